@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``admission.py``
+
+Memory-aware admission control and ordering for parallel execution. Tasks
+are started only while the sum of the estimated peak memory of the running
+tasks stays within the memory budget of the node, the remaining tasks wait
+in a queue. At least one task always runs, so a task estimated above the
+budget is run on its own.
+
+The peak memory of a task is estimated from the resource usage recorded for
+earlier runs of the same command (see record_metrics in general/core.py)
+and from the size of its input images.
+
+Tasks are submitted longest first (LPT), ranked by a cost such as the number
+of voxels times frames of their images. The recorded run times per unit of
+cost convert the costs into expected run times, from which the expected
+makespan of the schedule is reported next to the achieved one. The same
+expected run times are used to pack sessions into scheduler jobs with
+balanced loads.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import heapq
+
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import general.workers as gw
+
+# the fraction of the available memory used as the default budget
+DEFAULT_BUDGET_FRACTION = 0.9
+
+# peak memory of a task as a multiple of the in-memory size of its images
+IMAGE_MEMORY_FACTOR = 4
+
+# the number of most recent metrics files to learn from
+HISTORY_FILES = 20
+
+_units = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_memory(value):
+    """
+    Parses a memory size such as 64G, 1500M or a number of bytes. Returns
+    None for empty values.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    m = re.match(r"^\s*([\d.]+)\s*([kmgt]?)i?b?\s*$", str(value).lower())
+    if not m:
+        raise ValueError("Invalid memory size: %s" % (value))
+    return int(float(m.group(1)) * _units[m.group(2)])
+
+
+def _cgroup_limit():
+    for filename in [
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ]:
+        try:
+            with open(filename) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            pass
+    return None
+
+
+def available_memory():
+    """
+    Returns the memory available to QuNex in bytes: the SLURM memory
+    allocation or the cgroup limit if set, otherwise the currently available
+    physical memory.
+    """
+    limits = []
+
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        limits.append(parse_memory(os.environ["SLURM_MEM_PER_NODE"] + "M"))
+    elif os.environ.get("SLURM_MEM_PER_CPU") and os.environ.get("SLURM_CPUS_ON_NODE"):
+        limits.append(
+            parse_memory(os.environ["SLURM_MEM_PER_CPU"] + "M")
+            * int(os.environ["SLURM_CPUS_ON_NODE"])
+        )
+
+    cgroup = _cgroup_limit()
+    if cgroup:
+        limits.append(cgroup)
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        try:
+            limits.append(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+        except (ValueError, OSError, AttributeError):
+            pass
+
+    return min(limits) if limits else None
+
+
+def memory_budget(options):
+    """
+    Returns the memory budget in bytes as set by the memory_budget option,
+    or None if admission control is disabled. An empty value or "auto" uses
+    90% of the available memory.
+    """
+    value = options.get("memory_budget", "auto")
+    if value in [None, "none", "no", "off"]:
+        return None
+    if value in ["", "auto"]:
+        available = available_memory()
+        return int(available * DEFAULT_BUDGET_FRACTION) if available else None
+    return parse_memory(value)
+
+
+def _records(logfolder, name):
+    """Yields the entries for name in the most recent metrics files."""
+    if not logfolder:
+        return
+    files = glob.glob(os.path.join(logfolder, "Metrics-*.jsonl"))
+    files = sorted(files, key=os.path.getmtime)[-HISTORY_FILES:]
+
+    for filename in files:
+        try:
+            with open(filename) as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("name") == name:
+                yield entry
+
+
+def history(logfolder, task):
+    """
+    Returns the largest max RSS in bytes recorded for the task in the most
+    recent metrics files in the log folder, or None if it never ran.
+    """
+    peak = None
+    for entry in _records(logfolder, task):
+        if entry.get("maxrss"):
+            peak = max(peak or 0, entry["maxrss"] * 1024)
+    return peak
+
+
+def runtime_rate(logfolder, name):
+    """
+    Returns the recorded run time in seconds per unit of cost of the tasks
+    recorded under name, or None if there are no records.
+    """
+    wall, cost = 0.0, 0
+    for entry in _records(logfolder, name):
+        if entry.get("wall") and entry.get("cost"):
+            wall += entry["wall"]
+            cost += entry["cost"]
+    return wall / cost if cost else None
+
+
+def _image_sizes(images):
+    """Returns the (voxels times frames, bytes per voxel) of each readable image."""
+    import nibabel as nib
+
+    sizes = []
+    for image in images:
+        try:
+            img = nib.load(image)
+            voxels = 1
+            for dim in img.shape:
+                voxels *= dim
+            sizes.append((voxels, img.header.get_data_dtype().itemsize))
+        except Exception:
+            pass
+    return sizes
+
+
+def image_memory(images):
+    """
+    Returns the estimated peak memory in bytes of processing the images,
+    based on their dimensions and data type.
+    """
+    total = sum(voxels * size for voxels, size in _image_sizes(images))
+    return total * IMAGE_MEMORY_FACTOR
+
+
+def image_cost(images):
+    """Returns the processing cost of the images, their voxels times frames."""
+    return sum(voxels for voxels, _ in _image_sizes(images))
+
+
+def relative_costs(counts, images):
+    """
+    Returns the costs of items in units of an average image. images lists
+    the image files of each item; an item whose images can all be read
+    costs the voxels times frames of its images relative to the average
+    image of all items, any other item its count of images from counts.
+    """
+    sizes = [[image_cost([e]) for e in item] for item in images]
+    known = [e for item in sizes for e in item if e]
+    if not known:
+        return list(counts)
+    average = sum(known) / float(len(known))
+    return [
+        sum(item) / average if item and all(item) else count
+        for count, item in zip(counts, sizes)
+    ]
+
+
+def expected_times(costs, durations, rate=None):
+    """
+    Returns the expected run time of each item in seconds: its recorded
+    duration if known, otherwise its cost times the run time per unit of
+    cost. Without a rate, the rate of the items with recorded durations is
+    used. Returns the costs themselves and False if no run times are
+    known, otherwise the times and True.
+    """
+    measured = [(d, c) for d, c in zip(durations, costs) if d]
+    if rate is None and measured:
+        rate = sum(d for d, _ in measured) / float(sum(c for _, c in measured))
+    if rate is None:
+        return list(costs), False
+    return [d if d else c * rate for d, c in zip(durations, costs)], True
+
+
+def pack(times, bins):
+    """
+    Packs items with the given run times into bins with balanced loads,
+    taking the items longest first and adding each to the least loaded bin
+    (LPT). Returns the list of item indices in each bin and the load of
+    each bin.
+    """
+    groups = [[] for _ in range(bins)]
+    loads = [0.0] * bins
+    heap = [(0.0, b) for b in range(bins)]
+    for n in lpt_order(times):
+        load, b = heapq.heappop(heap)
+        groups[b].append(n)
+        loads[b] = load + times[n]
+        heapq.heappush(heap, (loads[b], b))
+    return groups, loads
+
+
+def estimate_memory(options, task, images=None):
+    """
+    Returns the estimated peak memory of a task in bytes, the larger of the
+    peak recorded for earlier runs of the task and the estimate from the
+    size of its images, or 0 if neither is known.
+    """
+    recorded = history(options.get("runlogs"), task) or 0
+    estimated = image_memory(images) if images else 0
+    return max(recorded, estimated)
+
+
+def apply_call(call):
+    """Calls call[0] with the remaining elements of the call as arguments."""
+    return call[0](*call[1:])
+
+
+def lpt_order(costs):
+    """Returns the indices of the items ordered by decreasing cost."""
+    return sorted(range(len(costs)), key=lambda n: -costs[n])
+
+
+def makespan(times, workers, order=None):
+    """
+    Returns the makespan of running items with the given run times on the
+    given number of workers, each item starting on the first free worker in
+    the given order.
+    """
+    if order is None:
+        order = range(len(times))
+    free = [0.0] * max(1, min(workers, len(times)))
+    for n in order:
+        heapq.heappush(free, heapq.heappop(free) + times[n])
+    return max(free)
+
+
+def map_admitted(
+    function,
+    items,
+    workers,
+    budget,
+    estimates,
+    report=None,
+    callback=None,
+    order=None,
+    timings=None,
+):
+    """
+    ``map_admitted(function, items, workers, budget, estimates, report=None, callback=None, order=None, timings=None)``
+
+    Runs function on all items in the shared worker pool (see
+    general/workers.py), or on a pool of its own within a worker, at most
+    workers at a time, and returns the list of results in the order of
+    items. If a budget in bytes is given, an item is only started while the estimated memory of the running items and of the item
+    stays within the budget. estimates is a list with the estimated peak
+    memory of each item. report is an optional function called with a
+    message whenever an item has to wait, callback an optional function
+    called with the index and the result of each item as it completes.
+    Items are submitted in the given order of indices, or in the order of
+    items. If timings is a dictionary, the start and end time of each item
+    are stored in it by index.
+    """
+    results = [None] * len(items)
+    pending = list(range(len(items)) if order is None else order)
+    running = {}
+    waiting = set()
+    used = 0
+
+    with gw.pool(workers) as start:
+        while pending or running:
+            # --- start items while within the limits
+            while pending and len(running) < workers:
+                n = pending[0]
+                if budget and running and used + estimates[n] > budget:
+                    if report and n not in waiting:
+                        waiting.add(n)
+                        report(
+                            "waiting with item %d, estimated memory %.1f GB, "
+                            "in use %.1f GB of %.1f GB"
+                            % (
+                                n + 1,
+                                estimates[n] / 1024**3,
+                                used / 1024**3,
+                                budget / 1024**3,
+                            )
+                        )
+                    break
+                pending.pop(0)
+                running[start(function, items[n])] = n
+                used += estimates[n]
+                if timings is not None:
+                    timings[n] = (time.time(), None)
+
+            # --- wait for an item to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                n = running.pop(future)
+                used -= estimates[n]
+                if timings is not None:
+                    timings[n] = (timings[n][0], time.time())
+                results[n] = future.result()
+                if callback:
+                    callback(n, results[n])
+
+    return results
+
+
+def run_scheduled(
+    function,
+    items,
+    workers,
+    options,
+    name,
+    costs,
+    estimates=None,
+    budget=None,
+    report=None,
+    callback=None,
+    timings=None,
+):
+    """
+    ``run_scheduled(function, items, workers, options, name, costs, estimates=None, budget=None, report=None, callback=None, timings=None)``
+
+    Runs function on the items with map_admitted, submitting them longest
+    first by their costs. The run time and cost of each item are recorded
+    under name in the metrics file of the run to calibrate the expected run
+    times of later runs. The start and end times of the items are stored
+    by index in timings if it is a dictionary. Returns the results in the
+    order of items and a summary of the expected and achieved makespan.
+    """
+    from general import core as gc
+
+    estimates = estimates or [0] * len(items)
+    order = lpt_order(costs)
+    rate = runtime_rate(options.get("runlogs"), name)
+    if timings is None:
+        timings = {}
+
+    results = map_admitted(
+        function,
+        items,
+        workers,
+        budget,
+        estimates,
+        report=report,
+        callback=callback,
+        order=order,
+        timings=timings,
+    )
+
+    for n, (start, end) in timings.items():
+        if end is not None and costs[n]:
+            gc.record_metrics(name, None, 0, {"wall": end - start}, cost=costs[n])
+
+    summary = "\n---> Ran %d %s longest first on %d workers" % (
+        len(items),
+        "item" if len(items) == 1 else "items",
+        workers,
+    )
+    if rate:
+        times = [e * rate for e in costs]
+        summary += ", expected makespan %.0f s (%.0f s in submitted order)" % (
+            makespan(times, workers, order),
+            makespan(times, workers),
+        )
+    if timings:
+        summary += ", achieved makespan %.0f s" % (
+            max(e[1] for e in timings.values()) - min(e[0] for e in timings.values())
+        )
+    return results, summary
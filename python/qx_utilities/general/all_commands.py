@@ -63,6 +63,8 @@ all_qunex_commands = [
     ("qx_mri.general.general_plot_bold_timeseries_list",            "Creates and saves a plot of BOLD timeseries for a list of sessions.",                      "matlab"),
     ("qx_mri.general.general_qa_concfile",                          "Computes and saves the specified statistics on images specified in the conc file.",        "matlab"),
     ("qx_utilities.general.dicomdeid.get_dicom_fields",             "Returns an overview of DICOM fields across all the DICOM files.",                          "python"),
+    ("qx_utilities.general.daemon.gmri_daemon",                     "Starts, stops or reports the status of a resident gmri daemon.",                           "python"),
+    ("qx_utilities.general.results.query_results",                  "Summarizes the progress of processing runs from their results files.",                     "python"),
     ("qx_utilities.hcp.process_hcp.hcp_asl",                        "Runs HCP ASL pipeline.",                                                                   "python"),
     ("qx_utilities.hcp.process_hcp.hcp_dedrift_and_resample",       "Runs HCP MSMAll pipeline.",                                                                "python"),
     ("qx_utilities.hcp.process_hcp.hcp_diffusion",                  "Runs HCP DWI pipeline.",                                                                   "python"),
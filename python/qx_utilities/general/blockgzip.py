@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``blockgzip.py``
+
+Parallel block gzip compression of image files. Data is split into blocks that
+are compressed independently in a thread pool and written as consecutive
+members of a standard multi-member gzip file, which can be read by gzip,
+nibabel, FSL and any other zlib based tool.
+
+Each member carries its compressed size in a 'QX' gzip extra subfield, which
+allows the reader to build an index of member boundaries by reading only the
+member headers and trailers, and to decompress only the members that overlap
+the requested data.
+
+The compression level and the number of threads default to the values of the
+QUNEXGZIPLEVEL and QUNEXGZIPTHREADS environment variables, or to 6 and the
+number of available cores.
+"""
+
+import os
+import io
+import gzip
+import zlib
+import struct
+import bisect
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+import general.exceptions as ge
+
+BLOCKSIZE = 1 << 22
+SUBFIELD = b"QX"
+
+# gzip member header: magic, deflate, FEXTRA flag, mtime 0, xfl 0, OS unknown,
+# XLEN, and the 'QX' subfield holding the total size of the member
+HEADER = struct.Struct("<4sIBBHHHI")
+TRAILER = struct.Struct("<II")
+
+
+def get_level(level=None):
+    """Returns the compression level to use."""
+    if level is None:
+        level = os.environ.get("QUNEXGZIPLEVEL", 6)
+    try:
+        return min(max(int(level), 0), 9)
+    except:
+        return 6
+
+
+def get_threads(threads=None):
+    """Returns the number of compression threads to use."""
+    if threads is None:
+        threads = os.environ.get("QUNEXGZIPTHREADS")
+    try:
+        return max(int(threads), 1)
+    except:
+        if hasattr(os, "sched_getaffinity"):
+            return max(len(os.sched_getaffinity(0)), 1)
+        return os.cpu_count() or 1
+
+
+def compress_block(data, level):
+    """Compresses a block of data into a complete gzip member."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    size = HEADER.size + len(cdata) + TRAILER.size
+    header = HEADER.pack(
+        b"\x1f\x8b\x08\x04", 0, 0, 255, 8, struct.unpack("<H", SUBFIELD)[0], 4, size
+    )
+    return (
+        header
+        + cdata
+        + TRAILER.pack(zlib.crc32(data) & 0xFFFFFFFF, len(data) & 0xFFFFFFFF)
+    )
+
+
+class BlockGzipWriter(io.RawIOBase):
+    """
+    A write only file object that compresses the data written to it in
+    parallel blocks and writes them as members of a multi-member gzip file.
+    """
+
+    def __init__(self, filename, level=None, threads=None, blocksize=BLOCKSIZE):
+        super(BlockGzipWriter, self).__init__()
+        self.filename = filename
+        self.level = get_level(level)
+        self.threads = get_threads(threads)
+        self.blocksize = int(blocksize)
+        self.buffer = bytearray()
+        self.pending = []
+        self.position = 0
+        self.file = open(filename, "wb")
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        size = len(data)
+        self.position += size
+
+        # ---> fill up the pending block, then submit full blocks directly
+
+        start = 0
+        if self.buffer:
+            start = min(self.blocksize - len(self.buffer), size)
+            self.buffer += data[:start]
+            if len(self.buffer) == self.blocksize:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+        while size - start >= self.blocksize:
+            self._submit(bytes(data[start : start + self.blocksize]))
+            start += self.blocksize
+        self.buffer += data[start:]
+        return size
+
+    def tell(self):
+        return self.position
+
+    def _submit(self, block):
+        if self.executor is None:
+            self.file.write(compress_block(block, self.level))
+            return
+
+        self.pending.append(self.executor.submit(compress_block, block, self.level))
+
+        # ---> write out completed members in order, keep memory bounded
+
+        while self.pending and (
+            self.pending[0].done() or len(self.pending) > 2 * self.threads
+        ):
+            self.file.write(self.pending.pop(0).result())
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def flush(self):
+        """Compresses and writes out all the data written so far."""
+        if self.closed or self.file.closed:
+            return
+        if self.buffer or self.file.tell() == 0 and not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.file.write(self.pending.pop(0).result())
+        self.file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.file.close()
+            super(BlockGzipWriter, self).close()
+
+
+class BlockGzipReader(io.RawIOBase):
+    """
+    A read only, seekable file object for multi-member gzip files written by
+    BlockGzipWriter. Only the members overlapping the requested data are
+    decompressed.
+    """
+
+    def __init__(self, filename):
+        super(BlockGzipReader, self).__init__()
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.position = 0
+        self.cache = (None, b"")
+        try:
+            self.index = self._build_index()
+        except:
+            self.file.close()
+            raise
+        self.offsets = [e[1] for e in self.index]
+        self.size = self.index[-1][1] + self.index[-1][2] if self.index else 0
+
+    def _build_index(self):
+        """Returns a list of (compressed offset, uncompressed offset, size, member size)."""
+        index = []
+        coffset, uoffset = 0, 0
+        fsize = os.fstat(self.file.fileno()).st_size
+        while coffset < fsize:
+            self.file.seek(coffset)
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ge.CommandFailed(
+                    "BlockGzipReader",
+                    "Not a block gzip file",
+                    "File %s is not indexable!" % (self.filename),
+                )
+            magic, _, _, _, xlen, si, slen, msize = HEADER.unpack(header)
+            if (
+                magic != b"\x1f\x8b\x08\x04"
+                or xlen != 8
+                or struct.pack("<H", si) != SUBFIELD
+                or slen != 4
+            ):
+                raise ge.CommandFailed(
+                    "BlockGzipReader",
+                    "Not a block gzip file",
+                    "File %s is not indexable!" % (self.filename),
+                )
+            self.file.seek(coffset + msize - 4)
+            (usize,) = struct.unpack("<I", self.file.read(4))
+            index.append((coffset, uoffset, usize, msize))
+            coffset += msize
+            uoffset += usize
+        return index
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def _member(self, n):
+        if self.cache[0] != n:
+            coffset, _, usize, msize = self.index[n]
+            self.file.seek(coffset + HEADER.size)
+            cdata = self.file.read(msize - HEADER.size - TRAILER.size)
+            self.cache = (n, zlib.decompress(cdata, -zlib.MAX_WBITS))
+        return self.cache[1]
+
+    def pread(self, offset, size):
+        """Returns size bytes starting at the uncompressed offset."""
+        size = max(min(size, self.size - offset), 0)
+        if size == 0:
+            return b""
+        n = bisect.bisect_right(self.offsets, offset) - 1
+        out = bytearray()
+        while len(out) < size and n < len(self.index):
+            start = offset + len(out) - self.index[n][1]
+            out += self._member(n)[start : start + size - len(out)]
+            n += 1
+        return bytes(out)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        data = self.pread(self.position, size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            super(BlockGzipReader, self).close()
+
+
+def open_gzip(filename, mode="rb", level=None, threads=None, blocksize=BLOCKSIZE):
+    """
+    Opens a gzip file. In write mode a parallel BlockGzipWriter is returned. In
+    read mode a seekable BlockGzipReader is returned for block gzip files and a
+    regular gzip file object for all other gzip files.
+    """
+
+    if "w" in mode:
+        return BlockGzipWriter(
+            filename, level=level, threads=threads, blocksize=blocksize
+        )
+
+    try:
+        return BlockGzipReader(filename)
+    except ge.CommandFailed:
+        return gzip.open(filename, "rb")
+
+
+def gzip_file(filename, level=None, threads=None, remove=True):
+    """
+    Compresses filename to filename.gz using parallel block compression and,
+    like the gzip command, removes the original file. Returns the name of the
+    compressed file.
+    """
+
+    target = filename + ".gz"
+    with open(filename, "rb") as sf, BlockGzipWriter(
+        target, level=level, threads=threads
+    ) as tf:
+        shutil.copyfileobj(sf, tf, BLOCKSIZE)
+    shutil.copystat(filename, target)
+    if remove:
+        os.remove(filename)
+    return target
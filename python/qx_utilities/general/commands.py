@@ -28,6 +28,8 @@ from general import (
     commands_support,
     bruker,
     extensions,
+    daemon,
+    results,
 )
 
 # pipeline imports
@@ -135,9 +137,9 @@ commands = {
     "reslice": {"com": nifti.reslice, "args": ("inf", "slices", "outf")},
     "slice_image": {
         "com": img.slice_image,
-        "args": ("sourcefile", "targetfile", "frames"),
+        "args": ("sourcefile", "targetfile", "frames", "scrubfile", "parelements"),
     },
-    "nifti24dfp": {"com": nifti.nifti24dfp, "args": ("inf", "outf")},
+    "nifti24dfp": {"com": nifti.nifti24dfp, "args": ("inf", "outf", "parelements")},
     "setup_hcp": {
         "com": setup_hcp.setup_hcp,
         "args": (
@@ -395,6 +397,14 @@ commands = {
         "com": utilities.get_sessions_for_slurm_array,
         "args": ("sessions", "sessionids"),
     },
+    "gmri_daemon": {
+        "com": daemon.gmri_daemon,
+        "args": ("action", "socketpath", "idle"),
+    },
+    "query_results": {
+        "com": results.query_results,
+        "args": ("sessionsfolder", "logfolder", "active", "details", "stale"),
+    },
     "run_qa": {
         "com": run_qa.run_qa,
         "args": (
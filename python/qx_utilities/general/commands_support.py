@@ -483,6 +483,8 @@ logskip_commands = [
     "batch_tag2namekey",
     "check_deprecated_commands",
     "get_sessions_for_slurm_array",
+    "gmri_daemon",
+    "query_results",
 ]
 
 
@@ -23,13 +23,19 @@ import time
 import multiprocessing
 import glob
 import sys
-import types
 import traceback
 import gzip
+import hashlib
+import json
+import socket
 from datetime import datetime
+import concurrent.futures
 from concurrent.futures import ProcessPoolExecutor
 
 import general.filelock as fl
+import general.fscache as fsc
+import general.watchdog as gwd
+import general.engine as gen
 import general.exceptions as ge
 import general.commands_support as gcs
 
@@ -55,9 +61,20 @@ def print_qunex_header(timestamp=None, file=None):
     return header
 
 
-def read_session_data(filename, verbose=False):
+# batch files larger than this are cached in a compiled form next to the file
+BATCH_CACHE_MIN_SIZE = 65536
+BATCH_CACHE_VERSION = 2
+
+# sessionids given as "map:<file>" are read from a job array session map
+SESSION_MAP_PREFIX = "map:"
+
+nsearch = re.compile(r"(.*?)\((.*)\)")
+csearch = re.compile(r"c([0-9]+)$")
+
+
+def read_session_data(filename, verbose=False, cache=None):
     """
-    ``read_session_data(filename, verbose=False)``
+    ``read_session_data(filename, verbose=False, cache=None)``
 
     Reads a `batch.txt` file.
 
@@ -68,6 +85,12 @@ def read_session_data(filename, verbose=False):
     reads the file and returns a list of sessions with the information on images
     and the additional parameters specified in the header.
 
+    The parsed content of large batch files is cached as JSON in a hidden
+    `.<filename>.qxcache` file next to the batch file. The cache is keyed by the
+    path, size, modification time and content hash of the batch file and is
+    rebuilt automatically whenever the file changes. Caching can be forced on
+    or off with the cache parameter, or disabled globally by setting the
+    QUNEXBATCHCACHE environment variable to 'no'.
     """
 
     if not os.path.exists(filename):
@@ -77,55 +100,82 @@ def read_session_data(filename, verbose=False):
         )
         raise ValueError("ERROR: Batch file not found: %s" % (filename))
 
-    file = open(filename, "r")
-    s = file.read()
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    if cache is None:
+        cache = len(content) >= BATCH_CACHE_MIN_SIZE
+    if os.environ.get("QUNEXBATCHCACHE", "yes").lower() == "no":
+        cache = False
+
+    if cache:
+        key = _batch_cache_key(filename, content)
+        cached = _load_batch_cache(filename, key)
+        if cached is not None:
+            slist, gpref, warnings = cached
+            if verbose:
+                for warning in warnings:
+                    print(warning)
+                _check_session_paths(slist, filename)
+            return slist, gpref
+
+    slist, gpref, warnings = _parse_session_data(
+        content.decode().replace("\r\n", "\n"), filename
+    )
+
+    if verbose:
+        for warning in warnings:
+            print(warning)
+        _check_session_paths(slist, filename)
+
+    if cache:
+        _save_batch_cache(filename, key, (slist, gpref, warnings))
+
+    return slist, gpref
+
+
+def _parse_session_data(s, filename):
+    """
+    Parses the content of a batch or session file in a single pass over its
+    lines. Returns the list of sessions, the global parameters and a list of
+    warnings.
+    """
+
     s = s.replace("\r", "\n")
     s = s.replace("\n\n", "\n")
     s = re.sub("^#.*?\n", "", s)
 
-    s = s.split("\n---")
-    s = [e for e in s if len(e) > 10]
-
-    nsearch = re.compile(r"(.*?)\((.*)\)")
-    csearch = re.compile(r"c([0-9]+)$")
-
     slist = []
     gpref = {}
+    warnings = []
 
     c = 0
+    line = None
     # first "session" is the parameters block
     first = True
     try:
-        for sub in s:
-            sub = sub.split("\n")
-            sub = [e.strip() for e in sub]
-            sub = [e.split("#")[0].strip() for e in sub]
-            sub = [e for e in sub if len(e) > 0]
+        for sub in s.split("\n---"):
+            if len(sub) <= 10:
+                continue
 
             dic = {}
-            for line in sub:
+            for line in sub.split("\n"):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
                 c += 1
 
                 # --- read preferences / settings
-                if line.startswith("--"):
-                    pkey, pvalue = [e.strip() for e in line.split(":", 1)]
-                    if first:
-                        gpref[pkey[2:]] = pvalue
-                    else:
-                        dic[pkey] = pvalue
-                    continue
-
-                elif line.startswith("_") or line.startswith("-"):
+                if line[0] in "-_":
                     pkey, pvalue = [e.strip() for e in line.split(":", 1)]
                     if first:
-                        gpref[pkey[1:]] = pvalue
+                        gpref[pkey[2:] if pkey.startswith("--") else pkey[1:]] = pvalue
                     else:
                         dic[pkey] = pvalue
                     continue
 
                 # --- split line
-                line = line.split(":")
-                line = [e.strip() for e in line]
+                line = [e.strip() for e in line.split(":")]
                 if len(line) < 2:
                     continue
 
@@ -135,7 +185,7 @@ def read_session_data(filename, verbose=False):
                     image["ima"] = line[0]
                     remove = []
                     for e in line:
-                        m = nsearch.match(e)
+                        m = "(" in e and nsearch.match(e)
                         if m:
                             image[m.group(1).strip()] = m.group(2).strip()
                             remove.append(e)
@@ -154,7 +204,7 @@ def read_session_data(filename, verbose=False):
                     dic[line[0]] = image
 
                 # --- read conc data
-                elif csearch.match(line[0]):
+                elif line[0].startswith("c") and csearch.match(line[0]):
                     conc = {}
                     conc["cnum"] = line[0]
                     for e in line:
@@ -181,10 +231,9 @@ def read_session_data(filename, verbose=False):
 
             if len(dic) > 0:
                 if ("id" not in dic) and ("session" not in dic):
-                    if verbose:
-                        print(
-                            "WARNING: There is a record missing an id field and is being omitted from processing."
-                        )
+                    warnings.append(
+                        "WARNING: There is a record missing an id field and is being omitted from processing."
+                    )
                 else:
                     if "id" in dic and "session" not in dic:
                         dic["session"] = dic["id"]
@@ -192,15 +241,6 @@ def read_session_data(filename, verbose=False):
                         dic["id"] = dic["session"]
                     slist.append(dic)
 
-            # check paths
-            for field in ["dicom", "raw_data", "data", "hpc"]:
-                if field in dic:
-                    if not os.path.exists(dic[field]) and verbose:
-                        print(
-                            "WARNING: session %s - folder %s: %s specified in %s does not exist! Check your paths!"
-                            % (dic["id"], field, dic[field], os.path.basename(filename))
-                        )
-
             # done with the parameters block
             first = False
 
@@ -211,6 +251,186 @@ def read_session_data(filename, verbose=False):
         )
         raise
 
+    return slist, gpref, warnings
+
+
+def _check_session_paths(slist, filename):
+    """Warns about session folders specified in a batch file that do not exist."""
+    for dic in slist:
+        for field in ["dicom", "raw_data", "data", "hpc"]:
+            if field in dic and not os.path.exists(dic[field]):
+                print(
+                    "WARNING: session %s - folder %s: %s specified in %s does not exist! Check your paths!"
+                    % (dic["id"], field, dic[field], os.path.basename(filename))
+                )
+
+
+def _batch_cache_file(filename, suffix=".qxcache"):
+    folder, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, "." + name + suffix)
+
+
+def _batch_cache_key(filename, content):
+    stat = os.stat(filename)
+    return (
+        BATCH_CACHE_VERSION,
+        os.path.abspath(filename),
+        stat.st_size,
+        stat.st_mtime_ns,
+        hashlib.sha1(content).hexdigest(),
+    )
+
+
+def _load_batch_cache(filename, key, suffix=".qxcache"):
+    """Returns the cached parse of the batch file or None if it is not valid."""
+    # the cache is plain JSON data, study folders are often writable by others
+    try:
+        with open(_batch_cache_file(filename, suffix), "r") as f:
+            ckey, data = json.load(f)
+    except Exception:
+        return None
+    if ckey != list(key):
+        return None
+    return data
+
+
+def _save_batch_cache(filename, key, data, suffix=".qxcache"):
+    """Atomically saves the parsed batch file, failures are silently ignored."""
+    cachefile = _batch_cache_file(filename, suffix)
+    tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+    try:
+        with open(tmpfile, "w") as f:
+            json.dump([list(key), data], f)
+        os.replace(tmpfile, cachefile)
+    except Exception:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+BATCH_INDEX_VERSION = 2
+
+isearch = re.compile(rb"^[ \t]*(id|session)[ \t]*:([^\n#]*)", re.M)
+
+
+def read_session_index(filename, rebuild=False):
+    """
+    ``read_session_index(filename, rebuild=False)``
+
+    Returns an index of the session blocks in a batch file as a list of
+    [byte offset, block length, session ids] entries, the first block holding
+    the global parameters. Returns None if the file can not be indexed (e.g.
+    it uses '\\r' line endings), in which case it has to be read in full.
+
+    For large batch files the index is saved as JSON in a hidden
+    `.<filename>.qxindex` file next to the batch file, keyed by the path, size
+    and modification time of the batch file. If rebuild is True, the saved
+    index is not used but replaced.
+    """
+
+    stat = os.stat(filename)
+    key = (
+        BATCH_INDEX_VERSION,
+        os.path.abspath(filename),
+        stat.st_size,
+        stat.st_mtime_ns,
+    )
+    cache = (
+        stat.st_size >= BATCH_CACHE_MIN_SIZE
+        and os.environ.get("QUNEXBATCHCACHE", "yes").lower() != "no"
+    )
+
+    if cache and not rebuild:
+        index = _load_batch_cache(filename, key, ".qxindex")
+        if index is not None:
+            return index
+
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    index = _build_session_index(content)
+    if cache and index is not None:
+        _save_batch_cache(filename, key, index, ".qxindex")
+
+    return index
+
+
+def _build_session_index(content):
+    """Splits the batch file content into blocks and extracts their ids."""
+
+    if b"\r" in content:
+        return None
+
+    bounds = [0] + [m.start() for m in re.finditer(rb"\n---", content)] + [len(content)]
+
+    # the first block has to be the one parsed as the parameters block
+    first = re.sub(rb"^#.*?\n", b"", content[: bounds[1]].replace(b"\n\n", b"\n"))
+    if len(first) <= 10:
+        return None
+
+    return [
+        [start, end - start, _block_ids(content, start, end)]
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def _block_ids(content, start, end):
+    """Returns the session ids given in the block of the batch file content."""
+    ids = []
+    for m in isearch.finditer(content, start, end):
+        value = m.group(2).decode()
+        ids.append(":".join([e.strip() for e in value.split(":")]))
+    return ids
+
+
+def _read_blocks(filename, blocks):
+    """
+    Reads the indexed blocks of the batch file. Returns None if any of them
+    does not hold the session ids it is indexed with, e.g. because the file
+    was edited without changing its size and modification time.
+    """
+    content = []
+    with open(filename, "rb") as f:
+        for n, (offset, length, ids) in enumerate(blocks):
+            block = os.pread(f.fileno(), length, offset)
+            if len(block) != length or (offset and not block.startswith(b"\n---")):
+                return None
+            if _block_ids(block, 0, length) != ids:
+                return None
+            content.append(block)
+    return b"".join(content)
+
+
+def read_session_subset(filename, sessionids, verbose=False):
+    """
+    ``read_session_subset(filename, sessionids, verbose=False)``
+
+    Reads only the blocks of the batch file that belong to the sessions in the
+    sessionids collection, using the batch file index. Returns the list of
+    sessions and the global parameters, exactly as read_session_data would
+    for these sessions, or (None, None) if the file can not be indexed. A
+    saved index that does not match the file is rebuilt.
+    """
+
+    sessionids = set(sessionids)
+    content = None
+    for rebuild in [False, True]:
+        index = read_session_index(filename, rebuild=rebuild)
+        if index is None:
+            return None, None
+        blocks = [index[0]] + [e for e in index[1:] if sessionids.intersection(e[2])]
+        content = _read_blocks(filename, blocks)
+        if content is not None:
+            break
+    if content is None:
+        return None, None
+
+    slist, gpref, warnings = _parse_session_data(content.decode(), filename)
+
+    if verbose:
+        for warning in warnings:
+            print(warning)
+        _check_session_paths(slist, filename)
+
     return slist, gpref
 
 
@@ -248,6 +468,47 @@ def read_list(filename, verbose=False):
     return slist
 
 
+def write_session_map(filename, tasks):
+    """
+    ``write_session_map(filename, tasks)``
+
+    Writes a job array session map, a line with the comma separated session
+    ids of each task of the array, in the order of task ids.
+    """
+    with open(filename, "w") as f:
+        for sessionids in tasks:
+            print(",".join(sessionids), file=f)
+
+
+def read_session_map(filename, task=None):
+    """
+    ``read_session_map(filename, task=None)``
+
+    Returns the session ids of the given task of a job array session map,
+    by default of the task given by SLURM_ARRAY_TASK_ID, or the session ids
+    of all tasks outside of a job array.
+    """
+    if task is None and "SLURM_ARRAY_TASK_ID" in os.environ:
+        task = int(os.environ["SLURM_ARRAY_TASK_ID"])
+
+    with open(filename, "r") as f:
+        if task is None:
+            return [e for line in f for e in line.strip().split(",") if e]
+        for n, line in enumerate(f):
+            if n == task:
+                sessionids = [e for e in line.strip().split(",") if e]
+                if sessionids:
+                    return sessionids
+                break
+
+    raise ge.CommandFailed(
+        "read_session_map",
+        "Job array task not in the session map",
+        "Task %s has no sessions in the session map %s!" % (task, filename),
+        "Please check the array setting of the job!",
+    )
+
+
 def get_sessions_list(
     listString, filter=None, sessionids=None, sessionsfolder=None, verbose=False
 ):
@@ -282,17 +543,39 @@ def get_sessions_list(
     sessions from a listString will be treated as glob patterns and all folders
     that match the pattern in the sessionsfolder will be returned as session
     ids.
+
+    If sessionids is given as "map:<file>", the sessions of the current SLURM
+    job array task are read from the session map file (see
+    write_session_map). Otherwise, inside a SLURM job array, each task gets
+    every n-th of the sessions.
     """
 
     gpref = {}
 
+    # sessions of a job array task listed in a session map
+    mapped = False
+    if sessionids is not None and sessionids.strip().startswith(SESSION_MAP_PREFIX):
+        mapfile = sessionids.strip()[len(SESSION_MAP_PREFIX) :]
+        sessionids = ",".join(read_session_map(mapfile))
+        mapped = True
+
     listString = listString.strip()
 
     if re.match(r".*\.list$", listString):
         slist = read_list(listString, verbose=verbose)
 
     elif os.path.isfile(listString):
-        slist, gpref = read_session_data(listString, verbose=verbose)
+        slist = None
+        if (
+            sessionids is not None
+            and sessionids.strip() != ""
+            and os.path.getsize(listString) >= BATCH_CACHE_MIN_SIZE
+        ):
+            slist, gpref = read_session_subset(
+                listString, re.split(r" +|,|\|", sessionids.strip()), verbose=verbose
+            )
+        if slist is None:
+            slist, gpref = read_session_data(listString, verbose=verbose)
 
     elif (
         re.match(r".*\.txt$", listString) or "/" in listString
@@ -322,15 +605,12 @@ def get_sessions_list(
 
     # filter with sessionids
     if sessionids is not None and sessionids.strip() != "":
-        sessionids = re.split(r" +|,|\|", sessionids)
-        filtered_slist = []
-        for s in slist:
-            if "id" in s and s["id"] in sessionids:
-                filtered_slist.append(s)
-            elif "session" in s and s["session"] in sessionids:
-                filtered_slist.append(s)
-
-        slist = filtered_slist
+        sessionids = set(re.split(r" +|,|\|", sessionids))
+        slist = [
+            s
+            for s in slist
+            if s.get("id") in sessionids or s.get("session") in sessionids
+        ]
 
     # filter with filter
     if filter is not None and filter.strip() != "":
@@ -354,17 +634,19 @@ def get_sessions_list(
                 "Please adjust the parameter!",
             )
 
+        filters = [(key, value, re.compile(value)) for key, value in filters]
+
         filtered_slist = []
         for s in slist:
-            for key, value in filters:
-                if key in s and (s[key] == value or re.match(value, s[key])):
+            for key, value, pattern in filters:
+                if key in s and (s[key] == value or pattern.match(s[key])):
                     filtered_slist.append(s)
                     break
 
         slist = filtered_slist
 
     # are we inside a SLURM job array?
-    if "SLURM_ARRAY_TASK_ID" in os.environ:
+    if "SLURM_ARRAY_TASK_ID" in os.environ and not mapped:
         # get ID for this job
         slurm_array_ix = int(os.environ["SLURM_ARRAY_TASK_ID"])
 
@@ -428,12 +710,142 @@ def deduceFolders(args):
     }
 
 
+def start_process(args, **kwargs):
+    """
+    ``start_process(args, **kwargs)``
+
+    Starts an external command with subprocess.Popen and notes its start
+    time so that wait_process can report its resource usage.
+    """
+    started = time.time()
+    p = subprocess.Popen(args, **kwargs)
+    p.started = started
+    return p
+
+
+def wait_process(p, nohang=False):
+    """
+    ``wait_process(p, nohang=False)``
+
+    Waits for a process started by start_process using os.wait4 and returns
+    its exit code and resource usage. The usage is a dictionary with wall
+    time, user and system CPU time in seconds, max RSS in kB and the number
+    of blocks read and written. It includes all the descendants of the
+    process that it waited for. If nohang is True and the process is still
+    running, (None, None) is returned.
+    """
+    if p.returncode is not None:
+        return p.returncode, getattr(p, "usage", None)
+
+    try:
+        pid, status, ru = os.wait4(p.pid, os.WNOHANG if nohang else 0)
+    except ChildProcessError:
+        # already reaped elsewhere, the usage is lost
+        return p.wait(), None
+    if pid == 0:
+        return None, None
+
+    p.returncode = os.waitstatus_to_exitcode(status)
+    p.usage = {
+        "wall": time.time() - p.started if hasattr(p, "started") else None,
+        "user": ru.ru_utime,
+        "system": ru.ru_stime,
+        "maxrss": ru.ru_maxrss,
+        "inblock": ru.ru_inblock,
+        "oublock": ru.ru_oublock,
+    }
+    return p.returncode, p.usage
+
+
+def call_process(args, watchdog=None, **kwargs):
+    """
+    ``call_process(args, watchdog=None, **kwargs)``
+
+    Runs an external command like subprocess.call and returns its exit code
+    and resource usage as reported by wait_process. If a Watchdog (see
+    general/watchdog.py) is given, the command is run in its own process
+    group under its supervision.
+    """
+    if watchdog is not None:
+        kwargs["start_new_session"] = True
+    p = start_process(args, **kwargs)
+    if watchdog is not None:
+        watchdog.start(p)
+    try:
+        return wait_process(p)
+    except:
+        if watchdog is not None:
+            watchdog.kill()
+        else:
+            p.kill()
+        wait_process(p)
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.stop()
+
+
+def format_usage(usage):
+    """
+    ``format_usage(usage)``
+
+    Returns a one line description of the resource usage of an external
+    command for the command log.
+    """
+    if not usage:
+        return "---> Resources used: not available"
+    wall = "n/a" if usage["wall"] is None else "%.1f s" % (usage["wall"])
+    return (
+        "---> Resources used: wall time %s, user CPU %.1f s, system CPU %.1f s, "
+        "max RSS %.1f MB, block I/O %d in / %d out"
+        % (
+            wall,
+            usage["user"],
+            usage["system"],
+            usage["maxrss"] / 1024.0,
+            usage["inblock"],
+            usage["oublock"],
+        )
+    )
+
+
+def record_metrics(name, command, exitcode, usage, **info):
+    """
+    ``record_metrics(name, command, exitcode, usage, **info)``
+
+    Appends the resource usage of an external command as a JSON line to the
+    metrics file of the run, given by the QUNEXMETRICS environment variable.
+    Nothing is recorded if the variable is not set.
+    """
+    filename = os.environ.get("QUNEXMETRICS")
+    if not filename or usage is None:
+        return
+    entry = {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "host": socket.gethostname(),
+        "name": name,
+        "command": command,
+        "exit": exitcode,
+    }
+    entry.update(usage)
+    entry.update(info)
+    try:
+        fl.safe_write(json.dumps(entry) + "\n", filename)
+    except (OSError, IOError) as e:
+        print("WARNING: Could not record metrics in %s: %s" % (filename, e))
+
+
 def runExternalParallel(calls, cores=None, prepend=""):
     """
     ``runExternalParallel(calls, cores=None, prepend='')``
 
     Runs external commands specified in 'calls' in parallel utilizing all the
-    available or the number of cores specified in 'cores'.
+    available or the number of cores specified in 'cores'. The commands run
+    on a ProcessEngine (see general/engine.py) that streams their output to
+    their log files. Each command is
+    supervised by a Watchdog if timeouts apply to it, and its 'stalled'
+    entry in the returned list records whether it was terminated as
+    "stalled" or on "timeout".
 
     Parameters:
         --calls (list):
@@ -472,135 +884,124 @@ def runExternalParallel(calls, cores=None, prepend=""):
         except:
             cores = 1
 
-    running = []
     completed = []
+    submitted = {}
+
+    def header(call):
+        return "Starting log for %s at %s\nThe command being run: \n>> %s\n\n" % (
+            call["name"],
+            str(datetime.now()).split(".")[0],
+            (
+                " ".join(call["args"])
+                if not isinstance(call["args"], str)
+                else call["args"]
+            ),
+        )
 
-    while True:
-        # --- check if we can add a process to run
-        if len(running) < cores:
-            if calls:
-                call = calls.pop(0)
-                if call["sout"]:
-                    if os.path.exists(call["sout"]):
-                        sout = open(call["sout"], "a", 1)
-                    else:
-                        sout = open(call["sout"], "w", 1)
-                else:
-                    sout = open(os.devnull, "w")
-
+    def started(call):
+        def report(p):
+            if call["sout"]:
                 print(
-                    "Starting log for %s at %s\nThe command being run: \n>> %s\n"
-                    % (
-                        call["name"],
-                        str(datetime.now()).split(".")[0],
-                        " ".join(call["args"]),
-                    ),
-                    file=sout,
+                    prepend
+                    + "started running %s at %s, track progress in %s"
+                    % (call["name"], str(datetime.now()).split(".")[0], call["sout"])
+                )
+            else:
+                print(
+                    prepend
+                    + "started running %s at %s"
+                    % (call["name"], str(datetime.now()).split(".")[0])
                 )
 
-                try:
-                    if "shell" in call and call["shell"]:
-                        running.append(
-                            {
-                                "call": call,
-                                "sout": sout,
-                                "p": subprocess.Popen(
-                                    call["args"],
-                                    stdout=sout,
-                                    stderr=sout,
-                                    bufsize=0,
-                                    shell=True,
-                                ),
-                            }
-                        )
-                    else:
-                        running.append(
-                            {
-                                "call": call,
-                                "sout": sout,
-                                "p": subprocess.Popen(
-                                    call["args"], stdout=sout, stderr=sout, bufsize=0
-                                ),
-                            }
-                        )
+        return report
 
-                    if call["sout"]:
-                        print(
-                            prepend
-                            + "started running %s at %s, track progress in %s"
-                            % (
-                                call["name"],
-                                str(datetime.now()).split(".")[0],
-                                call["sout"],
-                            )
-                        )
-                    else:
-                        print(
-                            prepend
-                            + "started running %s at %s"
-                            % (call["name"], str(datetime.now()).split(".")[0])
-                        )
-                except:
-                    print(
-                        prepend
-                        + "ERROR: failed to start running %s. Please check your environment!"
-                        % (call["name"])
-                    )
-                    completed.append(
-                        {
-                            "exit": -9,
-                            "name": call["name"],
-                            "log": call["sout"],
-                            "args": call["args"],
-                        }
-                    )
-                continue
+    with gen.ProcessEngine(cores) as engine:
+        for call in calls:
+            watchdog = gwd.Watchdog.from_environment(
+                call["args"],
+                task=call["name"],
+                logfile=call["sout"],
+                report=call["sout"],
+            )
+            future = engine.submit(
+                call["args"],
+                log=call["sout"],
+                name=call["name"],
+                shell=bool(call.get("shell")),
+                header=lambda call=call: header(call),
+                watchdog=watchdog,
+                started=started(call),
+            )
+            submitted[future] = call
 
-        # --- check if a process finished
-        done = []
-        for n in range(len(running)):
-            running[n]["sout"].flush()
-
-            if running[n]["p"].poll() is not None:
-                running[n]["sout"].close()
-                if running[n]["call"]["sout"]:
-                    print(
-                        prepend
-                        + "finished running %s (exit code: %d), log in %s"
-                        % (
-                            running[n]["call"]["name"],
-                            running[n]["p"].poll(),
-                            running[n]["call"]["sout"],
-                        )
-                    )
-                else:
-                    print(
-                        prepend
-                        + "finished running %s (exit code: %d)"
-                        % (running[n]["call"]["name"], running[n]["p"].poll())
-                    )
+        # --- report the commands as they finish
+        for future in concurrent.futures.as_completed(submitted):
+            call = submitted[future]
+            try:
+                result = future.result()
+            except Exception:
+                print(
+                    prepend
+                    + "ERROR: failed to start running %s. Please check your environment!"
+                    % (call["name"])
+                )
                 completed.append(
                     {
-                        "exit": running[n]["p"].poll(),
-                        "name": running[n]["call"]["name"],
-                        "log": running[n]["call"]["sout"],
-                        "args": running[n]["call"]["args"],
+                        "exit": -9,
+                        "name": call["name"],
+                        "log": call["sout"],
+                        "args": call["args"],
                     }
                 )
-                done.append(n)
-        if done:
-            while done:
-                running.pop(done.pop())
-            continue
-
-        # --- check if we are done:
-        if not calls and not running:
-            print(prepend + "DONE")
-            break
+                continue
+
+            exitcode, usage, stalled = (
+                result["exit"],
+                result["usage"],
+                result["stalled"],
+            )
+            if call["sout"]:
+                with open(call["sout"], "a") as sout:
+                    print("\n" + format_usage(usage), file=sout)
+                print(
+                    prepend
+                    + "finished running %s (exit code: %d%s), log in %s"
+                    % (
+                        call["name"],
+                        exitcode,
+                        ", " + stalled if stalled else "",
+                        call["sout"],
+                    )
+                )
+            else:
+                print(
+                    prepend
+                    + "finished running %s (exit code: %d%s)"
+                    % (call["name"], exitcode, ", " + stalled if stalled else "")
+                )
+            record_metrics(
+                call["name"],
+                call["args"],
+                exitcode,
+                usage,
+                log=call["sout"],
+                stalled=stalled,
+            )
+            completed.append(
+                {
+                    "exit": exitcode,
+                    "name": call["name"],
+                    "log": call["sout"],
+                    "args": call["args"],
+                    "usage": usage,
+                    "stalled": stalled,
+                }
+            )
 
-        # --- wait a bit
-        time.sleep(1)
+            # external commands might have changed any file
+            fsc.invalidate()
 
+    print(prepend + "DONE")
     return completed
 
 
@@ -882,6 +1283,53 @@ def runInParallel(calls, cores=None, prepend=""):
     return results
 
 
+# compiled spec files, keyed by path, size and mtime, and their field substitutions
+spec_cache = {}
+SPEC_CACHE_SIZE = 64  # spec files, and field substitutions per spec file
+
+
+def compileSpec(specFile, fields=None):
+    """
+    ``compileSpec(specFile, fields=None)``
+
+    Reads and compiles a full file check specification. Returns a tuple of
+    entries, each a tuple of alternatives, each a tuple of path components.
+    The compiled spec and its versions with {<key>} replaced by <value> for
+    each set of fields are cached for as long as the spec file does not
+    change.
+    """
+
+    stat = os.stat(specFile)
+    key = (os.path.abspath(specFile), stat.st_size, stat.st_mtime_ns)
+
+    if key not in spec_cache:
+        if len(spec_cache) >= SPEC_CACHE_SIZE:
+            spec_cache.pop(next(iter(spec_cache)))
+        with open(specFile, "r") as f:
+            text = f.read()
+        spec = tuple(
+            tuple(tuple(f.strip().split()) for f in e.split("|"))
+            for e in text.split("\n")
+            if len(e) and not e.startswith("#")
+        )
+        spec_cache[key] = {None: spec}
+
+    fields = tuple((k, v) for k, v in fields) if fields else None
+    compiled = spec_cache[key]
+    if fields not in compiled:
+        # keep the compiled spec itself and the most recent substitutions
+        if len(compiled) > SPEC_CACHE_SIZE:
+            compiled.pop(next(e for e in compiled if e is not None))
+        spec = compiled[None]
+        for k, v in fields:
+            k = "{%s}" % (k)
+            spec = tuple(
+                tuple(tuple(c.replace(k, v) for c in a) for a in e) for e in spec
+            )
+        compiled[fields] = spec
+    return compiled[fields]
+
+
 def checkFiles(testFolder, specFile, fields=None, report=None, append=False):
     """
     ``checkFiles(testFolder, specFile, fields=None, report=None, append=False)``
@@ -893,14 +1341,21 @@ def checkFiles(testFolder, specFile, fields=None, report=None, append=False):
     written to that file. Where there might be two alternative options of results
     e.g. difference because of AP/PA direction, then the alternative is to
     be provided in the same line separated by a pipe '|'
+
+    The compiled specification is cached across calls and each folder is
+    listed only once, the time spent checking is reported at the end of the
+    report.
     """
 
+    start = time.time()
+
     # --- open the report if needed:
 
+    rout = None
+    fileClose = False
     if report:
-        if type(report) is types.FileType:
+        if hasattr(report, "write"):
             rout = report
-            fileClose = False
         else:
             fileClose = True
             try:
@@ -923,15 +1378,16 @@ def checkFiles(testFolder, specFile, fields=None, report=None, append=False):
     # --- initial tests
 
     if not os.path.exists(testFolder):
-        print(
-            "The folder to be tested does not exist: %s \nPlease check your settings and paths!"
-            % (testFolder),
-            file=rout,
-        )
-        print(
-            "\n#-----------------=== End Full File Report ===----------------------",
-            file=rout,
-        )
+        if rout:
+            print(
+                "The folder to be tested does not exist: %s \nPlease check your settings and paths!"
+                % (testFolder),
+                file=rout,
+            )
+            print(
+                "\n#-----------------=== End Full File Report ===----------------------",
+                file=rout,
+            )
         if fileClose:
             rout.close()
         raise ge.CommandFailed(
@@ -942,15 +1398,16 @@ def checkFiles(testFolder, specFile, fields=None, report=None, append=False):
         )
 
     if not os.path.exists(specFile):
-        print(
-            "The specification file to test folder against does not exist: %s\nPlease check your settings and paths!"
-            % (specFile),
-            file=rout,
-        )
-        print(
-            "\n#-----------------=== End Full File Report ===----------------------",
-            file=rout,
-        )
+        if rout:
+            print(
+                "The specification file to test folder against does not exist: %s\nPlease check your settings and paths!"
+                % (specFile),
+                file=rout,
+            )
+            print(
+                "\n#-----------------=== End Full File Report ===----------------------",
+                file=rout,
+            )
         if fileClose:
             rout.close()
         raise ge.CommandFailed(
@@ -963,39 +1420,34 @@ def checkFiles(testFolder, specFile, fields=None, report=None, append=False):
 
     # --- read the spec
 
-    files = open(specFile, "r").read()
-
-    if fields:
-        for key, value in fields:
-            files = files.replace("{%s}" % (key), value)
-
-    files = [
-        [f.strip().split() for f in e.split("|")]
-        for e in files.split("\n")
-        if len(e) and not e.startswith("#")
-    ]
+    files = compileSpec(specFile, fields)
 
     # --- test the files
 
+    listing = fsc.DirectoryListing()
     present = []
     missing = []
     for testfiles in files:
         fileMissing = True
         for testfile in testfiles:
-            test = [testFolder] + testfile
-            tfile = os.path.join(*test)
-            if os.path.exists(tfile):
+            tfile = os.path.join(testFolder, *testfile)
+            if listing.exists(tfile):
                 present.append(tfile)
                 fileMissing = False
-                if report:
+                if rout:
                     print(". " + tfile, file=rout)
                 break
         if fileMissing:
             missing.append(tfile)
-            if report:
+            if rout:
                 print("X " + tfile, file=rout)
 
-    if report:
+    if rout:
+        print(
+            "\n# Checked %d files in %d folders in %.3f s"
+            % (len(files), listing.scans, time.time() - start),
+            file=rout,
+        )
         print(
             "\n#-----------------=== End Full File Report ===----------------------",
             file=rout,
@@ -1160,6 +1612,7 @@ def link_or_copy(
         name = "file"
     if prefix is None:
         prefix = "\n ... "
+    fsc.invalidate(target)
     if os.path.exists(source):
         try:
             if os.path.exists(target):
@@ -1228,6 +1681,10 @@ def moveLinkOrCopy(
     if prefix is None:
         prefix = ""
 
+    fsc.invalidate(target)
+    if action == "move":
+        fsc.invalidate(source)
+
     def report(rstatus, msg):
         if lock:
             fl.unlock(target)
@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``daemon.py``
+
+A resident gmri daemon that keeps the QuNex command tables and modules
+imported and runs commands received over a Unix socket. Each command is run
+in a forked child that takes over the standard input, output and error of the
+calling gmri process, which are passed over the socket, so that the output is
+streamed directly to the caller and commands remain isolated from each other
+and from the daemon.
+
+When the QUNEXDAEMON environment variable is set to "yes", gmri forwards the
+commands to the daemon listening on the socket given by QUNEXDAEMONSOCKET
+(by default $XDG_RUNTIME_DIR/qunex/gmri.sock or /tmp/qunex-<uid>/gmri.sock)
+and falls back to running them itself if no daemon is available or if the
+daemon was started with a different environment or code base.
+
+As the client passes its environment and standard streams to the daemon, the
+socket has to be in a folder that only the user can access, and both sides
+check that the process at the other end of the connection belongs to the
+same user before anything is sent or run.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import stat
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import traceback
+
+import general.exceptions as ge
+import general.manifest as gmf
+
+# environment variables that are read when QuNex modules are imported and
+# therefore have to match between the daemon and the client
+IMPORT_ENVIRONMENT = ["PYTHONPATH", "QXEXTENSIONSPY", "QUNEXMCOMMAND", "QUNEXPATH"]
+
+# commands that are never forwarded to the daemon
+LOCAL_COMMANDS = ["gmri_daemon"]
+
+LENGTH = struct.Struct("!I")
+STATUS = struct.Struct("!i")
+
+# status returned when the daemon refuses to run a command
+REFUSED = -1
+
+# set in the forked children that run commands within the daemon
+resident = False
+
+
+def get_socket(socketpath=None):
+    """Returns the path to the daemon socket."""
+    if socketpath:
+        return socketpath
+    if os.environ.get("QUNEXDAEMONSOCKET"):
+        return os.environ["QUNEXDAEMONSOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "qunex", "gmri.sock")
+    return os.path.join(tempfile.gettempdir(), "qunex-%d" % (os.getuid()), "gmri.sock")
+
+
+def _private_folder(socketpath):
+    """
+    Returns None if the folder of the socket is a directory, not a symlink,
+    owned by the user and not accessible to others, otherwise the problem.
+    """
+    folder = os.path.dirname(os.path.abspath(socketpath))
+    try:
+        info = os.lstat(folder)
+    except OSError as e:
+        return "%s can not be checked: %s" % (folder, e.strerror)
+    if not stat.S_ISDIR(info.st_mode):
+        return "%s is not a directory" % (folder)
+    if info.st_uid != os.getuid():
+        return "%s is not owned by the current user" % (folder)
+    if info.st_mode & 0o077:
+        return "%s is accessible to other users (mode %o)" % (
+            folder,
+            stat.S_IMODE(info.st_mode),
+        )
+    return None
+
+
+def _make_folder(socketpath):
+    """Creates the folder of the socket if needed and checks that it is private."""
+    folder = os.path.dirname(os.path.abspath(socketpath))
+    if not os.path.lexists(folder):
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+    problem = _private_folder(socketpath)
+    if problem:
+        raise ge.CommandFailed(
+            "gmri_daemon",
+            "Unsafe socket folder",
+            "The folder of the daemon socket %s is not private: %s!"
+            % (socketpath, problem),
+            "Use a folder that only you can access, e.g. with --socketpath.",
+        )
+
+
+def _peer_uid(conn):
+    """Returns the user id of the process at the other end of the connection."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = struct.Struct("3i")
+    try:
+        _, uid, _ = creds.unpack(
+            conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size)
+        )
+    except OSError:
+        return None
+    return uid
+
+
+def _environment_key(env):
+    return [env.get(e) for e in IMPORT_ENVIRONMENT]
+
+
+def _recv_exactly(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return data
+
+
+def _send_message(conn, message, fds=None):
+    data = json.dumps(message).encode()
+    if fds:
+        socket.send_fds(conn, [LENGTH.pack(len(data))], fds)
+    else:
+        conn.sendall(LENGTH.pack(len(data)))
+    conn.sendall(data)
+
+
+def _recv_message(conn, nfds=0):
+    if nfds:
+        header, fds, _, _ = socket.recv_fds(conn, LENGTH.size, nfds)
+        header += _recv_exactly(conn, LENGTH.size - len(header))
+    else:
+        header, fds = _recv_exactly(conn, LENGTH.size), []
+    (size,) = LENGTH.unpack(header)
+    return json.loads(_recv_exactly(conn, size).decode()), fds
+
+
+def _connect(socketpath):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketpath)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def _connect_daemon(socketpath):
+    """Connects to a daemon of the same user in a private folder, or returns None."""
+    if _private_folder(socketpath):
+        return None
+    conn = _connect(socketpath)
+    if conn is not None and _peer_uid(conn) != os.getuid():
+        conn.close()
+        return None
+    return conn
+
+
+# ==============================================================================
+#                                                                         CLIENT
+#
+
+
+def use_daemon(args):
+    """Returns True if the gmri call should be forwarded to the daemon."""
+    return (
+        not resident
+        and os.environ.get("QUNEXDAEMON", "no") == "yes"
+        and len(args) > 0
+        and args[0].strip("-") not in LOCAL_COMMANDS
+    )
+
+
+def client(args, socketpath=None):
+    """
+    Runs a gmri command through the daemon. Standard input, output and error
+    of the current process are passed to the daemon, signals are forwarded to
+    the command. Returns the exit status of the command or None if the daemon
+    is not available or refused to run the command. The daemon is only used
+    if its socket is in a private folder and it runs as the same user.
+    """
+
+    conn = _connect_daemon(get_socket(socketpath))
+    if conn is None:
+        return None
+
+    umask = os.umask(0o022)
+    os.umask(umask)
+
+    request = {
+        "action": "run",
+        "argv": list(args),
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "umask": umask,
+        "key": gmf.fingerprint(),
+    }
+
+    # -- forward signals to the command while it runs
+    def forward(signum, frame):
+        try:
+            conn.sendall(STATUS.pack(signum))
+        except OSError:
+            pass
+
+    handlers = {}
+    with conn:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_message(conn, request, fds=[0, 1, 2])
+        for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+            handlers[signum] = signal.signal(signum, forward)
+        try:
+            while True:
+                try:
+                    (status,) = STATUS.unpack(_recv_exactly(conn, STATUS.size))
+                    break
+                except InterruptedError:
+                    continue
+                except (EOFError, OSError):
+                    status = 1
+                    break
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    if status == REFUSED:
+        return None
+    return status
+
+
+# ==============================================================================
+#                                                                         SERVER
+#
+
+
+def _load_gmri():
+    """Imports the gmri script as a module."""
+    import importlib.machinery
+    import importlib.util
+
+    path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gmri"
+    )
+    loader = importlib.machinery.SourceFileLoader("gmri", path)
+    spec = importlib.util.spec_from_loader("gmri", loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def _preload():
+    """Imports gmri and the command tables so that forked children start warm."""
+    gmri = _load_gmri()
+
+    from general import commands, process, matlab, utilities, scheduler, core
+
+    gmf.load_manifest()
+    return gmri
+
+
+def _run_command(gmri, request, fds):
+    """Runs the command in the forked child, never returns."""
+    global resident
+
+    status = 1
+    try:
+        for n, fd in enumerate(fds):
+            os.dup2(fd, n)
+            os.close(fd)
+
+        for signum in [
+            signal.SIGINT,
+            signal.SIGTERM,
+            signal.SIGHUP,
+            signal.SIGCHLD,
+            signal.SIGPIPE,
+        ]:
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", buffering=1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+        os.environ.clear()
+        os.environ.update(request["env"])
+        resident = True
+        os.umask(request["umask"])
+        os.chdir(request["cwd"])
+        sys.argv = ["gmri"] + request["argv"]
+
+        try:
+            gmri.main(request["argv"])
+            status = 0
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status)
+
+
+def _handle(conn, gmri, key):
+    """
+    Handles a single connection in a forked handler process. The command is run
+    in a further child, the handler forwards signals from the client and reports
+    the exit status of the command. Connections from other users are closed
+    without reading the request.
+    """
+
+    if _peer_uid(conn) != os.getuid():
+        return
+
+    try:
+        request, fds = _recv_message(conn, nfds=3)
+    except (EOFError, OSError, ValueError):
+        return
+
+    if request.get("action") != "run" or len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        return
+
+    if (
+        request.get("key") != key["manifest"]
+        or _environment_key(request["env"]) != key["env"]
+    ):
+        for fd in fds:
+            os.close(fd)
+        conn.sendall(STATUS.pack(REFUSED))
+        return
+
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        _run_command(gmri, request, fds)
+
+    for fd in fds:
+        os.close(fd)
+
+    # -- forward signals from the client to the command
+    def forward():
+        while True:
+            try:
+                (signum,) = STATUS.unpack(_recv_exactly(conn, STATUS.size))
+                os.kill(pid, signum)
+            except (EOFError, OSError, ValueError):
+                return
+
+    threading.Thread(target=forward, daemon=True).start()
+
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        status = 128 + os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+
+    try:
+        conn.sendall(STATUS.pack(status))
+    except OSError:
+        pass
+
+
+def serve(socketpath=None, idle=None):
+    """
+    Runs the daemon in the foreground until it is stopped or, if idle is set,
+    until no command was run for idle seconds.
+    """
+
+    socketpath = get_socket(socketpath)
+    _make_folder(socketpath)
+
+    running = _connect(socketpath)
+    if running is not None:
+        running.close()
+        raise ge.CommandFailed(
+            "gmri_daemon",
+            "Daemon already running",
+            "A gmri daemon is already listening on %s!" % (socketpath),
+        )
+    if os.path.exists(socketpath):
+        os.remove(socketpath)
+
+    gmri = _preload()
+    key = {"manifest": gmf.fingerprint(), "env": _environment_key(os.environ)}
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socketpath)
+    finally:
+        os.umask(old_umask)
+    server.listen(64)
+
+    handlers = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print("---> gmri daemon listening on %s [pid %d]" % (socketpath, os.getpid()))
+    sys.stdout.flush()
+
+    last = time.time()
+    try:
+        while not stopping:
+            # -- reap finished handlers
+            for pid in list(handlers):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0]:
+                        handlers.discard(pid)
+                except ChildProcessError:
+                    handlers.discard(pid)
+            if handlers:
+                last = time.time()
+            elif idle and time.time() - last > float(idle):
+                break
+
+            try:
+                ready, _, _ = select.select([server], [], [], 1.0)
+            except InterruptedError:
+                continue
+            if not ready:
+                continue
+
+            try:
+                conn, _ = server.accept()
+            except OSError as e:
+                if e.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+
+            # -- check for the stop request and otherwise hand the connection to a handler
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    _handle(conn, gmri, key)
+                finally:
+                    os._exit(0)
+            conn.close()
+            handlers.add(pid)
+            last = time.time()
+    finally:
+        server.close()
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        print("---> gmri daemon stopped")
+
+
+def _daemon_pid(socketpath):
+    pidfile = socketpath + ".pid"
+    try:
+        with open(pidfile, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def gmri_daemon(action="status", socketpath=None, idle=None):
+    """
+    ``gmri_daemon [action=status] [socketpath=<runtime folder>/gmri.sock] [idle=None]``
+
+    Starts, stops or reports the status of a resident gmri daemon.
+
+    The daemon keeps the QuNex command tables and modules imported and runs
+    commands received over a Unix socket, each in its own forked child. When
+    the QUNEXDAEMON environment variable is set to "yes", gmri (and with it
+    the qunex front end and run_recipe steps) forwards commands to the daemon
+    and streams their output back, which avoids interpreter start-up and
+    module import costs for every call. If no daemon is running, or if the
+    daemon was started with different QuNex code or environment, commands are
+    run directly as before.
+
+    INPUTS
+    ======
+
+    --action      What to do: 'start' starts the daemon in the background,
+                  'run' runs it in the foreground, 'stop' stops a running
+                  daemon and 'status' reports whether a daemon is running.
+                  ['status']
+    --socketpath  The path to the Unix socket the daemon listens on, in a
+                  folder only the user can access. Defaults to
+                  QUNEXDAEMONSOCKET, $XDG_RUNTIME_DIR/qunex/gmri.sock or
+                  /tmp/qunex-<uid>/gmri.sock.
+    --idle        The number of seconds after which an idle daemon exits. By
+                  default the daemon runs until stopped. [None]
+
+    EXAMPLE USE
+    ===========
+
+    ::
+
+        qunex gmri_daemon --action=start --idle=3600
+        export QUNEXDAEMON=yes
+        qunex run_recipe --recipe_file=recipe.yaml --recipe=hcp_preprocess
+        qunex gmri_daemon --action=stop
+    """
+
+    socketpath = get_socket(socketpath)
+    pid = _daemon_pid(socketpath)
+    running = _connect_daemon(socketpath)
+    if running is not None:
+        running.close()
+
+    if action == "status":
+        if running is not None:
+            print("---> gmri daemon is running on %s [pid %s]" % (socketpath, pid))
+        else:
+            print("---> gmri daemon is not running on %s" % (socketpath))
+
+    elif action == "stop":
+        if running is None or pid is None:
+            print("---> gmri daemon is not running on %s" % (socketpath))
+            return
+        os.kill(pid, signal.SIGTERM)
+        for _ in range(100):
+            if not os.path.exists(socketpath):
+                break
+            time.sleep(0.1)
+        print("---> gmri daemon on %s stopped" % (socketpath))
+
+    elif action in ["start", "run"]:
+        if running is not None:
+            raise ge.CommandFailed(
+                "gmri_daemon",
+                "Daemon already running",
+                "A gmri daemon is already listening on %s [pid %s]!"
+                % (socketpath, pid),
+            )
+
+        _make_folder(socketpath)
+
+        if action == "start":
+            # -- detach from the terminal
+            if os.fork() > 0:
+                for _ in range(600):
+                    running = _connect(socketpath)
+                    if running is not None:
+                        running.close()
+                        print("---> gmri daemon started on %s" % (socketpath))
+                        return
+                    time.sleep(0.1)
+                raise ge.CommandFailed(
+                    "gmri_daemon",
+                    "Daemon not started",
+                    "The gmri daemon did not start listening on %s!" % (socketpath),
+                )
+            os.setsid()
+            if os.fork() > 0:
+                os._exit(0)
+            logfd = os.open(
+                socketpath + ".log", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600
+            )
+            nullfd = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(nullfd, 0)
+            os.dup2(logfd, 1)
+            os.dup2(logfd, 2)
+            os.close(nullfd)
+            os.close(logfd)
+
+        with open(socketpath + ".pid", "w") as f:
+            print(os.getpid(), file=f)
+        try:
+            serve(socketpath, idle)
+        finally:
+            if _daemon_pid(socketpath) == os.getpid():
+                os.remove(socketpath + ".pid")
+            if action == "start":
+                os._exit(0)
+
+    else:
+        raise ge.CommandError(
+            "gmri_daemon",
+            "Invalid action",
+            "Action '%s' is not supported!" % (action),
+            "Use one of: start, run, stop, status.",
+        )
@@ -44,6 +44,7 @@ import json
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import general.core as gc
 import general.img as gi
+import general.blockgzip as bgz
 import general.nifti as gn
 import general.qximg as qxi
 import general.exceptions as ge
@@ -627,7 +628,6 @@ def dicom2nii(
 
     # debug = True
     base = folder
-    null = open(os.devnull, "w")
     dmcf = os.path.join(folder, "dicom")
     imgf = os.path.join(folder, "nii")
 
@@ -912,7 +912,7 @@ def dicom2nii(
             if image[-3:] == "nii":
                 if debug:
                     print("     ---> gzipping: %s" % (image))
-                subprocess.call("gzip " + image, shell=True, stdout=null, stderr=null)
+                bgz.gzip_file(image)
                 image += ".gz"
             if os.path.basename(image)[0:2] == "co":
                 # os.rename(image, os.path.join(imgf, "%02d-co.nii.gz" % (c)))
@@ -1781,9 +1781,7 @@ def dicom2niix(
                 if image.endswith(".nii"):
                     if debug:
                         print("     ---> gzipping: %s" % (image))
-                    subprocess.call(
-                        "gzip " + image, shell=True, stdout=null, stderr=null
-                    )
+                    bgz.gzip_file(image)
                     image += ".gz"
 
                 # ---> compile the basename of the target file(s) for nii folder
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``engine.py``
+
+An asyncio engine for running external commands. A ProcessEngine runs an
+event loop in a background thread that starts the submitted commands, up to
+the given number at a time, streams their output through non-blocking pipes
+into their log files and waits for them to exit, all without a blocked
+thread or worker process per command. Each submitted command gets a future
+that resolves to a dictionary with its exit code, resource usage (see
+wait_process in general/core.py) and log, and cancelling it through the
+engine kills the command.
+
+A command supervised by a Watchdog (see general/watchdog.py) runs in its own
+process group, so that it can be terminated with all its children. Other
+commands stay in the process group of QuNex and receive the signals of the
+terminal with it. A cancelled command is sent SIGTERM, and SIGKILL if it does
+not exit within the grace period. A process that uses the shared engine
+exits on SIGTERM through the usual cleanup, which cancels its own commands,
+so nested QuNex calls are stopped with all the commands they started. The
+exit of a command is detected through a pidfd where the system supports it,
+and by polling otherwise.
+
+call runs a single command on a shared engine of the process and waits for
+it, which is what most of QuNex needs.
+"""
+
+import os
+import signal
+import asyncio
+import threading
+import contextlib
+import concurrent.futures
+
+import general.core as gc
+import general.watchdog as gwd
+
+# seconds between checks for exited commands without pidfd support
+POLL_INTERVAL = 0.05
+
+# size of the blocks read from the output pipes
+BLOCK_SIZE = 65536
+
+
+def _signal(p, sig, group):
+    """Sends the signal to the process, or its process group if it leads one."""
+    try:
+        if group:
+            os.killpg(p.pid, sig)
+        else:
+            os.kill(p.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class ProcessEngine(object):
+    """
+    ``ProcessEngine(workers=None)``
+
+    Runs external commands submitted to it, at most workers at a time or
+    all of them at once if workers is None. Use as a context manager or call
+    shutdown when done.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(workers) if workers else None
+        self._futures = set()
+        self._tasks = {}
+        self._thread = threading.Thread(
+            target=self.loop.run_forever, name="processengine", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        args,
+        log=None,
+        name=None,
+        shell=False,
+        header=None,
+        output=None,
+        watchdog=None,
+        started=None,
+        **popen,
+    ):
+        """
+        ``submit(args, log=None, name=None, shell=False, header=None, output=None, watchdog=None, started=None, **popen)``
+
+        Submits a command and returns a concurrent.futures.Future for its
+        result. The output of the command is appended to the log file,
+        after the header, a string or a function returning it when the
+        command starts, and passed block by block to the output function
+        if given. started is called with the process once it is running.
+        The remaining arguments are passed to subprocess.Popen. The result
+        is a dictionary with name, args, exit, usage, log and stalled, the
+        outcome of the watchdog.
+        """
+        future = concurrent.futures.Future()
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+        def finish(task):
+            del self._tasks[future]
+            if task.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            if future.set_running_or_notify_cancel():
+                task = self.loop.create_task(
+                    self._run(
+                        args, log, name, shell, header, output, watchdog, started, popen
+                    )
+                )
+                self._tasks[future] = task
+                task.add_done_callback(finish)
+
+        self.loop.call_soon_threadsafe(start)
+        return future
+
+    def cancel(self, future, wait=True):
+        """
+        Cancels a submitted command, killing it if it is running. Returns
+        once it is stopped if wait is True.
+        """
+        if future.cancel():
+            return
+
+        def cancel():
+            if future in self._tasks:
+                self._tasks[future].cancel()
+
+        self.loop.call_soon_threadsafe(cancel)
+        if wait:
+            concurrent.futures.wait([future])
+
+    async def _run(
+        self, args, log, name, shell, header, output, watchdog, started, popen
+    ):
+        async with self._semaphore or contextlib.nullcontext():
+            with open(log, "ab") if log else contextlib.nullcontext() as logfile:
+                if callable(header):
+                    header = header()
+                if header and logfile:
+                    logfile.write(header.encode())
+                    logfile.flush()
+                return await self._execute(
+                    args, logfile, name, shell, output, watchdog, started, popen
+                )
+
+    async def _execute(
+        self, args, logfile, name, shell, output, watchdog, started, popen
+    ):
+        rfd, wfd = os.pipe()
+        try:
+            p = gc.start_process(
+                args,
+                shell=shell,
+                stdout=wfd,
+                stderr=wfd,
+                start_new_session=watchdog is not None,
+                **popen,
+            )
+        except:
+            os.close(rfd)
+            raise
+        finally:
+            os.close(wfd)
+
+        os.set_blocking(rfd, False)
+        pipe = {"open": True}
+
+        def read():
+            while pipe["open"]:
+                try:
+                    block = os.read(rfd, BLOCK_SIZE)
+                except BlockingIOError:
+                    break
+                if not block:
+                    pipe["open"] = False
+                    self.loop.remove_reader(rfd)
+                    break
+                if logfile:
+                    logfile.write(block)
+                if output:
+                    output(block)
+            if logfile:
+                logfile.flush()
+
+        self.loop.add_reader(rfd, read)
+        if watchdog is not None:
+            watchdog.start(p)
+        if started:
+            started(p)
+
+        try:
+            exitcode, usage = await self._wait(p)
+        except asyncio.CancelledError:
+            await asyncio.shield(self._stop(p, watchdog is not None))
+            raise
+        finally:
+            # collect the output written before the exit
+            read()
+            if pipe["open"]:
+                self.loop.remove_reader(rfd)
+            os.close(rfd)
+            if watchdog is not None:
+                watchdog.stop()
+
+        return {
+            "name": name,
+            "args": args,
+            "exit": exitcode,
+            "usage": usage,
+            "log": logfile.name if logfile else None,
+            "stalled": watchdog.outcome if watchdog is not None else None,
+        }
+
+    async def _stop(self, p, group):
+        """Terminates the command and kills it if it does not exit in time."""
+        exited = self.loop.create_task(self._wait(p))
+        _signal(p, signal.SIGTERM, group)
+        try:
+            await asyncio.wait_for(asyncio.shield(exited), gwd.GRACE)
+        except asyncio.TimeoutError:
+            _signal(p, signal.SIGKILL, group)
+            await exited
+        if group:
+            # children that ignored SIGTERM
+            _signal(p, signal.SIGKILL, group)
+
+    async def _wait(self, p):
+        """Waits for the process to exit and reaps it with its usage."""
+        try:
+            pidfd = os.pidfd_open(p.pid)
+        except (AttributeError, OSError):
+            pidfd = None
+
+        if pidfd is None:
+            while True:
+                exitcode, usage = gc.wait_process(p, nohang=True)
+                if exitcode is not None:
+                    return exitcode, usage
+                await asyncio.sleep(POLL_INTERVAL)
+
+        exited = self.loop.create_future()
+        self.loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return gc.wait_process(p)
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        Stops the engine. If cancel is True, the running and waiting
+        commands are killed, otherwise they are waited for if wait is True.
+        """
+        futures = list(self._futures)
+        if cancel:
+            for future in futures:
+                self.cancel(future, wait=False)
+        if wait or cancel:
+            concurrent.futures.wait(futures)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.shutdown(cancel=exc_type is not None)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def _exit_on_sigterm(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def engine():
+    """
+    Returns the shared engine of the process. Unless the process handles
+    SIGTERM itself, SIGTERM then exits it like an exception, which cancels
+    the commands it is waiting for.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ProcessEngine()
+            if threading.current_thread() is threading.main_thread():
+                if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+        return _engine
+
+
+def _forget_engine():
+    # the event loop thread does not exist in a forked child
+    global _engine, _engine_lock
+    _engine = None
+    _engine_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_engine)
+
+
+def call(args, **kwargs):
+    """
+    ``call(args, **kwargs)``
+
+    Runs a command on the shared engine, with the arguments of
+    ProcessEngine.submit, and returns its result once it exits. If the wait
+    is interrupted, the command is killed before the exception is passed on.
+    """
+    shared = engine()
+    future = shared.submit(args, **kwargs)
+    try:
+        return future.result()
+    except BaseException:
+        shared.cancel(future)
+        raise
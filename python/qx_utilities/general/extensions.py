@@ -4,6 +4,9 @@
 import os
 import os.path
 import sys
+import json
+import hashlib
+import builtins
 import importlib
 from inspect import signature, Parameter
 
@@ -18,38 +21,274 @@ lalist = []
 malist = []
 salist = []
 
+# -- extension discovery cache
+#
+#   The registrations of the extension modules in each extensions path are
+#   stored in a cache file keyed by the path and the size and mtime of its
+#   qx_modules file and all module source files. When the cache is valid, no
+#   extension module is imported at start-up, functions are represented by
+#   LazyFunction objects that import their module when first called.
+
+EXTENSIONS_CACHE_VERSION = 1
+EXTENSIONS_CACHE_NAME = ".qx_modules.cache.json"
+
+# module attributes that are compiled across extensions by compile_list and compile_dict
+COMPILED = [
+    "commands", "functions", "arglist", "flaglist", "calist", "lalist", "malist", "salist",
+    "deprecated_commands", "deprecated_parameters", "deprecated_values", "towarn_parameters",
+    "to_impute", "extra_parameters", "logskip_commands",
+]
+
+# decorator registries
+REGISTRIES = ["commands", "arglist", "calist", "lalist", "malist", "salist"]
+
+cached = {}         # module name -> compiled module attributes read from the cache
+registered = set()  # modules whose decorator registrations were read from the cache
+
+
+class LazyFunction(object):
+    # A stand-in for a function defined in an extension module. The module is
+    # imported and the function looked up only when it is first used. Process
+    # functions are wrapped the same way the qx_process decorator wraps them.
+
+    def __init__(self, module, name, process=False):
+        self.module = module
+        self.name = name
+        self.process = process
+        self.function = None
+        self.__name__ = name.split(".")[-1]
+        self.__module__ = module
+
+    def load(self):
+        if self.function is None:
+            function = import_module(self.module)
+            for e in self.name.split("."):
+                function = getattr(function, e)
+            if self.process:
+                function = _process_wrapper(function)
+            self.function = function
+        return self.function
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["function"] = None
+        return state
+
+    __doc__ = property(lambda self: self.load().__doc__)
+
+
+def import_module(module_name):
+    """Imports an extension module and adds it to the loaded modules."""
+    if module_name not in modules:
+        modules[module_name] = importlib.import_module(module_name)
+    return modules[module_name]
+
+
+def extension_paths():
+    """Returns the list of extension paths specified in QXEXTENSIONSPY."""
+    return [e.strip() for e in os.environ.get("QXEXTENSIONSPY", "").split(":") if e.strip()]
+
+
+def read_module_names(extensions_path):
+    """Returns the module names listed in the qx_modules file of the extensions path."""
+    with open(os.path.join(extensions_path, "qx_modules"), "r") as f:
+        return [e.strip() for e in f if e.strip() and not e.strip().startswith("#")]
+
+
+def extension_files(extensions_path):
+    """Returns the qx_modules file and the source files of all modules in the extensions path."""
+    files = [os.path.join(extensions_path, "qx_modules")]
+    if not os.path.exists(files[0]):
+        return files
+    for module_name in read_module_names(extensions_path):
+        module_path = os.path.join(extensions_path, module_name)
+        if os.path.isdir(module_path):
+            for root, folders, filenames in os.walk(module_path):
+                folders.sort()
+                files += sorted(os.path.join(root, e) for e in filenames if e.endswith(".py"))
+        else:
+            files.append(module_path + ".py")
+    return files
+
+
+def _cache_key(extensions_path):
+    key = [EXTENSIONS_CACHE_VERSION, os.path.abspath(extensions_path)]
+    for filename in extension_files(extensions_path):
+        try:
+            s = os.stat(filename)
+            key.append([filename, s.st_size, s.st_mtime_ns])
+        except OSError:
+            key.append([filename, None, None])
+    return key
+
+
+def _cache_files(extensions_path):
+    """Returns the candidate locations of the cache file in order of preference."""
+    pathid = hashlib.sha1(os.path.abspath(extensions_path).encode()).hexdigest()
+    return [
+        os.path.join(extensions_path, EXTENSIONS_CACHE_NAME),
+        os.path.join(os.path.expanduser("~"), ".qunex", "extensions", pathid + ".json"),
+    ]
+
+
+def _encode(value):
+    """Encodes a registration value to JSON, raises TypeError if that is not possible."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [_encode(e) for e in value]
+    if isinstance(value, tuple):
+        return {"__qx_tuple__": [_encode(e) for e in value]}
+    if isinstance(value, dict):
+        if not all(isinstance(k, str) for k in value):
+            raise TypeError("Only string keys can be cached")
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, LazyFunction):
+        return {"__qx_function__": [value.module, value.name, value.process]}
+    if callable(value) and hasattr(value, "__module__") and hasattr(value, "__qualname__"):
+        if getattr(value, "__qx_process__", None):
+            value, process = value.__wrapped__, True
+        else:
+            process = False
+        if "<" in value.__qualname__:
+            raise TypeError("Local objects can not be cached")
+        return {"__qx_function__": [value.__module__, value.__qualname__, process]}
+    raise TypeError("Values of type %s can not be cached" % (type(value).__name__))
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(e) for e in value]
+    if isinstance(value, dict):
+        if "__qx_tuple__" in value:
+            return tuple(_decode(e) for e in value["__qx_tuple__"])
+        if "__qx_function__" in value:
+            module, name, process = value["__qx_function__"]
+            if module == "builtins":
+                return getattr(builtins, name)
+            return LazyFunction(module, name, process)
+        return {k: _decode(v) for k, v in value.items()}
+    return value
+
+
+def _scan_module(module_name):
+    """
+    Imports the extension module and returns its compiled attributes and
+    decorator registrations in a form that can be cached, or None if they
+    can not be cached.
+    """
+
+    before = {"commands": set(commands)}
+    before.update({e: len(globals()[e]) for e in REGISTRIES if e != "commands"})
+
+    module = import_module(module_name)
+
+    info = {"attributes": {}, "registrations": {}}
+    try:
+        for name in COMPILED:
+            value = getattr(module, name, None)
+            if type(value) in (list, dict):
+                info["attributes"][name] = _encode(value)
+        info["registrations"]["commands"] = _encode({k: v for k, v in commands.items() if k not in before["commands"]})
+        for name in REGISTRIES[1:]:
+            info["registrations"][name] = _encode(globals()[name][before[name]:])
+    except TypeError:
+        return None
+    return info
+
+
+def _load_cache(extensions_path, key):
+    for filename in _cache_files(extensions_path):
+        try:
+            with open(filename, "r") as f:
+                data = json.load(f)
+            if data.get("key") == key:
+                return data["modules"]
+        except (OSError, ValueError, AttributeError):
+            pass
+    return None
+
+
+def _save_cache(extensions_path, key, data):
+    data = json.dumps({"key": key, "modules": data})
+    for filename in _cache_files(extensions_path):
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmpfile, "w") as f:
+                f.write(data)
+            os.replace(tmpfile, filename)
+            return filename
+        except OSError:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+    return None
+
+
 # -- process extensions
 def load_extensions():
-    if "QXEXTENSIONSPY" in os.environ:
-        #print('=> processing extensions')
-        extensions_paths = [e.strip() for e in os.environ['QXEXTENSIONSPY'].split(':') if e]
-        
-        # -- loop through paths and check that we have qx_modules file
-        for extensions_path in extensions_paths:
-            if os.path.exists(os.path.join(extensions_path, 'qx_modules')):
-
-                # -- append the module python folder to the path
-                sys.path.append(extensions_path)
-
-                # -- read the module names
-                with open(os.path.join(extensions_path, 'qx_modules'), 'r') as f:
-                    for line in f:
-                        if (len(line.strip()) > 0) and (not line.strip().startswith('#')):
-                            module_name = line.strip()
-                            if os.path.isdir(os.path.join(extensions_path, module_name)):
-                                sys.path.append(os.path.join(extensions_path, module_name))
-                            try:
-                                modules[module_name] = importlib.import_module(module_name)
-                                module_names.append(module_name)
-                            except:
-                                print(f"WARNING: There was an error when trying to import extension module: {extensions_path}/{module_name}!")
-
-        # -- load the modules
-        # if module_names:
-        #     for module_name in module_names:
-        #         print(f'   ... importing module {module_name}')
-        #         if os.path.isdir(os.path.join(extensions_path, module_name))
-        #         modules[module_name] = importlib.import_module(module_name)
+    """
+    Discovers the extension modules listed in the qx_modules files of the
+    QXEXTENSIONSPY paths. Their registrations are read from the cache where
+    possible, otherwise the modules are imported and the cache is updated.
+    Modules whose registrations can not be cached are always imported.
+    """
+
+    for extensions_path in extension_paths():
+        if not os.path.exists(os.path.join(extensions_path, "qx_modules")):
+            continue
+
+        # -- append the module python folder to the path
+        sys.path.append(extensions_path)
+        names = read_module_names(extensions_path)
+        for module_name in names:
+            if os.path.isdir(os.path.join(extensions_path, module_name)):
+                sys.path.append(os.path.join(extensions_path, module_name))
+
+        key = _cache_key(extensions_path)
+        data = _load_cache(extensions_path, key)
+
+        # -- import the modules and record their registrations
+        if data is None:
+            data, complete = {}, True
+            for module_name in names:
+                try:
+                    data[module_name] = _scan_module(module_name)
+                except:
+                    complete = False
+                    print(f"WARNING: There was an error when trying to import extension module: {extensions_path}/{module_name}!")
+            if complete:
+                _save_cache(extensions_path, key, data)
+
+        # -- register the modules
+        for module_name in names:
+            if module_name not in data or module_name in module_names:
+                continue
+            module_names.append(module_name)
+            info = data[module_name]
+            if info is None:
+                try:
+                    import_module(module_name)
+                except:
+                    print(f"WARNING: There was an error when trying to import extension module: {extensions_path}/{module_name}!")
+                    module_names.remove(module_name)
+                continue
+            cached[module_name] = {k: _decode(v) for k, v in info["attributes"].items()}
+            if module_name not in modules:
+                registered.add(module_name)
+                commands.update(_decode(info["registrations"]["commands"]))
+                for name in REGISTRIES[1:]:
+                    globals()[name] += _decode(info["registrations"][name])
+
+
+def _module_attribute(module_name, name):
+    """Returns the attribute of an extension module, from the cache if possible."""
+    if module_name in cached and name in COMPILED:
+        return cached[module_name].get(name)
+    return getattr(import_module(module_name), name, None)
 
 
 def compile_list(list_name):
@@ -61,9 +300,9 @@ def compile_list(list_name):
     '''
     extensions_list = []
     for module_name in module_names:
-        if hasattr(modules[module_name], list_name):
-            if type(getattr(modules[module_name], list_name)) is list:
-                extensions_list += getattr(modules[module_name], list_name)
+        value = _module_attribute(module_name, list_name)
+        if type(value) is list:
+            extensions_list += value
 
     return extensions_list
 
@@ -80,11 +319,10 @@ def compile_dict(dict_name):
     # print(f'   -> modules {module_names}')
     for module_name in module_names:
         # print(f'... module {module_name}')
-        if hasattr(modules[module_name], dict_name):
-            # print(f'... dict {dict_name}')
-            if type(getattr(modules[module_name], dict_name)) is dict:
-                # print(f"... adding {getattr(modules[module_name], dict_name)}")
-                extensions_dict.update(getattr(modules[module_name], dict_name))
+        value = _module_attribute(module_name, dict_name)
+        if type(value) is dict:
+            # print(f"... adding {value}")
+            extensions_dict.update(value)
 
     return extensions_dict
 
@@ -94,12 +332,26 @@ def qx(qx_cmd=None):
         nonlocal qx_cmd
         if qx_cmd is None:
             qx_cmd = f.__name__
-        if qx_cmd not in commands:
+        if qx_cmd not in commands and f.__module__ not in registered:
             commands[qx_cmd] = {'com': f, 'args': list(signature(f).parameters.keys())}
         return f
     return inner_decorator
 
 
+def _process_wrapper(f):
+    """Wraps an extension processing function to be called with QuNex options."""
+    f_signature = signature(f)
+
+    def f_decorated(sinfo, options, overwrite, thread):
+        kwargs = {k: options[k] for k in f_signature.parameters if not k in ['sinfo', 'options', 'overwrite', 'thread']}
+        return f(sinfo, options, overwrite=overwrite, thread=thread, **kwargs)
+
+    f_decorated.__doc__ = f.__doc__
+    f_decorated.__wrapped__ = f
+    f_decorated.__qx_process__ = True
+    return f_decorated
+
+
 def qx_process(command_type="parallel", short_name=None, long_name=None, description=None):
     
     def inner_decorator(f):
@@ -120,11 +372,11 @@ def qx_process(command_type="parallel", short_name=None, long_name=None, descrip
             print('A QuNex extension function must have a keyword argument "thread". Not registering {f.__name__}')
             return f
         
-        def f_decorated(sinfo, options, overwrite, thread):
-            kwargs = {k: options[k] for k in f_signature.parameters if not k in ['sinfo', 'options', 'overwrite', 'thread']}
-            return f(sinfo, options, overwrite=overwrite, thread=thread, **kwargs)
-        
-        f_decorated.__doc__ = f.__doc__
+        # registrations of this module were already read from the cache
+        if f.__module__ in registered:
+            return f
+
+        f_decorated = _process_wrapper(f)
         
         # --- add options to arglist ---
         def _check_default(x):
@@ -9,85 +9,329 @@
 ``filelock.py``
 
 A python filelocking library.
+
+Locks are taken on a ``<filename>.lock`` file with fcntl.flock, so waiting
+processes sleep in the kernel instead of polling and a lock is released
+automatically when its owner dies. The lock file holds the owner metadata
+(identifier, host, pid and time of locking). Where the file system does not
+support flock, the original scheme of exclusively created lock files is used
+as a fallback.
 """
 
 from __future__ import print_function
 
 import os
+import json
+import errno
 import shutil
+import socket
 import time
 import atexit
 import random
+import threading
 
-# create a lock file for a file
-def lock(filename, delay=0.5, identifier="Python process"):
-    lock_file = filename + ".lock"
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LockTimeout(Exception):
+    """Raised when a lock could not be acquired within the timeout."""
+
+    def __init__(self, filename, timeout, owner=None):
+        self.filename = filename
+        self.timeout = timeout
+        self.owner = owner
+        msg = "Could not lock %s within %.1f s" % (filename, timeout)
+        if owner:
+            msg += ", held by %s" % (describe_owner(owner))
+        super(LockTimeout, self).__init__(msg)
+
+
+# errors signalling that the file system does not support flock
+NOLOCK_ERRORS = (errno.ENOLCK, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL)
 
-    # if the lock_file is older than 30 minutes, remove it
-    if os.path.isfile(lock_file):
-        if time.time() - os.stat(lock_file).st_mtime > 1800:
+# fallback lock files of owners on other hosts are considered stale after
+STALE_LOCK = 1800
+
+
+def _owner_data(identifier):
+    return json.dumps(
+        {
+            "identifier": identifier,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "time": time.time(),
+        }
+    )
+
+
+# read the owner metadata of a lock
+def owner(filename):
+    return _read_owner(filename + ".lock")
+
+
+def _read_owner(lock_file):
+    try:
+        with open(lock_file, "r") as f:
+            content = f.read()
+    except (OSError, IOError):
+        return None
+    try:
+        return json.loads(content)
+    except ValueError:
+        return {"identifier": content.strip()} if content.strip() else None
+
+
+def describe_owner(info):
+    if not info:
+        return "unknown owner"
+    description = info.get("identifier", "unknown owner")
+    if "pid" in info:
+        description += " (pid %s on %s)" % (info["pid"], info.get("host", "?"))
+    return description
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, TypeError):
+        pass
+    return True
+
+
+def _flock(lock_file, identifier, deadline, delay):
+    """
+    Locks the lock file with flock and returns its file descriptor or None if
+    the deadline has passed. Raises OSError if flock is not supported.
+    """
+    while True:
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if deadline is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                wait = delay / 10
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.time() >= deadline:
+                            os.close(fd)
+                            return None
+                        time.sleep(min(wait, max(deadline - time.time(), 0)))
+                        wait = min(wait * 2, delay)
+
+            # the lock file might have been removed by the previous owner
+            # while we were waiting, in that case lock the new one
             try:
-                os.remove(lock_file)
-            except:
+                current = os.stat(lock_file)
+            except FileNotFoundError:
+                current = None
+            locked = os.fstat(fd)
+            if current is None or (current.st_dev, current.st_ino) != (
+                locked.st_dev,
+                locked.st_ino,
+            ):
+                os.close(fd)
+                continue
+
+            os.ftruncate(fd, 0)
+            os.write(fd, bytes(_owner_data(identifier), encoding="utf8"))
+            return fd
+        except BaseException:
+            try:
+                os.close(fd)
+            except OSError:
                 pass
+            raise
+
 
-    # wait while file exists
+def _create_lock(lock_file, identifier, deadline, delay):
+    """
+    Fallback locking by exclusively creating the lock file. Returns True once
+    the lock is held or False if the deadline has passed.
+    """
     while True:
-        # create lock file
         try:
-            f = os.open(lock_file, os.O_CREAT|os.O_EXCL|os.O_WRONLY)
-            os.write(f, bytes(identifier, encoding='utf8'))
+            f = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            os.write(f, bytes(_owner_data(identifier), encoding="utf8"))
             os.close(f)
-
-            # store lock file
-            locks.append(lock_file)
-            break
-        except Exception as e:
-            print(e)
+            return True
+        except FileExistsError:
             pass
 
+        # remove locks left behind by dead processes
+        info = _read_owner(lock_file)
+        try:
+            age = time.time() - os.stat(lock_file).st_mtime
+        except OSError:
+            continue
+        if info and info.get("host") == socket.gethostname():
+            stale = not _pid_alive(info.get("pid"))
+        else:
+            stale = age > STALE_LOCK
+        if stale:
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+            continue
+
+        if deadline is not None and time.time() >= deadline:
+            return False
+
         # try again soon
-        time.sleep(delay + random.random() * delay)
+        sleep = delay + random.random() * delay
+        if deadline is not None:
+            sleep = min(sleep, max(deadline - time.time(), 0))
+        time.sleep(sleep)
+
+
+# create a lock file for a file
+def lock(filename, delay=0.5, identifier="Python process", timeout=None):
+    """
+    Locks the file for the calling thread and returns the time waited for the
+    lock in seconds. Waits indefinitely unless a timeout in seconds is given,
+    in which case LockTimeout is raised when it expires. A thread can lock a
+    file it already holds, it is released after the matching number of
+    unlock calls.
+    """
+    lock_file = filename + ".lock"
+    key = (os.path.abspath(lock_file), threading.get_ident())
+
+    with locks_guard:
+        if key in locks:
+            locks[key]["count"] += 1
+            return 0.0
+
+    start = time.time()
+    deadline = None if timeout is None else start + timeout
+    folder = os.path.dirname(key[0])
+    use_flock = fcntl is not None and folder not in nolock_folders
+    fd = None
+
+    if use_flock:
+        try:
+            fd = _flock(lock_file, identifier, deadline, delay)
+            held = fd is not None
+        except OSError as e:
+            if e.errno not in NOLOCK_ERRORS:
+                raise
+            nolock_folders.add(folder)
+            use_flock = False
+
+    if not use_flock:
+        held = _create_lock(lock_file, identifier, deadline, delay)
+
+    waited = time.time() - start
+    with locks_guard:
+        stats["locks"] += 1
+        stats["wait"] += waited
+        stats["max_wait"] = max(stats["max_wait"], waited)
+        if not held:
+            stats["timeouts"] += 1
+            raise LockTimeout(filename, timeout, owner(filename))
+        locks[key] = {"file": lock_file, "fd": fd, "count": 1}
+
+    return waited
 
 
 # remove a lock file for a file
 def unlock(filename):
+    """
+    Releases a lock held by the calling thread. Locks held by other threads
+    or processes are left untouched.
+    """
     lock_file = filename + ".lock"
+    key = (os.path.abspath(lock_file), threading.get_ident())
+
+    with locks_guard:
+        held = locks.get(key)
+        if held is None:
+            return
+        held["count"] -= 1
+        if held["count"] > 0:
+            return
+        del locks[key]
+
+    _release(held)
 
-    if os.path.isfile(lock_file):
+
+def _release(held):
+    # the lock file is removed while still locked, so that waiting processes
+    # notice it has been replaced
+    try:
+        os.unlink(held["file"])
+    except OSError:
+        pass
+    if held["fd"] is not None:
         try:
-            os.unlink(lock_file)
-        except:
+            os.close(held["fd"])
+        except OSError:
             pass
 
-    # remove from storage
-    if lock_file in locks:
-        locks.remove(lock_file)
 
+# return lock statistics of the process
+def lock_stats():
+    """
+    Returns the number of locks acquired, the total and the longest time
+    spent waiting for them in seconds and the number of timeouts.
+    """
+    with locks_guard:
+        return dict(stats)
 
-# lock a file, write into it, then unlock it
-def safe_write(string, filename, delay=1):
-    # lock
-    lock(filename, delay=delay)
 
-    # open file
-    f = open(filename, "a")
+# return lock statistics accumulated since an earlier snapshot
+def lock_stats_since(before):
+    """
+    Returns the lock statistics accumulated since before, an earlier result
+    of lock_stats. The longest wait is only reported if it happened since.
+    """
+    after = lock_stats()
+    since = {k: after[k] - before[k] for k in ["locks", "wait", "timeouts"]}
+    since["max_wait"] = after["max_wait"] if after["max_wait"] > before["max_wait"] else 0.0
+    return since
 
-    # write
-    f.write(string)
 
-    # close file
-    f.close()
+# lock a file, write into it, then unlock it
+def safe_write(string, filename, delay=1, timeout=None):
+    # lock
+    lock(filename, delay=delay, timeout=timeout)
 
-    # unlock
-    unlock(filename)
+    try:
+        # write
+        with open(filename, "a") as f:
+            f.write(string)
+    finally:
+        # unlock
+        unlock(filename)
+
+
+# forget the locks inherited by a forked child, they belong to the parent
+def _forget_locks():
+    global locks_guard
+    locks_guard = threading.Lock()
+    for lock in locks.values():
+        if lock["fd"] is not None:
+            try:
+                os.close(lock["fd"])
+            except OSError:
+                pass
+    locks.clear()
 
 
 # delete all lock files on exit
 def cleanup():
-    for lock_file in locks:
-        if os.path.isfile(lock_file):
-            os.unlink(lock_file)
+    with locks_guard:
+        held = list(locks.values())
+        locks.clear()
+    for lock in held:
+        _release(lock)
 
     for status_file in statuses:
         status = open(status_file, 'r').read().strip()
@@ -114,7 +358,8 @@ def open_status(filename, status=""):
 # write to the status file
 def write_status(filename, status="", mode="w"):
     try:
-        open(filename, mode).write(status)
+        with open(filename, mode) as f:
+            f.write(status)
         return True
     except:
         return False
@@ -122,19 +367,50 @@ def write_status(filename, status="", mode="w"):
 
 # wait for status to be done
 def wait_status(filename, status, delay=0.5):
-    
-    while True:
-        try:
-            # check content
-            content = open(filename, 'r').read()
-            if status in content:
-                return status
+    """
+    Waits until the status file contains status. Changes are watched with
+    inotify where available, the file is also re-read at least every delay
+    seconds as inotify does not see writes from other hosts. Without inotify
+    the file is polled with an exponential backoff up to delay seconds.
+    """
+
+    watch = None
+    try:
+        from general import inotify
 
-            # try again soon
-            time.sleep(delay + random.random() * delay)
+        watch = inotify.Inotify()
+        watch.add_watch(os.path.dirname(os.path.abspath(filename)))
+    except (ImportError, OSError):
+        if watch is not None:
+            watch.close()
+        watch = None
 
-        except (OSError, IOError) as e:
-            return e.strerror
+    name = os.path.basename(filename)
+    wait = min(0.01, delay)
+
+    try:
+        while True:
+            try:
+                # check content
+                with open(filename, 'r') as f:
+                    if status in f.read():
+                        return status
+            except (OSError, IOError) as e:
+                return e.strerror
+
+            # wait for a change or try again soon
+            if watch is not None:
+                deadline = time.time() + delay
+                while time.time() < deadline:
+                    events = watch.read(max(deadline - time.time(), 0))
+                    if any(e[2] == name for e in events):
+                        break
+            else:
+                time.sleep(wait + random.random() * wait)
+                wait = min(wait * 2, delay)
+    finally:
+        if watch is not None:
+            watch.close()
 
 
 # remove status file
@@ -182,8 +458,13 @@ def remove(filename):
 
 
 # lock storage
-locks = []
+locks = {}
+locks_guard = threading.Lock()
+nolock_folders = set()
 statuses = []
+stats = {"locks": 0, "wait": 0.0, "max_wait": 0.0, "timeouts": 0}
 
 # clenup on exit
 atexit.register(cleanup)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_locks)
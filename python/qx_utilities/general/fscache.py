@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``fscache.py``
+
+File system metadata caching. Folders are listed with a single os.scandir
+call and existence checks and glob patterns are answered from the listings
+kept in memory, which saves a round trip to the file server for every
+checked path on network and parallel file systems.
+
+The module level cache is shared by the path resolution functions for the
+duration of a run. QuNex invalidates it explicitly whenever it writes to the
+file system itself and after every external command it runs. The results of
+path resolution functions memoized with memoize are dropped together with
+the cache.
+"""
+
+import os
+import copy
+import fnmatch
+import functools
+
+from glob import has_magic
+
+
+class DirectoryListing(object):
+    """
+    Answers file existence and glob queries from a single os.scandir listing
+    per folder instead of a stat call per file.
+    """
+
+    def __init__(self):
+        self.listings = {}
+        self.scans = 0
+
+    def _listing(self, folder):
+        folder = os.path.abspath(folder)
+        if folder not in self.listings:
+            self.scans += 1
+            try:
+                with os.scandir(folder) as it:
+                    self.listings[folder] = {e.name: e for e in it}
+            except (FileNotFoundError, NotADirectoryError):
+                self.listings[folder] = {}
+            except OSError:
+                self.listings[folder] = None
+        return self.listings[folder]
+
+    def _entry(self, path):
+        """Returns the directory entry for the path, None if missing or False if unknown."""
+        folder, name = os.path.split(os.path.abspath(path))
+        if name in ("", ".", ".."):
+            return False
+        listing = self._listing(folder)
+        if listing is None:
+            return False
+        return listing.get(name)
+
+    def exists(self, path):
+        entry = self._entry(path)
+        if entry is None:
+            return False
+        if entry is False or entry.is_symlink():
+            # unknown or a symlink that might be broken
+            return os.path.exists(path)
+        return True
+
+    def lexists(self, path):
+        entry = self._entry(path)
+        if entry is False:
+            return os.path.lexists(path)
+        return entry is not None
+
+    def isdir(self, path):
+        entry = self._entry(path)
+        if entry is False:
+            return os.path.isdir(path)
+        return entry is not None and entry.is_dir()
+
+    def glob(self, pattern, dironly=False):
+        """
+        Returns the list of paths matching the pattern in the same order as
+        glob.glob (non-recursive, hidden files are matched only by patterns
+        starting with a dot).
+        """
+        dirname, basename = os.path.split(pattern)
+
+        if not has_magic(pattern):
+            if basename:
+                return [pattern] if self.lexists(pattern) else []
+            return [pattern] if self.isdir(dirname) else []
+
+        if not dirname:
+            folders = [""]
+        elif dirname != pattern and has_magic(dirname):
+            folders = self.glob(dirname, dironly=True)
+        else:
+            folders = [dirname]
+
+        results = []
+        for folder in folders:
+            if has_magic(basename):
+                listing = self._listing(folder or os.curdir) or {}
+                names = listing.keys()
+                if basename[0] != ".":
+                    names = [e for e in names if e[0] != "."]
+                for name in fnmatch.filter(names, basename):
+                    if not dironly or listing[name].is_dir():
+                        results.append(os.path.join(folder, name))
+            elif basename:
+                if self.lexists(os.path.join(folder, basename)):
+                    results.append(os.path.join(folder, basename))
+            elif self.isdir(folder):
+                results.append(os.path.join(folder, basename))
+        return results
+
+    def invalidate(self, path=None):
+        """
+        Drops the listings of the path, all its parent folders and all folders
+        below it, or all listings if no path is given.
+        """
+        if path is None:
+            self.listings.clear()
+            return
+        path = os.path.abspath(path)
+        for folder in [e for e in self.listings if e.startswith(path + os.sep)]:
+            del self.listings[folder]
+        while True:
+            self.listings.pop(path, None)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+
+# the shared per-run cache and memoized results
+cache = DirectoryListing()
+memos = {}
+
+
+def exists(path):
+    return cache.exists(path)
+
+
+def lexists(path):
+    return cache.lexists(path)
+
+
+def isdir(path):
+    return cache.isdir(path)
+
+
+def glob(pattern):
+    return cache.glob(pattern)
+
+
+def invalidate(path=None):
+    """
+    Invalidates the cached metadata of the path, or of all paths if no path is
+    given, together with all memoized path resolutions.
+    """
+    memos.clear()
+    cache.invalidate(path)
+
+
+def makedirs(path):
+    """Creates the folder and its missing parents and invalidates their metadata."""
+    try:
+        os.makedirs(path)
+    finally:
+        invalidate(path)
+
+
+def memoize(key):
+    """
+    Returns a decorator that memoizes the results of a path resolution
+    function on key(*args, **kwargs). A deep copy of the stored result is
+    returned so that callers can freely modify it. Memoized results are
+    dropped whenever the cache is invalidated.
+    """
+
+    def decorator(function):
+        name = function.__module__ + "." + function.__qualname__
+
+        @functools.wraps(function)
+        def memoized(*args, **kwargs):
+            try:
+                k = (name, key(*args, **kwargs))
+                hash(k)
+            except (KeyError, TypeError):
+                return function(*args, **kwargs)
+            if k not in memos:
+                memos[k] = function(*args, **kwargs)
+            return copy.deepcopy(memos[k])
+
+        return memoized
+
+    return decorator
@@ -14,9 +14,16 @@ Some basic functions to be used for work with nifti and 4dfp images.
 import struct
 import re
 import gzip
+import os
 import os.path
+import glob
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 
 import general.exceptions as ge
+import general.blockgzip as bgz
 
 niftiDataTypes = {1: 'b', 2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 32: 'c8', 64: 'f8', 128: 'u1,u1,u1', 256: 'i1', 512: 'u2', 768: 'u4', 1025: 'i8', 1280: 'u8', 1536: 'f16', 2304: 'u1,u1,u1,u1'}
 niftiBytesPerVoxel = {1: 1, 2: 1, 4: 2, 8: 4, 16: 4, 32: 8, 64: 8, 128: 3, 256: 1, 512: 2, 768: 4, 1025: 8, 1280: 8, 1536: 16, 2304: 4}
@@ -37,8 +44,8 @@ def sign(x):
 
 
 def readTextFileToLines(filename):
-    file = open(filename, 'r')
-    s = file.read()
+    with open(filename, 'r') as file:
+        s = file.read()
     s = s.replace('\r', '\n')
     s = s.replace('\n\n', '\n')
     s = s.split('\n')
@@ -260,8 +267,8 @@ class ifhhdr:
 
     def readHeader(self, filename):
         filename = filename.replace('.img', '.ifh')
-        file = open(filename, 'r')
-        s = file.read()
+        with open(filename, 'r') as file:
+            s = file.read()
         self.unpackHdr(s)
         self.hdr = s
 
@@ -726,85 +733,488 @@ class niftihdr:
                 print("WARNING: %s not a valid key for NIfTI header" % (k))
 
 
-def slice_image(sourcefile, targetfile, frames=1):
+# ---> image conversion engine
+
+def imageRoot(filename):
+    """Returns the filename stripped of the NIfTI or 4dfp extensions."""
+    for ext in ['.gz', '.nii', '.img', '.ifh', '.4dfp']:
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+    return filename
+
+
+def openImage(filename, mode='rb'):
     """
-    ``slice_image sourcefile=<source image> targetfile=<target image> [frames=1]``
+    Opens an image file in binary mode. Gzipped files are written using
+    parallel block compression and read with random access where possible.
+    """
+    if filename.endswith('.gz'):
+        return bgz.open_gzip(filename, mode)
+    return open(filename, mode)
 
-    Takes the source volume image file, removes all but the first N frames, and
-    saves the resulting image to target volume image file.
+
+def copyRange(sf, tf, offset, count):
+    """
+    Copies count bytes starting at offset in the source file object to the
+    current position of the target file object. The copy is done in the kernel
+    using copy_file_range or sendfile where the platform supports it and falls
+    back to a buffered copy otherwise. Both files have to be uncompressed.
+    """
+
+    tf.flush()
+    sfd, tfd = sf.fileno(), tf.fileno()
+    copied = 0
+
+    for method in ['copy_file_range', 'sendfile']:
+        if copied == count or not hasattr(os, method):
+            continue
+        try:
+            while copied < count:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(sfd, tfd, count - copied, offset + copied)
+                else:
+                    n = os.sendfile(tfd, sfd, offset + copied, count - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+
+    # ---> buffered fallback for what the kernel did not copy
+
+    if copied < count:
+        os.lseek(tfd, 0, os.SEEK_END)
+        sf.seek(offset + copied)
+        while copied < count:
+            buf = sf.read(min(1 << 24, count - copied))
+            if not buf:
+                break
+            os.write(tfd, buf)
+            copied += len(buf)
+
+    if copied < count:
+        raise ge.CommandFailed("copyRange", "Incomplete copy", "Only %d of %d bytes could be copied!" % (copied, count), "Please check your data!")
+
+    return copied
+
+
+def readImageHeader(filename):
+    """
+    Reads the header of a NIfTI or 4dfp image and returns a tuple with the
+    image format, the NIfTI header (converted from IFH for 4dfp images), the
+    IFH header (None for NIfTI images), the data file and the data offset.
+    """
+
+    sform = getImgFormat(filename)
+
+    if sform == '.4dfp.img':
+        ifh = ifhhdr(filename)
+        nihdr = ifh.toNIfTI()
+        return sform, nihdr, ifh, filename.replace('.4dfp.ifh', '.4dfp.img'), 0
+
+    if sform in ['.nii', '.nii.gz']:
+        nihdr = niftihdr()
+        with openImage(filename) as sf:
+            nihdr.unpackHdr(sf)
+        return sform, nihdr, None, filename, int(nihdr.vox_offset)
+
+    raise ge.CommandFailed("readImageHeader", "Unsupported image format", "File %s is neither a NIfTI nor a 4dfp volume image!" % (filename), "Please check your data!")
+
+
+def convert_image(inf, outf, tform=None, nihdr=None):
+    """
+    Converts a volume image between NIfTI (.nii, .nii.gz) and 4dfp formats, or
+    rewrites a NIfTI image with a modified header.
 
     INPUTS
     ======
 
-    --sourcefile  Source volume file (.4dfp, .nii, or .nii.gz).
-    --targetfile  Target volume file of the same format.
-    --frames      Optional number of initial frames to retain. [1]
+    --inf       input image filename.
+    --outf      output image filename. For 4dfp output, the .4dfp.ifh and
+                .4dfp.img files are created next to the root of outf.
+    --tform     optional target format ('.nii', '.nii.gz' or '.4dfp.img'). If
+                not provided, it is deduced from outf.
+    --nihdr     optional NIfTI header to use for NIfTI output instead of the
+                header of the input image.
+
+    The data is never loaded as a whole. Uncompressed inputs and outputs are
+    memory mapped and processed one frame at a time, compressed files are
+    streamed frame by frame. Data is byteswapped or converted only when the
+    source and target data types differ, and the y axis is flipped when
+    converting between NIfTI and 4dfp orientation. When the data layout of
+    source and target is identical, the payload is copied by the kernel
+    without passing through Python.
+
+    Returns the name of the (main) file written.
+    """
 
-    EXAMPLE USE
-    ===========
+    sform, shdr, ifh, source, offset = readImageHeader(inf)
 
-    ::
+    if tform is None:
+        tform = getImgFormat(outf)
+    if tform not in ['.nii', '.nii.gz', '.4dfp.img']:
+        raise ge.CommandFailed("convert_image", "Unsupported image format", "Can not convert %s to %s!" % (inf, outf), "Please check your command!")
 
-        qunex slice_image sourcefile=bold1.nii.gz targetfile=bold1_f10.nii.gz frames=10
-    """
+    sdtype = np.dtype(shdr.e + shdr.dType)
+    frames = max(shdr.frames, 1)
+    shape = (frames, shdr.sizez, shdr.sizey, shdr.sizex)
+
+    # ---> prepare target header
 
-    frames = int(frames)
-    if 'nii' in getImgFormat(sourcefile):
-        sliceNIfTI(sourcefile, targetfile, frames)
+    if tform == '.4dfp.img':
+        if ifh is None:
+            ifh = shdr.toIFH()
+        header = None
+        tdtype = np.dtype(shdr.e + 'f4')
+        flip = sform != '.4dfp.img'
+        target = imageRoot(outf) + '.4dfp.img'
     else:
-        slice4dfp(sourcefile, targetfile, frames)
+        thdr = shdr if nihdr is None else nihdr
+        if sform == '.4dfp.img':
+            thdr.data_type, thdr.bitpix, thdr.dType = 16, 32, 'f4'
+        header = thdr.packHdr()
+        tdtype = np.dtype(thdr.e + thdr.dType)
+        flip = sform == '.4dfp.img'
+        target = outf
+
+    nbytes = int(np.prod(shape)) * tdtype.itemsize
+    toffset = 0 if header is None else len(header)
+
+    # ---> in place header modification
+
+    if os.path.abspath(source) == os.path.abspath(target):
+        if sform == '.nii' and toffset == offset and sdtype == tdtype:
+            with open(target, 'r+b') as tf:
+                tf.write(header)
+            return target
+        work = os.path.join(os.path.dirname(target), '.' + os.path.basename(target) + '.tmp')
+    else:
+        work = target
 
+    # ---> write the header and data
 
+    if tform == '.4dfp.img':
+        ifh.writeHeader(imageRoot(outf) + '.4dfp.ifh')
 
-def slice4dfp(sourcefile, targetfile, frames=1):
-    hdr = ifhhdr(sourcefile.replace('.img', '.ifh'))
-    x = int(hdr.ifh['matrix size [1]'])
-    y = int(hdr.ifh['matrix size [2]'])
-    z = int(hdr.ifh['matrix size [3]'])
-    t = int(hdr.ifh['matrix size [4]'])
-    voxels = x * y * z
+    try:
+        if not flip and sdtype == tdtype and sform != '.nii.gz' and tform != '.nii.gz':
+            with open(source, 'rb') as sf, open(work, 'wb') as tf:
+                if header is not None:
+                    tf.write(header)
+                copyRange(sf, tf, offset, nbytes)
 
-    hdr.ifh['matrix size [4]'] = str(frames)
-    hdr.writeHeader(targetfile.replace('.img', '.ifh'))
+        else:
+            if sform == '.nii.gz':
+                sf = openImage(source)
+                sf.seek(offset)
+                sdata = None
+            else:
+                sf = None
+                sdata = np.memmap(source, dtype=sdtype, mode='r', offset=offset, shape=shape)
 
-    sf = open(sourcefile, 'r')
-    df = open(targetfile, 'w')
+            if tform == '.nii.gz':
+                tf = openImage(work, 'wb')
+                tf.write(header)
+                tdata = None
+            else:
+                with open(work, 'wb') as tf:
+                    if header is not None:
+                        tf.write(header)
+                    tf.truncate(toffset + nbytes)
+                tf = None
+                tdata = np.memmap(work, dtype=tdtype, mode='r+', offset=toffset, shape=shape)
+
+            fbytes = sdtype.itemsize * shdr.sizex * shdr.sizey * shdr.sizez
+            for frame in range(frames):
+                if sdata is None:
+                    block = np.frombuffer(sf.read(fbytes), dtype=sdtype).reshape(shape[1:])
+                else:
+                    block = sdata[frame]
+                if flip:
+                    block = block[:, ::-1, :]
+                if tdata is None:
+                    tf.write(block.astype(tdtype, copy=False).tobytes())
+                else:
+                    tdata[frame] = block
+
+            if sf is not None:
+                sf.close()
+            if tf is not None:
+                tf.close()
+            if tdata is not None:
+                tdata.flush()
+            del sdata, tdata
 
-    df.write(sf.read(voxels * frames * 4))
+    except:
+        if work != target and os.path.exists(work):
+            os.remove(work)
+        raise
 
-    df.flush()
-    os.fsync(df.fileno())
-    sf.close
-    df.close
+    if work != target:
+        os.replace(work, target)
 
+    return target
 
-def sliceNIfTI(sourcefile, targetfile, frames=1):
-    sform = getImgFormat(sourcefile)
-    tform = getImgFormat(targetfile)
 
-    if sform == '.nii.gz':
-        sf = gzip.open(sourcefile, 'r')
+def readScrub(filename, column=None):
+    """
+    Reads a QuNex .scrub file and returns the list of 0-based indices of frames
+    that are not marked for exclusion in the specified column. If no column is
+    specified, the 'use' column is used when present (1 marks frames to use),
+    and 'udvarsme' otherwise.
+    """
+
+    header, data = [], []
+    for line in readTextFileToLines(filename):
+        line = line.strip()
+        if not line:
+            continue
+        if not data and re.search(r"[a-df-zA-DF-Z]", line):
+            line = line.lstrip('#')
+            if ':' not in line:
+                header = line.split()
+        elif not line.startswith('#'):
+            data.append(line.split())
+
+    if column is None:
+        column = 'use' if 'use' in header else 'udvarsme'
+    if column not in header:
+        raise ge.CommandFailed("readScrub", "Missing scrubbing information", "Column %s is not present in %s!" % (column, filename), "Please check your data!")
+
+    c = header.index(column)
+    if column == 'use':
+        return [n for n, e in enumerate(data) if float(e[c]) > 0]
+    return [n for n, e in enumerate(data) if float(e[c]) == 0]
+
+
+def findScrubFile(sourcefile):
+    """
+    Finds the .scrub file matching the source image in the movement subfolder
+    of the image folder.
+    """
+
+    folder, name = os.path.split(sourcefile)
+    movfolder = os.path.join(folder, 'movement')
+    root = os.path.basename(imageRoot(name))
+
+    candidate = os.path.join(movfolder, root + '.scrub')
+    if os.path.exists(candidate):
+        return candidate
+
+    base = re.match(r"(^.*?[0-9]+).*", root)
+    if base and os.path.isdir(movfolder):
+        candidates = sorted([e for e in os.listdir(movfolder) if e.startswith(base.group(1)) and e.endswith('.scrub')], key=len)
+        if candidates:
+            return os.path.join(movfolder, candidates[0])
+
+    raise ge.CommandFailed("findScrubFile", "Missing scrubbing information", "Could not find a .scrub file for %s in %s!" % (sourcefile, movfolder), "Please run compute_bold_stats first!")
+
+
+def parseFrames(frames, nframes, sourcefile=None, scrubfile=None):
+    """
+    Resolves a frame specification to a list of 0-based frame indices.
+
+    The specification can be:
+
+    - a single number N, retaining the first N frames,
+    - a comma separated list of 1-based frames and inclusive ranges, e.g.
+      '1-10,15,20-'; an open range extends to the last frame,
+    - 'scrub' or 'scrub:<column>', retaining the frames that are not marked
+      for exclusion in the scrubbing information of the image.
+    """
+
+    spec = str(frames).strip()
+
+    if spec.startswith('scrub'):
+        column = spec.split(':', 1)[1] if ':' in spec else None
+        if scrubfile is None:
+            scrubfile = findScrubFile(sourcefile)
+        selected = readScrub(scrubfile, column)
+
+    elif re.match(r"^[0-9]+$", spec):
+        selected = list(range(min(int(spec), nframes)))
+
     else:
-        sf = open(sourcefile, 'r')
+        selected = []
+        try:
+            for e in [e.strip() for e in spec.split(',') if e.strip()]:
+                if '-' in e:
+                    first, last = e.split('-', 1)
+                    first = int(first) if first else 1
+                    last = int(last) if last else nframes
+                    selected += list(range(first - 1, last))
+                else:
+                    selected.append(int(e) - 1)
+        except ValueError:
+            raise ge.CommandFailed("parseFrames", "Invalid frame specification", "Could not parse frames: %s!" % (spec), "Please check your command!")
+
+    bad = [e + 1 for e in selected if e < 0 or e >= nframes]
+    if bad:
+        raise ge.CommandFailed("parseFrames", "Invalid frame specification", "Frames %s are out of range, the image has %d frames!" % (", ".join([str(e) for e in bad]), nframes), "Please check your command!")
+    if not selected:
+        raise ge.CommandFailed("parseFrames", "Invalid frame specification", "No frames selected by %s!" % (spec), "Please check your command!")
+
+    return selected
+
+
+def frameRuns(selected):
+    """Coalesces a list of frame indices into (first frame, count) runs."""
+    runs = []
+    for frame in selected:
+        if runs and runs[-1][0] + runs[-1][1] == frame:
+            runs[-1][1] += 1
+        else:
+            runs.append([frame, 1])
+    return runs
+
+
+def extractFrames(sourcefile, targetfile, frames=1, scrubfile=None):
+    """
+    Extracts a subset of frames from sourcefile and saves them to targetfile.
+    Only the byte ranges of the selected frames are read. Uncompressed data is
+    copied in the kernel, gzipped sources are decompressed only up to the last
+    selected frame (or only the blocks needed for block gzip files).
+
+    See parseFrames for the frame specification. Returns the number of frames
+    written.
+    """
+
+    sform, nihdr, ifh, source, offset = readImageHeader(sourcefile)
+    tform = getImgFormat(targetfile)
+    if (sform == '.4dfp.img') != (tform == '.4dfp.img'):
+        raise ge.CommandFailed("extractFrames", "Format mismatch", "Source %s and target %s have to be of the same format!" % (sourcefile, targetfile), "Use convert_image to convert between formats!")
 
-    if tform == '.nii.gz':
-        tf = gzip.open(targetfile, 'w')
+    nframes = max(nihdr.frames, 1)
+    selected = parseFrames(frames, nframes, sourcefile, scrubfile)
+    fbytes = nihdr.sizex * nihdr.sizey * nihdr.sizez * (nihdr.bitpix // 8)
+
+    # ---> write target header
+
+    if tform == '.4dfp.img':
+        ifh.ifh['matrix size [4]'] = str(len(selected))
+        ifh.writeHeader(targetfile.replace('.img', '.ifh'))
+        targetfile = targetfile.replace('.ifh', '.img')
+        header = b''
     else:
-        tf = open(targetfile, 'w')
+        nihdr.frames = len(selected)
+        header = nihdr.packHdr()
 
-    hdr = niftihdr()
-    hdr.unpackHdr(sf)
-    nvox = hdr.sizex * hdr.sizey * hdr.sizez
-    hdr.frames = frames
-    tocopy = int(hdr.vox_offset - 352 + nvox * (hdr.bitpix / 8) * frames)
+    # ---> copy frame runs
 
-    tf.write(hdr.packHdr())
-    tf.write(sf.read(tocopy))
+    chunk = max(1, (1 << 26) // max(fbytes, 1))
 
-    tf.flush()
-    os.fsync(tf.fileno())
-    tf.close
-    sf.close
+    with openImage(source) as sf, openImage(targetfile, 'wb') as tf:
+        tf.write(header)
+        for first, count in frameRuns(selected):
+            while count > 0:
+                n = min(count, chunk)
+                start = offset + first * fbytes
+                if sform != '.nii.gz' and tform != '.nii.gz':
+                    copyRange(sf, tf, start, n * fbytes)
+                elif sform != '.nii.gz':
+                    tf.write(os.pread(sf.fileno(), n * fbytes, start))
+                else:
+                    sf.seek(start)
+                    tf.write(sf.read(n * fbytes))
+                first += n
+                count -= n
+
+        # ---> make sure the image is on disk before later steps read it
+
+        tf.flush()
+        os.fsync(tf.fileno())
+
+    return len(selected)
+
+
+def slice_image(sourcefile, targetfile, frames=1, scrubfile=None, parelements=1):
+    """
+    ``slice_image sourcefile=<source image> targetfile=<target image> [frames=1] [scrubfile=None] [parelements=1]``
+
+    Takes the source volume image file, retains only the specified frames, and
+    saves the resulting image to target volume image file.
+
+    INPUTS
+    ======
+
+    --sourcefile   Source volume file (.4dfp, .nii, or .nii.gz). To slice
+                   multiple images, a comma separated list of files or a glob
+                   pattern can be provided.
+    --targetfile   Target volume file of the same format. When multiple images
+                   are sliced, the folder to save them to (with the same
+                   filenames as the source images).
+    --frames       Optional specification of frames to retain [1]:
+
+                   - a number N retains the first N frames,
+                   - a comma separated list of 1-based frames and ranges, e.g.
+                     '1-10,15,20-', where an open range extends to the last
+                     frame,
+                   - 'scrub' or 'scrub:<column>' retains the frames not marked
+                     for exclusion in the .scrub file in the movement subfolder
+                     of the image folder. The 'use' column is used by default
+                     if present, 'udvarsme' otherwise.
+
+    --scrubfile    Optional explicit path to the .scrub file to use with
+                   frames=scrub.
+    --parelements  The number of images to slice in parallel. [1]
+
+    USE
+    ===
+
+    Only the byte ranges of the requested frames are read from the source
+    image. Uncompressed data is copied directly by the kernel, and gzipped
+    images are only decompressed up to the last frame needed.
+
+    EXAMPLE USE
+    ===========
+
+    ::
+
+        qunex slice_image sourcefile=bold1.nii.gz targetfile=bold1_f10.nii.gz frames=10
+
+        qunex slice_image sourcefile=bold1.nii.gz targetfile=bold1_use.nii.gz frames=scrub
+
+        qunex slice_image sourcefile="sessions/*/images/functional/bold*.nii.gz" \\
+            targetfile=trimmed frames=6- parelements=8
+    """
+
+    try:
+        parelements = int(parelements)
+    except:
+        parelements = 1
+
+    if os.path.isfile(sourcefile):
+        extractFrames(sourcefile, targetfile, frames, scrubfile)
+        return
+
+    sourcefiles = sorted(set([f for e in sourcefile.split(',') for f in glob.glob(e.strip())]))
+    if not sourcefiles:
+        raise ge.CommandFailed("slice_image", "No images found", "No images match %s!" % (sourcefile), "Please check your command!")
+    if not os.path.isdir(targetfile):
+        raise ge.CommandFailed("slice_image", "Invalid target", "When slicing multiple images targetfile has to be an existing folder!", "Please check your command!")
+
+    print("---> Slicing %d images using %d parallel elements" % (len(sourcefiles), parelements))
+
+    failed = []
+    with ThreadPoolExecutor(parelements) as executor:
+        futures = {executor.submit(extractFrames, f, os.path.join(targetfile, os.path.basename(f)), frames, scrubfile): f for f in sourcefiles}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print("     ... %s failed: %s" % (futures[future], future.exception()))
+                failed.append(futures[future])
+            else:
+                print("     ... %s: %d frames" % (futures[future], future.result()))
+
+    if failed:
+        raise ge.CommandFailed("slice_image", "Slicing failed", "%d of %d images could not be sliced:" % (len(failed), len(sourcefiles)), *failed)
+
+
+def slice4dfp(sourcefile, targetfile, frames=1):
+    extractFrames(sourcefile, targetfile, frames)
+
+
+def sliceNIfTI(sourcefile, targetfile, frames=1):
+    extractFrames(sourcefile, targetfile, frames)
 
 
 def main():
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``logscan.py``
+
+Incremental scanning of command logs for error markers. A LogScanner is fed
+the output of a command as it is produced, or reads the new bytes of a log
+file, and searches it with a single precompiled pattern for all markers. It
+keeps the number of matching lines and the first and last few of them, so
+that the outcome is known as soon as the command exits without reading the
+log again.
+"""
+
+import re
+
+from collections import deque
+
+# markers of errors in command logs
+ERROR_MARKERS = ["Error ", "Error:", "ERROR ", "ERROR:"]
+
+# size of the blocks read from log files
+BLOCK_SIZE = 1 << 20
+
+
+class LogScanner(object):
+    """
+    ``LogScanner(markers=ERROR_MARKERS, keep=5)``
+
+    Scans text fed to it for lines containing any of the markers. The
+    number of matching lines is kept in count, the number of lines matched
+    by each marker in counts and the first and last keep matching lines in
+    first and last as (marker, line) tuples.
+    """
+
+    def __init__(self, markers=ERROR_MARKERS, keep=5):
+        self.pattern = re.compile(b"|".join(re.escape(e.encode()) for e in markers))
+        self.keep = keep
+        self.count = 0
+        self.counts = {}
+        self.first = []
+        self.last = deque(maxlen=keep)
+        self.offset = 0
+        self._partial = b""
+
+    @property
+    def matched(self):
+        return self.count > 0
+
+    @property
+    def pending(self):
+        """The start of the current line, not yet scanned."""
+        return self._partial
+
+    def _scan(self, data):
+        """Scans complete lines and returns the list of matches in them."""
+        matches = []
+        end = -1
+        for m in self.pattern.finditer(data):
+            if m.start() <= end:
+                # one match per line
+                continue
+            start = data.rfind(b"\n", 0, m.start()) + 1
+            end = data.find(b"\n", m.end())
+            if end < 0:
+                end = len(data)
+            match = (
+                m.group(0).decode(),
+                data[start:end].decode("utf-8", errors="replace").rstrip("\r"),
+                start,
+            )
+            matches.append(match)
+            self.count += 1
+            self.counts[match[0]] = self.counts.get(match[0], 0) + 1
+            if len(self.first) < self.keep:
+                self.first.append(match[:2])
+            self.last.append(match[:2])
+        return matches
+
+    def feed(self, data):
+        """
+        Scans the next block of output. Lines are scanned once they are
+        complete. Returns the list of (marker, line, position) matches found,
+        where position is the offset of the line within data, negative if
+        the line started in an earlier block.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        buffered = len(self._partial)
+        data = self._partial + data
+        cut = data.rfind(b"\n") + 1
+        self._partial = data[cut:]
+        return [
+            (marker, line, position - buffered)
+            for marker, line, position in self._scan(data[:cut])
+        ]
+
+    def finish(self):
+        """Scans the last incomplete line."""
+        data, self._partial = self._partial, b""
+        return self._scan(data) if data else []
+
+    def scan_file(self, filename):
+        """
+        Scans the bytes appended to the file since the last call and returns
+        the matches found.
+        """
+        matches = []
+        with open(filename, "rb") as f:
+            f.seek(self.offset)
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                self.offset += len(block)
+                matches += self.feed(block)
+        return matches
+
+    def summary(self):
+        """Returns a description of the matching lines."""
+        lines = list(self.first)
+        if self.count > len(self.first):
+            last = list(self.last)[-(min(self.count - len(self.first), self.keep)) :]
+            if self.count > len(self.first) + len(last):
+                lines.append(("", "..."))
+            lines += last
+        return "\n".join(line for _, line in lines)
+
+
+def feeder(*scanners):
+    """Returns a function that feeds each block of output to all scanners."""
+
+    def feed(data):
+        for scanner in scanners:
+            scanner.feed(data)
+
+    return feed
+
+
+def scan_file(filename, markers=ERROR_MARKERS, keep=5):
+    """Scans the whole file and returns the LogScanner with the results."""
+    scanner = LogScanner(markers, keep)
+    scanner.scan_file(filename)
+    scanner.finish()
+    return scanner
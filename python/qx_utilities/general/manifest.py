@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``manifest.py``
+
+Precomputed manifest of the commands that can be run through gmri. For each
+command the manifest holds its class (gmri, process or matlab), the module and
+the function implementing it, its arguments and its documentation. This allows
+gmri to list the available commands and print help without importing any of
+the command modules, and to run a command by importing only the module that
+implements it.
+
+The manifest is stored as JSON next to this file, or in ~/.qunex when the
+package folder is not writable. It is rebuilt whenever one of the command
+registries, one of the modules implementing the commands, from which the
+documentation is taken, or the extension setup changes.
+"""
+
+import os
+import sys
+import json
+import importlib
+
+from general import extensions
+
+MANIFEST_VERSION = 2
+MANIFEST_NAME = ".command_manifest.json"
+
+# modules holding the command registries and the manifest code itself
+REGISTRIES = ["commands.py", "process.py", "matlab.py", "extensions.py", "manifest.py"]
+
+_manifest = None
+
+
+def _manifest_files():
+    """Returns the candidate locations of the manifest file in order of preference."""
+    return [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), MANIFEST_NAME),
+        os.path.join(os.path.expanduser("~"), ".qunex", "command_manifest.json"),
+    ]
+
+
+def _stat_key(filename):
+    try:
+        s = os.stat(filename)
+        return [filename, s.st_size, s.st_mtime_ns]
+    except OSError:
+        return [filename, None, None]
+
+
+def fingerprint():
+    """Returns the key identifying the current state of the command registries."""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    key = [MANIFEST_VERSION, os.environ.get("QXEXTENSIONSPY", "")]
+    key += [_stat_key(os.path.join(folder, e)) for e in REGISTRIES]
+    for path in extensions.extension_paths():
+        key += [_stat_key(e) for e in extensions.extension_files(path)]
+    return key
+
+
+def _sources(commands):
+    """Returns the stat keys of the source files of the command modules."""
+    files = set()
+    for entry in commands.values():
+        module = sys.modules.get(entry.get("source") or "")
+        filename = getattr(module, "__file__", None)
+        if filename:
+            files.add(os.path.abspath(filename))
+    return [_stat_key(e) for e in sorted(files)]
+
+
+def _current(sources):
+    """Returns whether none of the source files changed since they were stat'ed."""
+    if sources is None:
+        return False
+    return all(_stat_key(e[0]) == e for e in sources)
+
+
+def build_manifest():
+    """
+    Imports all command registries and compiles the manifest. Commands are
+    entered with the same precedence that gmri uses when dispatching them:
+    gmri commands first, then processing commands and then matlab functions.
+    """
+
+    from general import commands as gcom
+    from general import process as gp
+    from general import matlab as gm
+
+    commands = {}
+
+    # -> gmri commands
+    for name, spec in gcom.commands.items():
+        com = spec["com"]
+        if isinstance(com, extensions.LazyFunction):
+            com = com.load()
+        module, function = getattr(com, "__module__", None), getattr(
+            com, "__name__", None
+        )
+        try:
+            if getattr(importlib.import_module(module), function) is not com:
+                raise AttributeError
+        except Exception:
+            module, function = None, None
+        commands[name] = {
+            "class": "gmri",
+            "module": module,
+            "function": function,
+            "args": (
+                spec["args"] if isinstance(spec["args"], str) else list(spec["args"])
+            ),
+            "doc": com.__doc__,
+            "source": getattr(com, "__module__", None),
+        }
+
+    # -> processing commands
+    for list_name in ["calist", "lalist", "malist", "salist"]:
+        for line in getattr(gp, list_name):
+            if len(line) == 4 and line[1] not in commands:
+                com = gp.allactions[line[1]]
+                commands[line[1]] = {
+                    "class": "process",
+                    "module": "general.process",
+                    "function": "run",
+                    "list": list_name,
+                    "doc": com.__doc__,
+                    "source": getattr(com, "__module__", None),
+                }
+
+    # -> matlab functions
+    for name, args in gm.functions.items():
+        if name not in commands:
+            commands[name] = {
+                "class": "matlab",
+                "module": "general.matlab",
+                "function": "run",
+                "args": [arg for arg, _ in args],
+                "doc": None,
+            }
+
+    return commands
+
+
+def _save_manifest(key, commands):
+    """Atomically writes the manifest to the first writable location."""
+    data = json.dumps({"key": key, "sources": _sources(commands), "commands": commands})
+    for filename in _manifest_files():
+        tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(tmpfile, "w") as f:
+                f.write(data)
+            os.replace(tmpfile, filename)
+            return filename
+        except OSError:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+    return None
+
+
+def load_manifest(rebuild=False):
+    """
+    Returns the command manifest, a dictionary that maps command names to
+    their description. The stored manifest is used if it matches the current
+    state of the command registries, otherwise it is rebuilt and saved.
+    """
+
+    global _manifest
+
+    if _manifest is not None and not rebuild:
+        return _manifest
+
+    key = fingerprint()
+
+    if not rebuild:
+        for filename in _manifest_files():
+            try:
+                with open(filename, "r") as f:
+                    data = json.load(f)
+                if data.get("key") == key and _current(data.get("sources")):
+                    _manifest = data["commands"]
+                    return _manifest
+            except (OSError, ValueError, AttributeError):
+                pass
+
+    _manifest = build_manifest()
+    _save_manifest(key, _manifest)
+    return _manifest
+
+
+def get_command(command):
+    """Returns the manifest entry for the command or None if it does not exist."""
+    return load_manifest().get(command)
+
+
+def available_commands():
+    """Returns a sorted list of all commands that can be run through gmri."""
+    return sorted(load_manifest())
+
+
+def resolve_command(command):
+    """
+    Returns the specification of a gmri command as found in
+    general.commands, a dictionary with the function to run ("com") and the
+    list of its arguments ("args"). Only the module implementing the command
+    is imported.
+    """
+
+    entry = get_command(command)
+    if entry is None or entry["class"] != "gmri":
+        return None
+
+    if entry["module"] and entry["function"]:
+        try:
+            com = getattr(importlib.import_module(entry["module"]), entry["function"])
+            args = entry["args"]
+            return {"com": com, "args": args if isinstance(args, str) else tuple(args)}
+        except (ImportError, AttributeError):
+            pass
+
+    from general import commands as gcom
+
+    return gcom.commands.get(command)
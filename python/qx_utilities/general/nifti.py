@@ -14,6 +14,7 @@ implemented here are:
 --fz2zf        Reordering of time and z dimension.
 --reslice      Reslicing of images.
 --reorder      Reordering of slices in images.
+--nifti24dfp   Conversion of NIfTI images to 4dfp.
 
 These functions are primarily intended for internal use by other gmri commands.
 """
@@ -24,10 +25,13 @@ Copyright (c) Grega Repovs. All rights reserved.
 """
 
 import numpy as np
-import gzip
+import glob
+import os.path
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import general.img as gi
-import general.qximg as qxi
+import general.exceptions as ge
 
 def fz2zf(inf, outf=None):
     """
@@ -46,11 +50,7 @@ def fz2zf(inf, outf=None):
 
     # ---> check data format
 
-    sform = gi.getImgFormat(inf)
-    if sform == '.nii.gz':
-        sf = gzip.open(inf, 'r')
-    else:
-        sf = open(inf,'r')
+    sf = gi.openImage(inf)
 
     # ---> read the header info
 
@@ -72,17 +72,13 @@ def fz2zf(inf, outf=None):
     if outf is None:
         outf = inf
 
-    tform = gi.getImgFormat(outf)
-    if tform == '.nii.gz':
-        tf = gzip.open(outf, 'w')
-    else:
-        tf = open(outf,'w')
+    tf = gi.openImage(outf, 'wb')
 
     # ---> save image data
 
     tf.write(nihdr.packHdr())
-    tf.write(out.astype(dataType).tostring())
-    tf.close
+    tf.write(out.astype(dataType).tobytes())
+    tf.close()
 
 #
 def reslice(inf, slices, outf=None):
@@ -119,11 +115,7 @@ def reslice(inf, slices, outf=None):
 
     # ---> check data format
 
-    sform = gi.getImgFormat(inf)
-    if sform == '.nii.gz':
-        sf = gzip.open(inf, 'r')
-    else:
-        sf = open(inf,'r')
+    sf = gi.openImage(inf)
 
     # ---> read the header info
 
@@ -173,17 +165,13 @@ def reslice(inf, slices, outf=None):
     if outf is None:
         outf = inf
 
-    tform = gi.getImgFormat(outf)
-    if tform == '.nii.gz':
-        tf = gzip.open(outf, 'w')
-    else:
-        tf = open(outf,'w')
+    tf = gi.openImage(outf, 'wb')
 
     # ---> save image data
 
     tf.write(nihdr.packHdr())
-    tf.write(out.astype(dataType).tostring())
-    tf.close
+    tf.write(out.astype(dataType).tobytes())
+    tf.close()
 
 def reorder(inf, outf=None):
     """
@@ -201,11 +189,7 @@ def reorder(inf, outf=None):
 
     # ---> check data format
 
-    sform = gi.getImgFormat(inf)
-    if sform == '.nii.gz':
-        sf = gzip.open(inf, 'r')
-    else:
-        sf = open(inf,'r')
+    sf = gi.openImage(inf)
 
     # ---> read the header info
 
@@ -227,37 +211,93 @@ def reorder(inf, outf=None):
     if outf is None:
         outf = inf
 
-    tform = gi.getImgFormat(outf)
-    if tform == '.nii.gz':
-        tf = gzip.open(outf, 'w')
-    else:
-        tf = open(outf,'w')
+    tf = gi.openImage(outf, 'wb')
 
     # ---> save image data
 
     tf.write(nihdr.packHdr())
-    tf.write(out.astype(dataType).tostring())
-    tf.close
+    tf.write(out.astype(dataType).tobytes())
+    tf.close()
 
-def nifti24dfp(inf, outf=None):
+def nifti24dfp(inf, outf=None, parelements=1):
     """
-    ``nifti24dfp inf=<input_image> [outf=<output_image>]``
+    ``nifti24dfp inf=<input_image> [outf=<output_image>] [parelements=1]``
 
     Converts a NIfTI file to a 4dfp file.
     
     INPUTS
     ======
 
-    --inf       input image filename to be converted.
-    --outf      output image filename. If not provided, it replaces the original
-                file.
+    --inf           input image filename to be converted. To convert multiple
+                    images, a comma separated list of files, a glob pattern or
+                    a folder (all .nii and .nii.gz images in the folder are
+                    converted) can be provided.
+    --outf          output image filename. If not provided, the 4dfp image is
+                    saved next to the original file. When multiple images are
+                    converted, it can specify the folder to save them to.
+    --parelements   the number of images to convert in parallel. [1]
+
+    USE
+    ===
+
+    The image data is streamed frame by frame using memory mapped buffers, so
+    the conversion does not require the whole image to be loaded in memory.
+    The data is only converted to float if needed, the byte order of the
+    source image is retained.
+
+    EXAMPLE USE
+    ===========
+
+    ::
+
+        qunex nifti24dfp inf=bold1.nii.gz
+
+        qunex nifti24dfp inf=sessions/OP101/images/functional parelements=4
     """
 
-    if outf is None:
-        outf = inf
+    try:
+        parelements = int(parelements)
+    except:
+        parelements = 1
+
+    # ---> single image
 
-    # ---> read image
+    if os.path.isfile(inf):
+        if outf is None:
+            outf = inf
+        gi.convert_image(inf, outf, tform='.4dfp.img')
+        return
 
+    # ---> batch of images
 
-    image = qxi.qximg(inf)
-    image.save4DFP(outf)
+    if os.path.isdir(inf):
+        images = glob.glob(os.path.join(inf, '*.nii')) + glob.glob(os.path.join(inf, '*.nii.gz'))
+    else:
+        images = [f for e in inf.split(',') for f in glob.glob(e.strip())]
+    images = sorted(set(images))
+
+    if not images:
+        raise ge.CommandFailed("nifti24dfp", "No images found", "No NIfTI images match %s!" % (inf), "Please check your command!")
+
+    if outf is not None and not os.path.isdir(outf):
+        raise ge.CommandFailed("nifti24dfp", "Invalid output", "When converting multiple images outf has to be an existing folder!", "Please check your command!")
+
+    calls = []
+    for image in images:
+        target = image if outf is None else os.path.join(outf, os.path.basename(image))
+        calls.append((image, target))
+
+    print("---> Converting %d images to 4dfp using %d parallel elements" % (len(calls), parelements))
+
+    failed = []
+    with ProcessPoolExecutor(parelements) as executor:
+        futures = {executor.submit(gi.convert_image, image, target, '.4dfp.img'): image for image, target in calls}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print("     ... %s failed: %s" % (futures[future], future.exception()))
+                failed.append(futures[future])
+            else:
+                print("     ... converted %s" % (future.result()))
+
+    if failed:
+        raise ge.CommandFailed("nifti24dfp", "Conversion failed", "%d of %d images could not be converted:" % (len(failed), len(calls)), *failed)
@@ -21,10 +21,20 @@ None of the code is run directly from the terminal interface.
 import os
 import os.path
 import sys
+import json
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import general.scheduler as gs
+import general.admission as ga
+import general.watchdog as gwd
+import general.workers as gw
+import general.filelock as fl
+import general.retry as grt
+import general.results as grs
 import general.core as gc
 import general.exceptions as ge
 import general.commands_support as gcs
@@ -43,33 +53,132 @@ from qx_mice import setup_mice, process_mice
 # =======================================================================
 #                                                                 GLOBALS
 
-log = []
-stati = []
 logname = ""
+runlog = None
+results = None
 
 
 # =======================================================================
 #                                                       SUPPORT FUNCTIONS
 
 
-def writelog(item):
+class RunLog(object):
     """
-    ``writelog(item)``
+    ``RunLog(filename, fsync_interval=5.0, batch=256)``
 
-    Splits the passed item into two parts and appends the first to the
-    global log list, and the second to the global stati list. It also
-    prints the contents to the file specified in the global logname
-    variable.
+    A sink for the run log. Records are queued and appended to the log file
+    by a background thread in batches, the file is synced to disk at most
+    every fsync_interval seconds and when the log is closed. Per-session
+    status records are summarized as they arrive, so that the final report
+    does not need the full log.
+    """
+
+    def __init__(self, filename, fsync_interval=5.0, batch=256):
+        self.filename = filename
+        self.fsync_interval = fsync_interval
+        self.batch = batch
+        self.queue = queue.Queue()
+        self.stati = []
+        self.failed = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, name="runlog", daemon=True)
+        self.thread.start()
+
+    def _writer(self):
+        try:
+            with open(self.filename, "a") as f:
+                synced = time.time()
+                closed = False
+                while not closed:
+                    try:
+                        items = [self.queue.get(timeout=self.fsync_interval)]
+                    except queue.Empty:
+                        items = []
+                    while items and len(items) < self.batch:
+                        try:
+                            items.append(self.queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    closed = None in items
+                    f.write("".join(str(e) + "\n" for e in items if e is not None))
+                    f.flush()
+                    if closed or time.time() - synced >= self.fsync_interval:
+                        os.fsync(f.fileno())
+                        synced = time.time()
+        except Exception as e:
+            self.error = e
+
+    def write(self, text):
+        """Queues text to be appended to the log as a separate line."""
+        self.queue.put(text)
+
+    def record(self, status):
+        """Adds a (session id, report, failed) status record to the summary."""
+        sid, report, failed = status
+        if "Unknown" in sid:
+            return
+        self.stati.append((sid, report))
+        if failed is None:
+            self.failed = None
+        elif self.failed is not None:
+            self.failed += failed
+
+    def close(self):
+        """Writes all queued records, syncs and closes the log file."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            print(
+                "WARNING: Could not write to the run log %s: %s"
+                % (self.filename, error)
+            )
+
+
+def writelog(item, started=None, finished=None):
+    """
+    ``writelog(item, started=None, finished=None)``
+
+    Splits the passed item into the report and the status part. The report
+    is appended to the run log file specified in the global logname variable
+    and the status is added to the run log summary. Session statuses are
+    also recorded, with the start and end time of the session if given, in
+    the results file of the run.
     """
-    global logname
-    global log
-    global stati
     r, status = procResponse(item)
-    log.append(r)
-    stati.append(status)
-    f = open(logname, "a")
-    print(r, file=f)
-    f.close()
+    if runlog is None:
+        with open(logname, "a") as f:
+            print(r, file=f)
+    else:
+        runlog.write(r)
+        runlog.record(status)
+    if results is not None and "Unknown" not in status[0]:
+        results.record(r, status, started, finished)
+
+
+def closelog():
+    """
+    ``closelog()``
+
+    Flushes and closes the current run log.
+    """
+    global runlog
+    if runlog is not None:
+        runlog.close()
+        runlog = None
+
+
+def _forget_runlog():
+    # the writer thread of the parent does not exist in a forked child
+    global runlog, results
+    runlog = None
+    results = None
+
+
+atexit.register(closelog)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_runlog)
 
 
 def procResponse(r):
@@ -97,6 +206,51 @@ def procResponse(r):
         return (r, ("Unknown", "Unknown", None))
 
 
+def lock_report(metricsfile, waits=None):
+    """
+    ``lock_report(metricsfile, waits=None)``
+
+    Returns a line summarizing the file lock waits recorded in the metrics
+    file by the workers and given in waits for the calling process, or None
+    if no locks were taken.
+    """
+    total = {"locks": 0, "wait": 0.0, "max_wait": 0.0, "timeouts": 0}
+    entries = [waits] if waits else []
+    try:
+        with open(metricsfile, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("name") == gw.LOCK_METRICS:
+                    entries.append(entry)
+    except (OSError, TypeError):
+        pass
+    for entry in entries:
+        for k in ["locks", "wait", "timeouts"]:
+            total[k] += entry.get(k, 0)
+        total["max_wait"] = max(total["max_wait"], entry.get("max_wait", 0))
+    if not total["locks"]:
+        return None
+    return (
+        "---> File locks: %d taken, %.1f s spent waiting, longest wait %.1f s, %d timeouts"
+        % (total["locks"], total["wait"], total["max_wait"], total["timeouts"])
+    )
+
+
+def session_cost(session):
+    """
+    ``session_cost(session)``
+
+    Returns the relative processing cost of a session, the number of its
+    BOLD images or, if it has none, the number of all its images.
+    """
+    images = [v for k, v in session.items() if k.isdigit() and isinstance(v, dict)]
+    bolds = [e for e in images if "bold" in e.get("name", "").lower()]
+    return max(1, len(bolds) or len(images))
+
+
 def torf(s):
     """
     ``torf(s)``
@@ -205,6 +359,54 @@ arglist = [
     ["parsessions", "1", int, "How many sessions to run in parallel."],
     ["parelements", "1", int, "How many elements to run in parralel."],
     ["nprocess", "0", int, "How many sessions to process (0 - all)."],
+    [
+        "memory_budget",
+        "auto",
+        str,
+        "Memory available to parallel sessions and elements, e.g. 64G; 'auto' for 90% of the available memory, 'none' to run them by count only.",
+    ],
+    [
+        "stall_timeout",
+        "",
+        str,
+        "Terminate external commands that show no progress for this long, e.g. 2h or 'wb_command:30m|2h'; empty or 'none' to disable.",
+    ],
+    [
+        "soft_timeout",
+        "",
+        str,
+        "Log a warning with a process snapshot for external commands running longer than this, e.g. 12h; empty or 'none' to disable.",
+    ],
+    [
+        "hard_timeout",
+        "",
+        str,
+        "Terminate external commands running longer than this, e.g. 24h or 'bet:1h|24h'; empty or 'none' to disable.",
+    ],
+    [
+        "retries",
+        "",
+        str,
+        "How many times to retry external commands that fail transiently, e.g. 3 or 'matlab:3|1'; empty or 'none' to disable.",
+    ],
+    [
+        "retry_delay",
+        "",
+        str,
+        "Delay before the first retry of a transiently failed external command, doubled for each further retry, e.g. 1m; empty for the default of 30s.",
+    ],
+    [
+        "retry_patterns",
+        "",
+        str,
+        "Additional pipe separated output markers of transient failures, e.g. 'Out of licenses|Device or resource busy'.",
+    ],
+    [
+        "retry_stalled",
+        "no",
+        str,
+        "Whether to also retry external commands that the watchdog terminated as stalled (yes/no).",
+    ],
     ["datainfo", "False", torf, "Whether to print information."],
     ["printoptions", "False", torf, "Whether to print options."],
     ["filter", "", str, "Filtering information."],
@@ -510,6 +712,12 @@ arglist = [
         float,
         "time in seconds between submission of individual scheduler jobs",
     ],
+    [
+        "scheduler_packing",
+        "chunks",
+        str,
+        "how to divide sessions among scheduler jobs: in equal chunks (chunks) or packed by their expected run times (cost)",
+    ],
     ["# --- general HCP options"],
     [
         "hcp_processing_mode",
@@ -2197,9 +2405,9 @@ for line in flaglist:
 
 
 def run(command, args):
-    global log
-    global stati
     global logname
+    global runlog
+    global results
 
     # --------------------------------------------------------------------------
     #                                                            Parsing options
@@ -2312,8 +2520,60 @@ def run(command, args):
     else:
         logname = os.path.join(runlogfolder, "Log-%s-long-%s.log") % (command, logstamp)
 
-    log = []
-    stati = []
+    # parallel sessions and elements receive the options as changes to these
+    gw.set_base(options)
+
+    # timeouts of external commands are read by their watchdogs
+    for kind, variable in gwd.ENVIRONMENT.items():
+        value = options[kind + "_timeout"]
+        if value:
+            try:
+                gwd.parse_timeouts(value, [])
+            except ValueError as e:
+                raise ge.CommandFailed(
+                    command,
+                    "Invalid %s_timeout" % (kind),
+                    str(e),
+                    "Please check the %s_timeout parameter!" % (kind),
+                )
+            os.environ[variable] = value
+
+    # retries of external commands are read by their retry policies
+    for option, kind, parse in [
+        ("retries", "retries", grt.parse_count),
+        ("retry_delay", "delay", gwd.parse_duration),
+    ]:
+        value = options[option]
+        if value:
+            try:
+                grt.lookup(value, [], parse)
+            except ValueError as e:
+                raise ge.CommandFailed(
+                    command,
+                    "Invalid %s" % (option),
+                    str(e),
+                    "Please check the %s parameter!" % (option),
+                )
+            os.environ[grt.ENVIRONMENT[kind]] = value
+    if options["retry_patterns"]:
+        os.environ[grt.ENVIRONMENT["patterns"]] = options["retry_patterns"]
+    if options["retry_stalled"] not in ["yes", "no"]:
+        raise ge.CommandFailed(
+            command,
+            "Invalid retry_stalled",
+            "retry_stalled has to be yes or no, not %s" % (options["retry_stalled"]),
+            "Please check the retry_stalled parameter!",
+        )
+    os.environ[grt.ENVIRONMENT["stalled"]] = options["retry_stalled"]
+
+    closelog()
+    runlog = RunLog(logname)
+    runlog.write(gc.print_qunex_header())
+    runlog.write("#")
+    runlog.write(
+        "\n\n============================= LOG ================================\n"
+    )
+
     sout = gc.print_qunex_header()
     sout += "#\n"
     sout += "=================================================================\n"
@@ -2335,6 +2595,7 @@ def run(command, args):
         sout += "\nERROR: No sessions specified to process. Please check your batch file, filtering options or sessionids parameter!\n"
         print(sout)
         writelog(sout)
+        closelog()
         exit()
 
     elif options["run"] == "run":
@@ -2380,9 +2641,28 @@ def run(command, args):
     #                                                             local queue
 
     if options["scheduler"] == "local":
-        consoleLog = ""
-
+        schedule = None
         c = 0
+
+        # resource usage of external commands is recorded in a metrics file of
+        # this run, which replaces the one of an enclosing run until it ends
+        outer_metrics = os.environ.get("QUNEXMETRICS")
+        metrics = os.path.join(
+            runlogfolder, "Metrics-%s-%s.jsonl" % (command, logstamp)
+        )
+        os.environ["QUNEXMETRICS"] = metrics
+        locks_before = fl.lock_stats()
+
+        # session results are streamed to a results file as they complete
+        results = grs.ResultStream(
+            os.path.join(runlogfolder, "Results-%s-%s.jsonl" % (command, logstamp)),
+            "%s-%s" % (command, logstamp),
+            options["command_ran"],
+        )
+        if command in pactions:
+            results.start([e["id"] for e in sessions if len(e["id"]) > 1], logname)
+        else:
+            results.start([",".join(e["id"] for e in sessions)], logname)
         if parsessions == 1 or options["run"] == "test":
             # processing commands
             if command in pactions:
@@ -2394,11 +2674,6 @@ def run(command, args):
                         else:
                             action = "processing"
                         soptions = update_options(session, options)
-                        consoleLog += "\nStarting %s of sessions %s at %s" % (
-                            action,
-                            session["id"],
-                            datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
-                        )
                         print(
                             "\nStarting %s of sessions %s at %s"
                             % (
@@ -2407,13 +2682,12 @@ def run(command, args):
                                 datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
                             )
                         )
+                        started = time.time()
                         r, status = procResponse(
                             pending_actions(session, soptions, overwrite, c + 1)
                         )
-                        writelog(r)
-                        consoleLog += r
+                        writelog((r, status), started, time.time())
                         print(r)
-                        stati.append(status)
                         c += 1
                         if nprocess and c >= nprocess:
                             break
@@ -2439,11 +2713,6 @@ def run(command, args):
                         sessionids = sessionids + "," + session["id"]
 
                 # log
-                consoleLog += "\nStarting %s of sessions %s at %s" % (
-                    action,
-                    sessionids,
-                    datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
-                )
                 print(
                     "\nStarting %s of sessions %s at %s"
                     % (
@@ -2454,15 +2723,14 @@ def run(command, args):
                 )
 
                 # process
+                started = time.time()
                 r, status = procResponse(
                     pending_actions(sessions, sessionids, soptions, overwrite, c + 1)
                 )
 
                 # write log
-                writelog(r)
-                consoleLog += r
+                writelog((r, status), started, time.time())
                 print(r)
-                stati.append(status)
 
             # longitudinalo commands
             elif command in lactions:
@@ -2481,11 +2749,6 @@ def run(command, args):
                 subjectids = ",".join(subject_list)
 
                 # log
-                consoleLog += "\nStarting %s of subjects %s at %s" % (
-                    action,
-                    subjectids,
-                    datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
-                )
                 print(
                     "\nStarting %s of subjects %s at %s"
                     % (
@@ -2496,15 +2759,14 @@ def run(command, args):
                 )
 
                 # process
+                started = time.time()
                 r, status = procResponse(
                     pending_actions(sessions, subjectids, soptions, overwrite, c + 1)
                 )
 
                 # write log
-                writelog(r)
-                consoleLog += r
+                writelog((r, status), started, time.time())
                 print(r)
-                stati.append(status)
 
             # simple processing commands
             elif command in sactions:
@@ -2516,20 +2778,12 @@ def run(command, args):
 
         else:
             c = 0
-            processPoolExecutor = ProcessPoolExecutor(parsessions)
-            futures = []
             if command in pactions:
                 pending_actions = pactions[command]
+                calls = []
                 for session in sessions:
                     if len(session["id"]) > 1:
                         soptions = update_options(session, options)
-                        consoleLog += (
-                            "\nAdding processing of session %s to the pool at %s"
-                            % (
-                                session["id"],
-                                datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
-                            )
-                        )
                         print(
                             "\nAdding processing of session %s to the pool at %s"
                             % (
@@ -2537,72 +2791,99 @@ def run(command, args):
                                 datetime.now().strftime("%A, %d. %B %Y %H:%M:%S"),
                             )
                         )
-                        future = processPoolExecutor.submit(
-                            pending_actions, session, soptions, overwrite, c + 1
+                        calls.append(
+                            (pending_actions, session, soptions, overwrite, c + 1)
                         )
-                        futures.append(future)
                         c += 1
                         if nprocess and c >= nprocess:
                             break
 
-                for future in as_completed(futures):
-                    result = future.result()
-                    writelog(result)
-                    consoleLog += result[0]
+                # sessions are started while their memory use fits the budget
+                budget = ga.memory_budget(options)
+                estimate = 0
+                if budget:
+                    estimate = ga.estimate_memory(options, command) * max(
+                        1, options["parelements"]
+                    )
+
+                timings = {}
+
+                def completed(n, result):
+                    writelog(result, *timings[n])
                     print(result[0])
 
+                # sessions with more images are started first
+                _, schedule = ga.run_scheduled(
+                    ga.apply_call,
+                    calls,
+                    parsessions,
+                    options,
+                    command + " session",
+                    [session_cost(e[1]) for e in calls],
+                    estimates=[estimate] * len(calls),
+                    budget=budget,
+                    report=lambda message: print("---> memory budget: " + message),
+                    callback=completed,
+                    timings=timings,
+                )
+
             elif command in sactions:
                 pending_actions = sactions[command]
                 soptions = update_options(session, options)
                 r, status = procResponse(pending_actions(sessions, soptions, overwrite))
                 writelog(r)
 
-        # print(console log)
-        # print(consoleLog)
-
-        # create log
-        f = open(logname, "w")
-        # header
-        gc.print_qunex_header(file=f)
-        # print("# Generated by QuNex %s on %s" % (gc.get_qunex_version(), datetime.now().strftime("%Y-%m-%d_%H.%M.%S.%f")), file=f)
-        print("#", file=f)
-        print(
-            "\n\n============================= LOG ================================\n",
-            file=f,
-        )
-        for e in log:
-            print(e, file=f)
-
-        print("\n\n---> Final report for command", options["command_ran"])
-        print("\n\n---> Final report for command", options["command_ran"], file=f)
-        failedTotal = 0
-
-        for sid, report, failed in stati:
-            if "Unknown" not in sid:
-                print("... %s ---> %s" % (sid, report))
-                print("... %s ---> %s" % (sid, report), file=f)
-                if failed is None:
-                    failedTotal = None
-                else:
-                    if failedTotal is not None:
-                        failedTotal += failed
-        if failedTotal is None:
-            print("---> Success status not reported for some or all tasks")
-            print("---> Success status not reported for some or all tasks", file=f)
-        elif failedTotal > 0:
-            print("---> Not all tasks completed fully!")
-            print("---> Not all tasks completed fully!", file=f)
+        # final report
+        report = ["\n\n---> Final report for command %s" % (options["command_ran"])]
+        if schedule:
+            report.append(schedule.strip())
+        for sid, sreport in runlog.stati:
+            report.append("... %s ---> %s" % (sid, sreport))
+        if runlog.failed is None:
+            report.append("---> Success status not reported for some or all tasks")
+        elif runlog.failed > 0:
+            report.append("---> Not all tasks completed fully!")
         else:
-            print("---> Successful completion of all tasks")
-            print("---> Successful completion of all tasks", file=f)
+            report.append("---> Successful completion of all tasks")
+        if os.path.exists(metrics):
+            report.append("---> Resource usage of external commands: %s" % (metrics))
+            retried = grt.retried(metrics)
+            if retried:
+                report.append(
+                    "---> Retried %d attempts of external commands after transient "
+                    "failures:" % (len(retried))
+                )
+                for entry in retried:
+                    report.append(
+                        "... %s attempt %d: %s"
+                        % (entry["name"], entry["attempt"], entry["retry"])
+                    )
+
+        locks = lock_report(metrics, fl.lock_stats_since(locks_before))
+        if locks:
+            report.append(locks)
 
-        f.close()
+        if results is not None:
+            results.finish()
+            report.append("---> Results of the sessions: %s" % (results.filename))
+
+        for line in report:
+            print(line)
+            runlog.write(line)
+        closelog()
+        results = None
+
+        if outer_metrics is None:
+            del os.environ["QUNEXMETRICS"]
+        else:
+            os.environ["QUNEXMETRICS"] = outer_metrics
 
     # -----------------------------------------------------------------------
     #                                                  general scheduler code
 
     else:
         # schedule
+        closelog()
         gs.runThroughScheduler(
             command,
             sessions=sessions,
@@ -2610,4 +2891,5 @@ def run(command, args):
             parsessions=parsessions,
             logfolder=os.path.join(logfolder, "batchlogs"),
             logname=logname,
+            options=options,
         )
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``provenance.py``
+
+Provenance records of completed external commands. For each check file a
+record holds the command that produced it and the state of the input files
+at the time it ran. The inputs are the existing files named in the command
+and any additional files given explicitly; files the command itself changed
+while running are treated as its outputs and are not recorded.
+
+A step is considered up to date when the command is unchanged and all its
+recorded inputs are in the same state. The state of a file is its size and
+modification time, or its size and content hash when QUNEXPROVENANCE is set
+to "hash". Setting QUNEXPROVENANCE to "none" disables the records.
+
+Records are stored as JSON in a .qunex_provenance folder next to the check
+file.
+"""
+
+import os
+import re
+import json
+import hashlib
+
+PROVENANCE_VERSION = 1
+PROVENANCE_FOLDER = ".qunex_provenance"
+
+# separators of file paths in command strings
+_separators = re.compile(r"[\s=@,;\"']+")
+
+
+def mode():
+    """Returns the provenance mode: "stat", "hash" or "none"."""
+    value = os.environ.get("QUNEXPROVENANCE", "stat").lower()
+    return value if value in ("stat", "hash", "none") else "stat"
+
+
+def record_file(checkfile):
+    folder, name = os.path.split(os.path.abspath(checkfile))
+    return os.path.join(folder, PROVENANCE_FOLDER, name + ".json")
+
+
+def _content_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_state(filename, method="stat"):
+    """Returns the state of the file or None if it is not a regular file."""
+    try:
+        s = os.stat(filename)
+    except OSError:
+        return None
+    if not os.path.isfile(filename):
+        return None
+    if method == "hash":
+        try:
+            return [s.st_size, _content_hash(filename)]
+        except OSError:
+            return None
+    return [s.st_size, s.st_mtime_ns]
+
+
+def command_files(command, inputs=None):
+    """Returns the absolute paths of existing files named in the command."""
+    files = [e for e in _separators.split(command) if os.path.isabs(e)]
+    files += [os.path.abspath(e) for e in inputs or []]
+    return sorted(set(e for e in files if os.path.isfile(e)))
+
+
+def snapshot(command, checkfile, inputs=None):
+    """
+    Returns the state of the command inputs before running it, or None if
+    provenance is disabled.
+    """
+    method = mode()
+    if method == "none" or not checkfile:
+        return None
+    checkfile = os.path.abspath(checkfile)
+    states = {}
+    for filename in command_files(command, inputs):
+        if filename != checkfile:
+            state = file_state(filename, method)
+            if state is not None:
+                states[filename] = state
+    return {"method": method, "inputs": states}
+
+
+def save(checkfile, command, before):
+    """
+    Records the provenance of the check file once the command completed.
+    Inputs whose state changed while the command ran are its outputs and are
+    left out.
+    """
+    if before is None or not checkfile:
+        return False
+    method = before["method"]
+    inputs = {k: v for k, v in before["inputs"].items() if file_state(k, method) == v}
+    data = {
+        "version": PROVENANCE_VERSION,
+        "command": command,
+        "method": method,
+        "inputs": inputs,
+    }
+
+    filename = record_file(checkfile)
+    tmpfile = "%s.%d.tmp" % (filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmpfile, "w") as f:
+            json.dump(data, f)
+        os.replace(tmpfile, filename)
+        return True
+    except OSError:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return False
+
+
+def remove(checkfile):
+    """Removes the provenance record of the check file."""
+    if checkfile:
+        try:
+            os.remove(record_file(checkfile))
+        except OSError:
+            pass
+
+
+def check(checkfile, command, inputs=None):
+    """
+    Compares the provenance record of the check file with the command and
+    the current state of its inputs. Returns None if there is no record,
+    otherwise a list of reasons why the check file is out of date, empty if
+    it is up to date.
+    """
+    if mode() == "none" or not checkfile:
+        return None
+    try:
+        with open(record_file(checkfile), "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != PROVENANCE_VERSION:
+        return None
+
+    if data["command"] != command:
+        return ["command or parameters changed"]
+
+    reasons = []
+    method = data["method"]
+    for filename, state in sorted(data["inputs"].items()):
+        if file_state(filename, method) != state:
+            reasons.append("input changed: %s" % (filename))
+    for filename in inputs or []:
+        if os.path.abspath(filename) not in data["inputs"] and os.path.isfile(filename):
+            reasons.append("new input: %s" % (filename))
+    return reasons
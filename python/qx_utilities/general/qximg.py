@@ -19,7 +19,6 @@ Copyright (c) Grega Repovs. All rights reserved.
 """
 
 import numpy as np
-import gzip
 import os.path
 
 import general.img as gi
@@ -105,10 +104,7 @@ class qximg(object):
         # ---> check data format
 
         sform = gi.getImgFormat(filename)
-        if sform == '.nii.gz':
-            sf = gzip.open(filename, 'r')
-        else:
-            sf = open(filename,'r')
+        sf = gi.openImage(filename)
 
         # ---> read the header info
 
@@ -188,11 +184,7 @@ class qximg(object):
         if filename == None:
             filename = self.filename
 
-        tform = gi.getImgFormat(filename)
-        if tform == '.nii.gz':
-            tf = gzip.open(filename, 'w')
-        else:
-            tf = open(filename,'w')
+        tf = gi.openImage(filename, 'wb')
 
         # ---> check if image has to be trimmed
 
@@ -207,8 +199,8 @@ class qximg(object):
         dataType = np.dtype(self.hdrnifti.e + self.hdrnifti.dType)
 
         tf.write(self.hdrnifti.packHdr())
-        tf.write(data.astype(dataType).tostring())
-        tf.close
+        tf.write(data.astype(dataType).tobytes())
+        tf.close()
 
 
 def modniftihdr(filename, s):
@@ -226,6 +218,6 @@ def modniftihdr(filename, s):
         gmri modniftihdr img.nii.gz "srow_x:[0.7,0.0,0.0,-84.0];srow_y:[0.0,0.7,0.0,-112.0];srow_z:[0.0,0.0,0.7,-126]"
     """
 
-    image = qximg(filename)
-    image.hdrnifti.modifyHeader(s)
-    image.saveimage()
+    _, nihdr, _, _, _ = gi.readImageHeader(filename)
+    nihdr.modifyHeader(s)
+    gi.convert_image(filename, filename, nihdr=nihdr)
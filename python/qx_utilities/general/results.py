@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``results.py``
+
+Structured results of processing runs. While process.run works through the
+sessions, a ResultStream appends a JSON record for each completed session to
+a results file in the runlogs folder: the session, the command, its status
+and number of failures, the counts reported in its status (e.g. BOLDS done
+or failed), its start and end times and the paths of its logs. The run
+itself is marked by a start record listing the sessions to process and an
+end record with the final status, so that the progress of a run can be read
+while it is in progress.
+
+query_results summarizes the results files of all runs in a log folder,
+which gives an overview of many runs, e.g. scheduled jobs, running at once.
+A run that did not finish is reported as interrupted when its process on
+this host or its scheduler job is gone, and as stale when neither can be
+checked and it has not recorded anything for a while.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import socket
+import subprocess
+
+from datetime import datetime
+
+import general.core as gc
+import general.filelock as fl
+import general.watchdog as gwd
+
+RESULTS_PATTERN = "Results-*.jsonl"
+
+# environment variables with the id of the scheduler job of a run
+JOB_VARIABLES = {"SLURM": "SLURM_JOB_ID", "PBS": "PBS_JOBID"}
+
+# commands that succeed with output only while the job is queued or running
+JOB_COMMANDS = {"SLURM": ["squeue", "-h", "-j"], "PBS": ["qstat"]}
+
+_counts = re.compile(r"([A-Za-z][A-Za-z ]*?)\s*:\s*(-?\d+)")
+_logs = re.compile(r"---> logfile: (\S+)")
+
+
+def _timestamp(t=None):
+    return datetime.fromtimestamp(time.time() if t is None else t).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def parse_counts(report):
+    """
+    Returns the counts in a session status report, e.g. {"bolds_done": 2,
+    "failed": 1} for "BOLDS done: 2, failed: 1".
+    """
+    return {
+        "_".join(name.lower().split()): int(value)
+        for name, value in _counts.findall(str(report))
+    }
+
+
+def parse_logs(r):
+    """Returns the paths of the command logs listed in a session report."""
+    return _logs.findall(str(r))
+
+
+def session_status(failed):
+    """Returns the status of a session with the given number of failures."""
+    if failed is None:
+        return "unknown"
+    return "failed" if failed else "done"
+
+
+class ResultStream(object):
+    """
+    ``ResultStream(filename, run, command)``
+
+    Appends the result records of the run with the given id to the results
+    file as they arrive.
+    """
+
+    def __init__(self, filename, run, command):
+        self.filename = filename
+        self.run = run
+        self.command = command
+        self.failed = 0
+
+    def _write(self, event, **entry):
+        entry = dict(
+            event=event, run=self.run, command=self.command, time=_timestamp(), **entry
+        )
+        try:
+            fl.safe_write(json.dumps(entry) + "\n", self.filename)
+        except (OSError, IOError) as e:
+            print("WARNING: Could not record results in %s: %s" % (self.filename, e))
+        return entry
+
+    def start(self, sessions, log=None):
+        """Records the start of the run on the sessions with the given ids."""
+        scheduler, job = None, None
+        for name, variable in JOB_VARIABLES.items():
+            if os.environ.get(variable):
+                scheduler, job = name, os.environ[variable]
+                break
+        return self._write(
+            "start",
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            scheduler=scheduler,
+            job=job,
+            sessions=list(sessions),
+            total=len(sessions),
+            log=log,
+            metrics=os.environ.get("QUNEXMETRICS"),
+        )
+
+    def record(self, r, status, started=None, finished=None):
+        """
+        Records the result of a session from its report r and its (session
+        id, report, failed) status, with its start and end time if known.
+        """
+        sid, report, failed = status
+        if failed is None:
+            self.failed = None
+        elif self.failed is not None:
+            self.failed += failed
+        return self._write(
+            "result",
+            session=sid,
+            status=session_status(failed),
+            failed=failed,
+            report=report,
+            counts=parse_counts(report),
+            started=None if started is None else _timestamp(started),
+            finished=None if finished is None else _timestamp(finished),
+            duration=None if None in [started, finished] else finished - started,
+            logs=parse_logs(r),
+        )
+
+    def finish(self):
+        """Records the end of the run with its final status."""
+        if self.failed is None:
+            status = "unknown"
+        else:
+            status = "failed" if self.failed else "done"
+        return self._write("end", status=status, failed=self.failed)
+
+
+def read_results(filenames):
+    """Returns the records in the results files, skipping incomplete lines."""
+    entries = []
+    for filename in filenames:
+        try:
+            with open(filename, "r") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+    return entries
+
+
+def durations(logfolder, command):
+    """
+    Returns the most recent recorded duration in seconds of each session
+    processed by the command in the results files in the log folder.
+    """
+    if not logfolder:
+        return {}
+    files = glob.glob(os.path.join(logfolder, RESULTS_PATTERN))
+    times = {}
+    for entry in read_results(sorted(files, key=os.path.getmtime)):
+        if entry.get("event") != "result" or not entry.get("duration"):
+            continue
+        if entry.get("command") == command:
+            times[entry.get("session")] = entry["duration"]
+    return times
+
+
+def _alive(host, pid):
+    """Returns whether the process is running, or None if it is on another host."""
+    if host != socket.gethostname() or not pid:
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _job_alive(scheduler, job):
+    """
+    Returns whether the scheduler job is queued or running, or None if the
+    scheduler can not be asked.
+    """
+    if not scheduler or not job or scheduler not in JOB_COMMANDS:
+        return None
+    try:
+        result = subprocess.run(
+            JOB_COMMANDS[scheduler] + [str(job)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=30,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def _age(timestamp):
+    """Returns the seconds since the recorded time."""
+    try:
+        then = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return (datetime.now() - then).total_seconds()
+
+
+def summarize(entries, stale=None):
+    """
+    Returns a summary of each run in the records as a dictionary with the
+    command, host, pid, scheduler job, start, end and last record time,
+    total number of sessions, the sessions by status and the state of the
+    run: "running", "finished", "interrupted" or, if its process or job can
+    not be checked and it recorded nothing for stale seconds, "stale".
+    """
+    runs = {}
+    jobs = {}
+    for entry in entries:
+        run = runs.setdefault(
+            entry.get("run"),
+            {
+                "run": entry.get("run"),
+                "command": entry.get("command"),
+                "host": None,
+                "pid": None,
+                "scheduler": None,
+                "job": None,
+                "started": None,
+                "last": None,
+                "finished": None,
+                "total": None,
+                "sessions": {"done": [], "failed": [], "unknown": []},
+                "status": None,
+            },
+        )
+        if entry["event"] == "start":
+            run.update(
+                host=entry.get("host"),
+                pid=entry.get("pid"),
+                scheduler=entry.get("scheduler"),
+                job=entry.get("job"),
+                started=entry.get("time"),
+                total=entry.get("total"),
+            )
+        elif entry["event"] == "result":
+            run["sessions"][entry.get("status", "unknown")].append(entry.get("session"))
+        elif entry["event"] == "end":
+            run.update(finished=entry.get("time"), status=entry.get("status"))
+        run["last"] = max(run["last"] or "", entry.get("time") or "")
+
+    for run in runs.values():
+        if run["finished"]:
+            run["state"] = "finished"
+            continue
+        alive = _alive(run["host"], run["pid"])
+        if alive is None:
+            key = (run["scheduler"], run["job"])
+            if key not in jobs:
+                jobs[key] = _job_alive(*key)
+            alive = jobs[key]
+        age = _age(run["last"])
+        if alive is False:
+            run["state"] = "interrupted"
+        elif alive is None and stale and age is not None and age > stale:
+            run["state"] = "stale"
+        else:
+            run["state"] = "running"
+    return sorted(runs.values(), key=lambda e: e["started"] or "")
+
+
+def query_results(
+    sessionsfolder=None, logfolder=None, active="no", details="no", stale="24h"
+):
+    """
+    ``query_results [sessionsfolder=None] [logfolder=None] [active=no] [details=no] [stale=24h]``
+
+    Summarizes the progress of processing runs from their results files.
+
+    INPUTS
+    ======
+
+    --sessionsfolder  The sessions folder of the study, used to find its log
+                      folder if logfolder is not given.
+    --logfolder       The log folder holding the runlogs of the runs, or the
+                      runlogs folder itself. [<study>/processing/logs]
+    --active          Whether to list only runs that have not finished. [no]
+    --details         Whether to list the sessions that failed or did not
+                      report their status. [no]
+    --stale           How long a run whose process or job can not be checked
+                      may go without recording a result before it is
+                      reported as stale, e.g. 12h; 'none' to never. [24h]
+
+    For each run the results file records the sessions to process and the
+    result of each session as it completes, so the summary shows the
+    progress of runs in progress as well as the outcome of finished ones.
+    A run that has not finished is reported as interrupted if its process
+    is no longer running on this host or, for runs in scheduler jobs, if
+    the job is no longer known to squeue or qstat.
+
+    EXAMPLE USE
+    ===========
+
+    ::
+
+        qunex query_results \\
+            --sessionsfolder=/data/studies/WM/sessions \\
+            --active=yes
+    """
+
+    folder = gc.deduceFolders(
+        {"sessionsfolder": sessionsfolder, "logfolder": logfolder}
+    )["logfolder"]
+    if os.path.isdir(os.path.join(folder, "runlogs")):
+        folder = os.path.join(folder, "runlogs")
+
+    files = sorted(glob.glob(os.path.join(folder, RESULTS_PATTERN)))
+    runs = summarize(read_results(files), gwd.parse_duration(stale))
+    if active in ["yes", "Yes", "YES", "true", "True", True]:
+        runs = [e for e in runs if e["state"] != "finished"]
+    details = details in ["yes", "Yes", "YES", "true", "True", True]
+
+    print("\n---> Results of %d runs in %s" % (len(runs), folder))
+    for run in runs:
+        sessions = run["sessions"]
+        completed = sum(len(e) for e in sessions.values())
+        print(
+            "\n... %s [%s] %s on %s, pid %s%s, started %s, last record %s"
+            % (
+                run["run"],
+                run["state"],
+                run["command"],
+                run["host"],
+                run["pid"],
+                ", %s job %s" % (run["scheduler"], run["job"]) if run["job"] else "",
+                run["started"],
+                run["last"],
+            )
+        )
+        print(
+            "    %d of %s sessions completed: %d done, %d failed, %d unknown"
+            % (
+                completed,
+                run["total"] if run["total"] is not None else "?",
+                len(sessions["done"]),
+                len(sessions["failed"]),
+                len(sessions["unknown"]),
+            )
+        )
+        if run["finished"]:
+            print("    finished %s with status %s" % (run["finished"], run["status"]))
+        if details:
+            for status in ["failed", "unknown"]:
+                if sessions[status]:
+                    print(
+                        "    %s: %s"
+                        % (status, ", ".join(str(e) for e in sessions[status]))
+                    )
+    return runs
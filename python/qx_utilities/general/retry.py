@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``retry.py``
+
+Retry policy for external commands that fail for transient reasons, such as
+a stale NFS handle, a license server that did not answer or a temporarily
+exhausted resource. A failed attempt is classified as transient by its exit
+code or by markers in its output, and is then retried
+after an exponentially growing delay while the retry budget of the command
+lasts. Before a retry, the files of the full file check that the failed
+attempt created or modified are removed, so that partial outputs are not
+mistaken for results.
+
+Retries are off unless a budget is set. The budgets and the initial delay
+are set by the QUNEXRETRIES and QUNEXRETRYDELAY environment variables, which
+process.run sets from the retries and retry_delay options, in the format of
+the watchdog timeouts: a single value or pipe separated <command>:<value>
+entries with an optional default, e.g. "matlab:3|wb_command:1|2". Additional
+output markers can be given, pipe separated, in QUNEXRETRYPATTERNS (the
+retry_patterns option). Commands the watchdog terminated as stalled are
+only retried if QUNEXRETRYSTALLED (the retry_stalled option) is "yes", and
+commands that exceeded their hard timeout never are.
+"""
+
+import os
+import json
+import random
+
+import general.core as gc
+import general.logscan as gls
+import general.watchdog as gwd
+
+ENVIRONMENT = {
+    "retries": "QUNEXRETRIES",
+    "delay": "QUNEXRETRYDELAY",
+    "patterns": "QUNEXRETRYPATTERNS",
+    "stalled": "QUNEXRETRYSTALLED",
+}
+
+# used when the budgets and delays are not set
+DEFAULTS = {"retries": "none", "delay": "30s"}
+
+# the longest delay between attempts in seconds
+MAX_DELAY = 900
+
+# exit codes of transient failures (EX_TEMPFAIL)
+TRANSIENT_EXITCODES = [75]
+
+# output markers of transient failures
+TRANSIENT_MARKERS = [
+    "Resource temporarily unavailable",
+    "Stale file handle",
+    "Stale NFS file handle",
+    "Connection timed out",
+    "Connection reset by peer",
+    "Temporary failure in name resolution",
+    "License checkout failed",
+    "License Manager Error",
+    "Licensing error",
+    "Unable to contact the license server",
+]
+
+
+def lookup(spec, names, parse):
+    """
+    Returns the value that the specification sets for the first of the
+    names it lists, otherwise its default, or None.
+    """
+    values = {}
+    default = None
+    for entry in str(spec).split("|"):
+        entry = entry.strip()
+        if ":" in entry:
+            name, value = entry.rsplit(":", 1)
+            values[name.strip()] = parse(value)
+        elif entry:
+            default = parse(entry)
+    for name in names:
+        if name in values:
+            return values[name]
+    return default
+
+
+def parse_count(value):
+    """Parses a number of retries. Returns 0 for none."""
+    value = str(value).strip().lower()
+    if value in ["", "none", "no", "off"]:
+        return 0
+    return int(value)
+
+
+def markers():
+    """Returns the output markers of transient failures."""
+    extra = os.environ.get(ENVIRONMENT["patterns"], "")
+    return TRANSIENT_MARKERS + [e.strip() for e in extra.split("|") if e.strip()]
+
+
+class RetryPolicy(object):
+    """
+    ``RetryPolicy(retries=0, delay=30, stalled=False)``
+
+    The retry budget and the initial delay in seconds of a command, and
+    whether stalled attempts are retried. Keeps the list of failed attempts
+    in attempts as (attempt, reason, delay) tuples.
+    """
+
+    def __init__(self, retries=0, delay=30, stalled=False):
+        self.retries = retries
+        self.delay = delay or 0
+        self.stalled = stalled
+        self.attempts = []
+
+    @classmethod
+    def from_environment(cls, command, task=None):
+        """Returns the policy set for the command."""
+        names = [e for e in [task, gwd.command_name(command)] if e]
+        retries = lookup(
+            os.environ.get(ENVIRONMENT["retries"]) or DEFAULTS["retries"],
+            names,
+            parse_count,
+        )
+        delay = lookup(
+            os.environ.get(ENVIRONMENT["delay"]) or DEFAULTS["delay"],
+            names,
+            gwd.parse_duration,
+        )
+        stalled = os.environ.get(ENVIRONMENT["stalled"], "no").lower()
+        return cls(retries or 0, delay, stalled in ["yes", "true"])
+
+    def scanner(self):
+        """Returns a LogScanner for the markers of transient failures."""
+        return gls.LogScanner(markers(), keep=1)
+
+    def classify(self, exitcode, stalled, scanner):
+        """
+        Returns the reason why a failed attempt is considered transient, or
+        None if it is not.
+        """
+        if stalled == "stalled":
+            return "stalled" if self.stalled else None
+        if stalled or not exitcode:
+            return None
+        if scanner is not None and scanner.matched:
+            return "'%s' in the output" % (scanner.first[0][0])
+        if exitcode in TRANSIENT_EXITCODES:
+            return "exit code %d" % (exitcode)
+        return None
+
+    def backoff(self, attempt):
+        """Returns the delay in seconds before the given retry."""
+        delay = min(MAX_DELAY, self.delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def retry(self, exitcode, stalled, scanner):
+        """
+        Decides whether to retry a failed attempt. Returns the reason and the
+        delay before the next attempt, or None if it should not be retried.
+        """
+        reason = self.classify(exitcode, stalled, scanner)
+        if reason is None or len(self.attempts) >= self.retries:
+            return None
+        delay = self.backoff(len(self.attempts) + 1)
+        self.attempts.append((len(self.attempts) + 1, reason, delay))
+        return reason, delay
+
+    def summary(self):
+        """Returns a description of the failed attempts."""
+        return "\n".join(
+            "---> attempt %d failed transiently (%s), retried after %.0f s" % attempt
+            for attempt in self.attempts
+        )
+
+
+def partial_outputs(fullTest, started):
+    """
+    Returns the files of the full file check that were created or modified
+    since started.
+    """
+    if not fullTest:
+        return []
+    specfile = fullTest["tfile"]
+    if "specfolder" in fullTest and not os.path.exists(specfile):
+        specfile = os.path.join(fullTest["specfolder"], specfile)
+    if not os.path.exists(specfile):
+        return []
+
+    files = []
+    for alternatives in gc.compileSpec(specfile, fullTest.get("fields")):
+        for parts in alternatives:
+            filename = os.path.join(fullTest["tfolder"], *parts)
+            try:
+                if os.path.isfile(filename) and os.lstat(filename).st_mtime >= started:
+                    files.append(filename)
+            except OSError:
+                pass
+    return files
+
+
+def cleanup(checkfile, fullTest, started):
+    """
+    Removes the check file and the files of the full file check that a
+    failed attempt created or modified. Returns the removed files.
+    """
+    files = partial_outputs(fullTest, started)
+    if checkfile and os.path.isfile(checkfile):
+        if os.path.getmtime(checkfile) >= started:
+            files.append(checkfile)
+
+    removed = []
+    for filename in files:
+        try:
+            os.remove(filename)
+            removed.append(filename)
+        except OSError:
+            pass
+    return removed
+
+
+def retried(metricsfile):
+    """
+    Returns the entries of the metrics file for attempts that were retried
+    after a transient failure.
+    """
+    entries = []
+    try:
+        with open(metricsfile, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("retry"):
+                    entries.append(entry)
+    except OSError:
+        pass
+    return entries
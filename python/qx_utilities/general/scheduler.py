@@ -23,6 +23,8 @@ import re
 import general.exceptions as ge
 import general.core as gc
 import general.process as gp
+import general.admission as ga
+import general.results as grs
 
 from datetime import datetime
 
@@ -500,8 +502,64 @@ def schedule(
 #                                                  general scheduler code
 
 
+def _bold_images(session, sessionsfolder):
+    """Returns the imported BOLD images of the session."""
+    images = []
+    for k, v in session.items():
+        if k.isdigit() and isinstance(v, dict) and "bold" in v.get("name", "").lower():
+            for ext in [".nii.gz", ".nii"]:
+                image = os.path.join(sessionsfolder, session["id"], "nii", k + ext)
+                if os.path.exists(image):
+                    images.append(image)
+                    break
+            else:
+                images.append(None)
+    return images
+
+
+def session_times(command, sessions, options):
+    """
+    ``session_times(command, sessions, options)``
+
+    Returns the expected run times of the sessions and whether they are in
+    seconds. A session is expected to take as long as the command took on
+    it before, as recorded in the results files in the runlogs folder.
+    Otherwise its run time is estimated from its number of BOLD images,
+    weighted by their voxels times frames where the image headers can be
+    read, and the run time per BOLD recorded for the command. Without any
+    records the relative costs of the sessions are returned.
+    """
+    sessionsfolder = options.get("sessionsfolder") or "."
+    counts = [gp.session_cost(e) for e in sessions]
+    images = []
+    for session in sessions:
+        bolds = _bold_images(session, sessionsfolder)
+        images.append(bolds if bolds and None not in bolds else [])
+    costs = ga.relative_costs(counts, images)
+
+    runlogs = options.get("runlogs")
+    recorded = grs.durations(runlogs, command)
+    durations = [recorded.get(e["id"]) for e in sessions]
+    rate = ga.runtime_rate(runlogs, command + " session")
+    return ga.expected_times(costs, durations, rate)
+
+
+def _load(seconds, times):
+    if not seconds:
+        return "%.1f" % (times)
+    if times < 60:
+        return "%.0f s" % (times)
+    return "%dh %02dm" % (times // 3600, times % 3600 // 60)
+
+
 def runThroughScheduler(
-    command, sessions=None, args=[], parsessions=1, logfolder=None, logname=None
+    command,
+    sessions=None,
+    args=[],
+    parsessions=1,
+    logfolder=None,
+    logname=None,
+    options=None,
 ):
     jobs = []
 
@@ -516,6 +574,7 @@ def runThroughScheduler(
             "nprocess",
             "bash",
             "parjobs",
+            "scheduler_packing",
         ]:
             nopt.append((k, v))
 
@@ -545,6 +604,15 @@ def runThroughScheduler(
 
     test = args.get("run", "run")
 
+    packing = args.get("scheduler_packing", "chunks")
+    if packing not in ["chunks", "cost"]:
+        raise ge.CommandError(
+            "schedule",
+            "Misspecified parameter",
+            "scheduler_packing has to be either chunks or cost!",
+            "The value submitted was: %s" % (packing),
+        )
+
     # check scheduler
     if scheduler not in ["PBS", "SLURM", "GridEngine"]:
         raise ge.CommandError(
@@ -617,43 +685,53 @@ def runThroughScheduler(
                 # SLURM job array?
                 if scheduler == "SLURM" and s.strip() == "array":
                     slurm_array = True
-                    if parjobs is None:
-                        settings["array"] = "0-%s" % (len(sessions) - 1)
-                    else:
-                        settings["array"] = "0-%s%%%s" % (len(sessions) - 1, parjobs)
+                    settings["array"] = None
                 else:
                     settings[s.strip()] = None
 
-        # only allow HCP MPP commands with job array
+        # only allow per-session commands with job array
         if slurm_array:
             qx_command = command.split(" ")[0]
-
-            array_commands = [
-                "hcp_pre_freesurfer",
-                "hcp_freesurfer",
-                "hcp_post_freesurfer",
-                "hcp_fmri_volume",
-                "hcp_fmri_surface",
-                "run_recipe",
-            ]
-            if qx_command not in array_commands:
+            if any(qx_command in e for e in [gp.mactions, gp.lactions, gp.sactions]):
                 raise ge.CommandError(
                     qx_command,
-                    "SLURM job arrays are supported only for HCP Minimal Preprocessing Pipelines: hcp_pre_freesurfer, hcp_freesurfer, hcp_post_freesurfer, hcp_fmri_volume and hcp_fmri_surface.",
+                    "SLURM job arrays are supported only for commands that process each session on its own.",
                 )
 
         settings["jobname"] = settings.get("jobname", command)
 
-        # if job array we have a single job
-        if slurm_array:
-            parjobs = 1
-
         # split sessions
         # how big are chunks of sessions
         n_sessions = len(sessions)
         chunks = int(math.ceil(n_sessions / float(parsessions)))
         chunk_size = int(math.ceil(n_sessions / float(chunks)))
 
+        # a job array runs a task for each chunk of sessions, the tasks read
+        # their sessions from a session map
+        if slurm_array:
+            if packing == "cost":
+                times, seconds = session_times(command, sessions, options or args)
+                groups = [sorted(e) for e in ga.pack(times, chunks)[0] if e]
+            else:
+                groups = [
+                    list(range(n, min(n + chunk_size, n_sessions)))
+                    for n in range(0, n_sessions, chunk_size)
+                ]
+            tasks = [[sessions[n]["id"] for n in group] for group in groups]
+            exectime = datetime.now().strftime("%Y-%m-%d_%H.%M.%S.%f")
+            mapfile = os.path.join(
+                logfolder, "%s_%s.%s.sessions" % (scheduler, command, exectime)
+            )
+            if test == "run":
+                gc.write_session_map(mapfile, tasks)
+            if not settings["array"]:
+                settings["array"] = "0-%d" % (len(tasks) - 1)
+                if parjobs is not None:
+                    settings["array"] += "%%%d" % (parjobs)
+
+            # the whole array is a single job
+            parjobs = 1
+
         # is parjobs none create a job for each session
         if parjobs is None:
             parjobs = n_sessions
@@ -668,6 +746,33 @@ def runThroughScheduler(
 
         # init queues
         sessionids_array = [""] * parjobs
+        planned = None
+        if slurm_array:
+            sessionids_array = [gc.SESSION_MAP_PREFIX + mapfile]
+            chunks = 0
+
+        # pack sessions into jobs by their expected run times
+        if packing == "cost" and parjobs > 1 and not slurm_array:
+            times, seconds = session_times(command, sessions, options or args)
+            groups, loads = ga.pack(times, parjobs)
+            sessionids_array = [
+                ",".join(sessions[n]["id"] for n in group) for group in groups
+            ]
+            planned = []
+            for group, load in zip(groups, loads):
+                planned.append(
+                    "%d %s, expected load %s, expected runtime %s"
+                    % (
+                        len(group),
+                        "session" if len(group) == 1 else "sessions",
+                        _load(seconds, load),
+                        _load(
+                            seconds,
+                            ga.makespan([times[n] for n in group], parsessions),
+                        ),
+                    )
+                )
+            chunks = 0
 
         # divide sessions among jobs
         job = 0
@@ -708,12 +813,22 @@ def runThroughScheduler(
         )
 
         if slurm_array:
-            print("    Using SLURM job array over sessions: %s" % sessionids_array[0])
+            print(
+                "    Using a SLURM job array of %d tasks over the sessions listed in: %s"
+                % (len(tasks), mapfile)
+            )
         else:
             for i in range(0, parjobs):
                 print(
                     "    Job #%s will run sessions: %s" % ((i + 1), sessionids_array[i])
                 )
+                if planned:
+                    print("            %s" % (planned[i]))
+            if planned and not seconds:
+                print(
+                    "\n    No run times are recorded for %s, loads are in units of "
+                    "an average BOLD image." % (command)
+                )
 
         if test == "run":
             for i in range(parjobs):
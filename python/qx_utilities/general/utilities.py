@@ -19,6 +19,8 @@ Copyright (c) Grega Repovs and Jure Demsar. All rights reserved.
 
 import os.path
 import os
+import sys
+import codecs
 import errno
 import shutil
 import glob
@@ -35,9 +37,13 @@ import general.core as gc
 import processing.core as gpc
 import general.exceptions as ge
 import general.filelock as fl
+import general.logscan as gls
+import general.engine as gen
 import general.parser as parser
 import general.all_commands as gac
 
+# markers of failed commands in the output of commands run by run_recipe
+RECIPE_ERRORS = ["ERROR in completing", "ERROR:", "failed with error"]
 
 parameterTemplateHeader = """#  Parameters file
 #  =====================
@@ -2608,15 +2614,8 @@ def run_recipe(recipe_file=None, recipe=None, steps=None, logfolder=None, eargs=
                 print(f"    ... creating log folder [{comlogfolder}]", file=log)
                 os.makedirs(comlogfolder)
 
-            # run the command with subprocess Popen
-            with open(log_path, "w", encoding="UTF-8") as log_file:
-                process = subprocess.Popen(
-                    command, stdout=log_file, stderr=subprocess.STDOUT
-                )
-                process.communicate()
-
-            # Get the exit code
-            exit_code = process.returncode
+            # run the command
+            exit_code = gen.call(command, log=log_path)["exit"]
 
             if exit_code != 0:
                 error = True
@@ -2741,33 +2740,35 @@ def run_recipe(recipe_file=None, recipe=None, steps=None, logfolder=None, eargs=
             print(commandr)
             print(commandr, file=log)
 
-            # run command
-            process = subprocess.Popen(
-                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0
-            )
+            # Scan the output for errors and the final report as it arrives,
+            # log it from the first of them on
+            scanner = gls.LogScanner(RECIPE_ERRORS + ["Final report"])
+            output = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            logged = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            logging = []
 
-            # Poll process for new output until finished
-            logging = False
+            def stream(block):
+                sys.stdout.write(output.decode(block))
+                sys.stdout.flush()
 
-            for line in iter(process.stdout.readline, b""):
-                line = line.decode("utf-8")
-                print(line)
-                if (
-                    "ERROR in completing" in line
-                    or "ERROR:" in line
-                    or "failed with error" in line
-                ):
+                pending = scanner.pending
+                matches = scanner.feed(block)
+                if not logging and matches:
                     print("", file=log)
-                    error = True
+                    block = (pending + block)[len(pending) + matches[0][2] :]
+                    logging.append(True)
+                if logging:
+                    log.write(logged.decode(block))
+                    log.flush()
 
-                if "Final report" in line:
-                    print("", file=log)
-                    logging = True
+            # run command
+            gen.call(command, output=stream)
 
-                # print
-                if logging or error:
-                    print(line, end=" ", file=log)
-                    log.flush()
+            matches = scanner.finish()
+            if not logging and matches:
+                print("", file=log)
+                log.write(logged.decode(scanner.last[-1][1].encode()))
+            error = any(scanner.counts.get(e) for e in RECIPE_ERRORS)
 
             if error:
                 summary += f"\n - command {command_name} ... FAILED"
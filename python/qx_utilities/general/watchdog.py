@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``watchdog.py``
+
+Supervision of external commands. A Watchdog runs in a background thread
+next to a command started in its own process group and watches for signs of
+progress: growth of the command log, and CPU time and I/O of the processes
+in the group. If there is no progress for the stall timeout, or the command
+runs longer than the hard timeout, a snapshot of the processes is written
+to the log and the whole process group is terminated. Past the soft timeout
+only a warning with a snapshot is written.
+
+The timeouts are set by the QUNEXSTALLTIMEOUT, QUNEXSOFTTIMEOUT and
+QUNEXHARDTIMEOUT environment variables, which process.run sets from the
+stall_timeout, soft_timeout and hard_timeout options. Each is either a
+single duration applying to all commands, or a pipe separated list of
+<command>:<duration> entries with an optional default duration, e.g.
+"wb_command:30m|bet:10m|2h". A command is matched by its task name or the
+name of its executable. Durations are in seconds unless suffixed with s, m,
+h or d; "none" disables the timeout. All timeouts are off by default, so
+that commands are only supervised, and moved to a process group of their
+own, when a timeout is set.
+"""
+
+import os
+import re
+import time
+import signal
+import threading
+
+from datetime import datetime
+
+ENVIRONMENT = {
+    "stall": "QUNEXSTALLTIMEOUT",
+    "soft": "QUNEXSOFTTIMEOUT",
+    "hard": "QUNEXHARDTIMEOUT",
+}
+
+# used when the timeouts are not set
+DEFAULTS = {"stall": "none", "soft": "none", "hard": "none"}
+
+# seconds between SIGTERM and SIGKILL
+GRACE = 10
+
+_units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(value):
+    """Parses a duration such as 90, 30m or 2h. Returns None for none."""
+    value = str(value).strip().lower()
+    if value in ["", "none", "no", "off", "0"]:
+        return None
+    m = re.match(r"^([\d.]+)\s*([smhd]?)$", value)
+    if not m:
+        raise ValueError("Invalid duration: %s" % (value))
+    return float(m.group(1)) * _units[m.group(2)]
+
+
+def parse_timeouts(spec, names):
+    """
+    Returns the timeout in seconds that the specification sets for the
+    first of the names it lists, otherwise its default, or None.
+    """
+    timeouts = {}
+    default = None
+    for entry in str(spec).split("|"):
+        entry = entry.strip()
+        if ":" in entry:
+            name, value = entry.rsplit(":", 1)
+            timeouts[name.strip()] = parse_duration(value)
+        elif entry:
+            default = parse_duration(entry)
+    for name in names:
+        if name in timeouts:
+            return timeouts[name]
+    return default
+
+
+def command_name(command):
+    """Returns the name of the executable run by the command."""
+    if isinstance(command, (list, tuple)):
+        command = command[0] if command else ""
+    words = str(command).split()
+    return os.path.basename(words[0]) if words else ""
+
+
+def _read(filename):
+    try:
+        with open(filename, "r") as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def group_processes(pgid):
+    """
+    Returns a dictionary with the ppid, state, CPU ticks and command name of
+    the processes in the process group, read from /proc, or None if /proc is
+    not available.
+    """
+    try:
+        pids = [e for e in os.listdir("/proc") if e.isdigit()]
+    except OSError:
+        return None
+
+    processes = {}
+    for pid in pids:
+        stat = _read("/proc/%s/stat" % (pid))
+        if not stat:
+            continue
+        # the command name is in parentheses and can contain spaces
+        name = stat[stat.find("(") + 1 : stat.rfind(")")]
+        fields = stat[stat.rfind(")") + 2 :].split()
+        if int(fields[2]) != pgid:
+            continue
+        processes[int(pid)] = {
+            "name": name,
+            "state": fields[0],
+            "ppid": int(fields[1]),
+            "cpu": int(fields[11]) + int(fields[12]),
+        }
+    return processes
+
+
+def _io(pid):
+    io = _read("/proc/%d/io" % (pid)) or ""
+    total = 0
+    for line in io.splitlines():
+        key, _, value = line.partition(":")
+        if key in ["rchar", "wchar"]:
+            total += int(value)
+    return total
+
+
+def activity(pgid):
+    """
+    Returns the CPU ticks and I/O bytes of the processes in the group, or
+    None if they can not be read.
+    """
+    processes = group_processes(pgid)
+    if processes is None:
+        return None
+    return (
+        sum(e["cpu"] for e in processes.values()),
+        sum(_io(pid) for pid in processes),
+        len(processes),
+    )
+
+
+def snapshot(pgid):
+    """Returns a description of the state of the processes in the group."""
+    processes = group_processes(pgid)
+    if not processes:
+        return "   ... no process information available"
+
+    lines = []
+    for pid, info in sorted(processes.items()):
+        cmdline = (_read("/proc/%d/cmdline" % (pid)) or "").replace("\0", " ").strip()
+        wchan = _read("/proc/%d/wchan" % (pid)) or "?"
+        lines.append(
+            "   ... pid %d (parent %d) state %s waiting in %s: %s"
+            % (pid, info["ppid"], info["state"], wchan or "-", cmdline or info["name"])
+        )
+        stack = _read("/proc/%d/stack" % (pid))
+        if stack:
+            lines += ["       " + e for e in stack.strip().splitlines()]
+    return "\n".join(lines)
+
+
+class Watchdog(object):
+    """
+    ``Watchdog(logfile=None, stall=None, soft=None, hard=None, report=None, interval=None)``
+
+    Supervises a process started in its own process group. logfile is the
+    log the command writes to, stall, soft and hard the timeouts in seconds
+    and report an open file or the name of a file to which warnings are
+    written. After the process ends, outcome is None if the watchdog did not
+    intervene and "stalled" or "timeout" if it terminated the process, with
+    the reason in reason.
+    """
+
+    def __init__(
+        self, logfile=None, stall=None, soft=None, hard=None, report=None, interval=None
+    ):
+        self.logfile = logfile
+        self.stall = stall
+        self.soft = soft
+        self.hard = hard
+        self.report = report
+        if interval is None:
+            limits = [e for e in [stall, soft, hard] if e]
+            interval = min(max(min(limits) / 10.0, 1.0), 60.0) if limits else 60.0
+        self.interval = interval
+        self.outcome = None
+        self.reason = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_environment(cls, command, task=None, **kwargs):
+        """
+        Returns a Watchdog with the timeouts set for the command, or None if
+        no timeout applies to it.
+        """
+        names = [e for e in [task, command_name(command)] if e]
+        timeouts = {
+            kind: parse_timeouts(os.environ.get(variable) or DEFAULTS[kind], names)
+            for kind, variable in ENVIRONMENT.items()
+        }
+        if not any(timeouts.values()):
+            return None
+        return cls(**timeouts, **kwargs)
+
+    def _write(self, message):
+        if self.report is None:
+            return
+        try:
+            if isinstance(self.report, str):
+                with open(self.report, "a") as f:
+                    print(message, file=f)
+            else:
+                print(message, file=self.report)
+                self.report.flush()
+        except (OSError, ValueError):
+            pass
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.pgid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _heartbeat(self):
+        state = [activity(self.pgid)]
+        if self.logfile:
+            try:
+                state.append(os.stat(self.logfile).st_size)
+            except OSError:
+                state.append(None)
+        return state
+
+    def _terminate(self, outcome, reason):
+        self.outcome = outcome
+        self.reason = reason
+        self._write(
+            "\n---> WATCHDOG [%s]: %s, terminating the command\n%s"
+            % (str(datetime.now()).split(".")[0], reason, snapshot(self.pgid))
+        )
+        self._signal(signal.SIGTERM)
+        self._stopped.wait(GRACE)
+        self._signal(signal.SIGKILL)
+
+    def _run(self):
+        started = last = time.time()
+        previous = self._heartbeat()
+        warned = False
+        # without a source of heartbeats stalls can not be detected
+        stall = self.stall if previous != [None] else None
+
+        while not self._stopped.wait(self.interval):
+            now = time.time()
+            current = self._heartbeat()
+            if current != previous:
+                previous, last = current, now
+
+            if self.hard and now - started > self.hard:
+                self._terminate(
+                    "timeout",
+                    "command exceeded the hard timeout of %.0f s" % (self.hard),
+                )
+                return
+            if stall and now - last > stall:
+                self._terminate(
+                    "stalled", "no progress of the command for %.0f s" % (now - last)
+                )
+                return
+            if self.soft and not warned and now - started > self.soft:
+                warned = True
+                self._write(
+                    "\n---> WATCHDOG [%s]: command exceeded the soft timeout of %.0f s\n%s"
+                    % (
+                        str(datetime.now()).split(".")[0],
+                        self.soft,
+                        snapshot(self.pgid),
+                    )
+                )
+
+    def start(self, p):
+        """Starts supervising the process p."""
+        self.pgid = p.pid
+        self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops supervising once the process has ended."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def kill(self):
+        """Kills the whole process group."""
+        self._signal(signal.SIGKILL)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# SPDX-FileCopyrightText: 2021 QuNex development team <https://qunex.yale.edu/>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+"""
+``workers.py``
+
+A shared pool of worker processes for running sessions and elements in
+parallel. The workers are started through a forkserver that has the QuNex
+modules, numpy and nibabel already imported, so a new worker starts warm
+without importing or copying them, and the same workers are reused by all
+parallel steps of a run instead of starting a new pool for each.
+
+Tasks do not carry the full options. set_base registers the options of the
+run; an options dictionary passed to a worker is sent as the differences to
+them, and the base options are stored once in a file that each worker reads
+the first time it needs them. The environment and the working folder of the
+calling process are passed the same way, so the workers follow changes made
+after they were started.
+
+Elements of a task that itself runs in a worker, e.g. the bolds of a session,
+are run on a pool of their own that is forked from the worker and shut down
+as soon as they are done, so that no pool outlives the task that started it.
+
+Functions run in the workers and their arguments have to be picklable, as
+with any ProcessPoolExecutor.
+"""
+
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+import functools
+import threading
+import contextlib
+import multiprocessing
+import multiprocessing.util
+
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# modules imported by the forkserver before it forks workers
+PRELOAD = [
+    "numpy",
+    "nibabel",
+    "general.core",
+    "general.process",
+    "processing.workflow",
+    "hcp.process_hcp",
+]
+
+_executor = None
+_size = 0
+_base = None
+_bases = 0
+_folder = None
+_shared = {}
+_lock = threading.Lock()
+
+# whether this process is a worker of a shared pool
+_worker = False
+
+# objects read from shared files, in the workers
+_cache = {}
+
+# name of the metrics entries with the lock waits of the tasks
+LOCK_METRICS = "file locks"
+
+
+class Shared(object):
+    """A reference to an object stored once in a file for the workers."""
+
+    def __init__(self, key, filename):
+        self.key = key
+        self.filename = filename
+
+    def resolve(self):
+        if self.key not in _cache:
+            with open(self.filename, "rb") as f:
+                _cache[self.key] = pickle.load(f)
+        return _cache[self.key]
+
+
+def _same(a, b):
+    try:
+        return a is b or bool(a == b)
+    except Exception:
+        return False
+
+
+class Delta(object):
+    """An options dictionary sent as its differences to the shared base."""
+
+    def __init__(self, options, base, shared):
+        self.base = shared
+        self.changed = {}
+        for k, v in options.items():
+            if k not in base or not _same(base[k], v):
+                self.changed[k] = v
+        self.removed = [k for k in base if k not in options]
+
+    def resolve(self):
+        base = self.base.resolve()
+        # tasks submitted by the worker are sent relative to the same base
+        if _base is None or _base[0] is not base:
+            set_base(base)
+        options = dict(base)
+        options.update(self.changed)
+        for k in self.removed:
+            del options[k]
+        return options
+
+
+def _share(obj, key):
+    """Stores the object in the shared folder once and returns a reference."""
+    global _folder
+    with _lock:
+        if key not in _shared:
+            if _folder is None:
+                _folder = tempfile.mkdtemp(prefix="qunex-workers-")
+                # unlike atexit, finalizers also run when a worker exits
+                multiprocessing.util.Finalize(
+                    None, _remove, args=(_folder, os.getpid()), exitpriority=0
+                )
+            filename = os.path.join(_folder, key + ".pickle")
+            with open(filename, "wb") as f:
+                pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+            _shared[key] = Shared(key, filename)
+        return _shared[key]
+
+
+def _remove(folder, pid):
+    # forked children inherit the exit handlers of their parent
+    if os.getpid() == pid:
+        shutil.rmtree(folder, True)
+
+
+def set_base(options):
+    """Sets the options that are sent to the workers only once."""
+    global _base, _bases
+    _bases += 1
+    _base = None if options is None else (options, None)
+
+
+def _compact(obj):
+    """Replaces options dictionaries in the arguments by their deltas."""
+    global _base
+    if isinstance(obj, functools.partial):
+        return functools.partial(
+            obj.func,
+            *[_compact(e) for e in obj.args],
+            **{k: _compact(v) for k, v in obj.keywords.items()},
+        )
+    if isinstance(obj, tuple):
+        return tuple(_compact(e) for e in obj)
+    if isinstance(obj, list):
+        return [_compact(e) for e in obj]
+    if isinstance(obj, dict) and _base is not None and "command_ran" in obj:
+        base, shared = _base
+        if shared is None:
+            shared = _share(base, "options-%d" % (_bases))
+            _base = (base, shared)
+        return Delta(obj, base, shared)
+    return obj
+
+
+def _expand(obj):
+    if isinstance(obj, functools.partial):
+        return functools.partial(
+            obj.func,
+            *[_expand(e) for e in obj.args],
+            **{k: _expand(v) for k, v in obj.keywords.items()},
+        )
+    if isinstance(obj, tuple):
+        return tuple(_expand(e) for e in obj)
+    if isinstance(obj, list):
+        return [_expand(e) for e in obj]
+    if isinstance(obj, (Delta, Shared)):
+        return obj.resolve()
+    return obj
+
+
+def _context():
+    """Returns the environment and working folder for the workers."""
+    env = dict(os.environ)
+    key = hashlib.sha1(repr(sorted(env.items())).encode()).hexdigest()
+    return _share(env, "env-" + key), os.getcwd()
+
+
+def _run(context, function, item):
+    """Runs a task in a worker in the context of the calling process."""
+    import general.core as gc
+    import general.filelock as fl
+    import general.fscache as fsc
+
+    global _worker
+    _worker = True
+
+    env, folder = context
+    env = env.resolve()
+    if env != os.environ:
+        os.environ.clear()
+        os.environ.update(env)
+    if folder != os.getcwd():
+        os.chdir(folder)
+
+    # other tasks might have changed the files since the last task
+    fsc.invalidate()
+    before = fl.lock_stats()
+    try:
+        return _expand(function)(_expand(item))
+    finally:
+        # lock waits of the workers are summarized in the final report
+        waits = fl.lock_stats_since(before)
+        if waits["locks"]:
+            gc.record_metrics(LOCK_METRICS, None, 0, waits)
+
+
+def _forkserver_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return None
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PRELOAD)
+    return context
+
+
+def executor(workers):
+    """
+    Returns the shared pool with at least the given number of workers. A
+    larger pool replaces the current one once its tasks are done.
+    """
+    global _executor, _size
+    with _lock:
+        if _executor is None or _size < workers:
+            if _executor is not None:
+                _executor.shutdown(wait=True)
+            else:
+                # stop the pool before its shared folder is removed
+                multiprocessing.util.Finalize(None, shutdown, exitpriority=10)
+            _executor = ProcessPoolExecutor(workers, mp_context=_forkserver_context())
+            _size = workers
+        return _executor
+
+
+def _serial(function, item):
+    """Runs function(item) at once and returns its completed future."""
+    future = Future()
+    try:
+        future.set_result(function(item))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def submit(function, item, workers):
+    """
+    Submits function(item) to the shared pool of at least the given number
+    of workers and returns its future. In a worker, which can not use the
+    shared pool, the task is run at once; use pool to run tasks in parallel
+    there.
+    """
+    if _worker:
+        return _serial(function, item)
+    pool = executor(workers)
+    return pool.submit(_run, _context(), _compact(function), _compact(item))
+
+
+@contextlib.contextmanager
+def pool(workers):
+    """
+    Returns a context with a function that submits function(item) like
+    submit. In a worker the tasks run on a pool of the given number of
+    processes forked from the worker, which is shut down when the context
+    is left, so that no pool outlives the task that started it.
+    """
+    if not _worker:
+        yield lambda function, item: submit(function, item, workers)
+    elif workers < 2:
+        yield _serial
+    else:
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = _forkserver_context()
+        with ProcessPoolExecutor(workers, mp_context=context) as local:
+            yield local.submit
+
+
+def map(function, items, workers):
+    """
+    Runs function on all items, at most workers at a time, and returns the
+    list of results in the order of items.
+    """
+    results = [None] * len(items)
+    pending = list(range(len(items)))
+    running = {}
+    with pool(min(workers, len(items))) as start:
+        while pending or running:
+            while pending and len(running) < workers:
+                n = pending.pop(0)
+                running[start(function, items[n])] = n
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def shutdown():
+    """Stops the shared pool."""
+    global _executor, _size
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+            _size = 0
+
+
+def _forget_workers():
+    # a forked child starts its own pool
+    global _executor, _size, _base, _bases, _folder, _shared, _lock
+    _executor = None
+    _size = 0
+    _base = None
+    _bases = 0
+    _folder = None
+    _shared = {}
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_workers)
@@ -60,12 +60,14 @@ import traceback
 import time
 import json
 import general.core as gc
+import general.fscache as fsc
+import general.admission as ga
+import general.workers as gw
 import processing.core as pc
 import general.img as gi
 import general.exceptions as ge
 import nibabel as nib
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 unwarp = {
@@ -121,23 +123,116 @@ def _get_bold_names(boldinfo, options):
     return printbold, boldtarget, boldsource
 
 
+def _element_images(element, options, hcp):
+    """
+    Returns the BOLD images processed by a parallel element, prepared
+    fMRIVolume data, a single BOLD or a group of BOLDs.
+    """
+    try:
+        if "boldimg" in element:
+            return [element["boldimg"]]
+        bolds = element["bolds"] if "bolds" in element else [element]
+        images = []
+        for boldinfo in bolds:
+            _, boldtarget, _ = _get_bold_names(boldinfo, options)
+            images.append(
+                os.path.join(
+                    hcp["hcp_nonlin"], "Results", boldtarget, "%s.nii.gz" % (boldtarget)
+                )
+            )
+        return images
+    except (TypeError, KeyError):
+        return []
+
+
+def _map_elements(f, elements, parelements, options, hcp):
+    """
+    Runs f on the elements in a pool of parelements processes, longest
+    first by the voxels times frames of their BOLD images. Elements are
+    started only while their estimated memory use fits in the memory budget
+    shared by the sessions running in parallel. Returns the results in the
+    order of elements and a report of the expected and achieved makespan.
+    """
+    images = [_element_images(e, options, hcp) for e in elements]
+    budget = ga.memory_budget(options)
+    estimates = [0] * len(elements)
+    if budget:
+        budget //= max(1, options.get("parsessions", 1))
+        estimates = [
+            ga.estimate_memory(options, options["command_ran"], e) for e in images
+        ]
+    return ga.run_scheduled(
+        f,
+        elements,
+        parelements,
+        options,
+        options["command_ran"] + " element",
+        [ga.image_cost(e) for e in images],
+        estimates=estimates,
+        budget=budget,
+        report=lambda message: print("---> memory budget: " + message),
+    )
+
+
 # -------------------------------------------------------------------
 #
 #                       HCP Pipeline Scripts
 #
 
 
+# options that getHCPPaths resolves paths from
+HCP_PATH_OPTIONS = (
+    "hcp_pipeline",
+    "hcp_suffix",
+    "hcp_folderstructure",
+    "hcp_filename",
+    "hcp_t2",
+    "hcp_avgrdcmethod",
+    "hcp_bold_dcmethod",
+    "fmtail",
+    "sessionsfolder",
+    "hcp_prefs_check",
+    "hcp_fs_check",
+    "hcp_postfs_check",
+    "hcp_bold_vol_check",
+    "hcp_bold_surf_check",
+    "hcp_dwi_check",
+)
+
+
+def _hcp_paths_key(sinfo, options):
+    images = tuple(
+        (k, v.get("name"), v.get("filename")) for k, v in sinfo.items() if k.isdigit()
+    )
+    return (
+        sinfo["id"],
+        sinfo.get("hcp"),
+        images,
+        tuple((e in options, options.get(e)) for e in HCP_PATH_OPTIONS),
+    )
+
+
 def getHCPPaths(sinfo, options):
     """
     getHCPPaths - documentation not yet available.
     """
-    d = {}
-
-    # ---- HCP Pipeline folders
 
     # set location of HCP Pipelines
     options["hcp_pipeline"] = os.environ["HCPPIPEDIR"]
 
+    return _hcpPaths(sinfo, options)
+
+
+@fsc.memoize(_hcp_paths_key)
+def _hcpPaths(sinfo, options):
+    """
+    Resolves the HCP paths of the session, image files are looked up through
+    the shared file system cache.
+    """
+    d = {}
+
+    # ---- HCP Pipeline folders
+
     base = options["hcp_pipeline"]
 
     d["hcp_base"] = base
@@ -193,7 +288,7 @@ def getHCPPaths(sinfo, options):
         filename = T1w.get("filename", None)
         if filename and options["hcp_filename"] == "userdefined":
             d["T1w"] = "@".join(
-                glob.glob(
+                fsc.glob(
                     os.path.join(
                         d["source"], "T1w", sinfo["id"] + "*" + filename + "*.nii.gz"
                     )
@@ -201,7 +296,7 @@ def getHCPPaths(sinfo, options):
             )
         else:
             d["T1w"] = "@".join(
-                glob.glob(
+                fsc.glob(
                     os.path.join(d["source"], "T1w", sinfo["id"] + "*T1w_MPR*.nii.gz")
                 )
             )
@@ -219,7 +314,7 @@ def getHCPPaths(sinfo, options):
             filename = T2w.get("filename", None)
             if filename and options["hcp_filename"] == "userdefined":
                 d["T2w"] = "@".join(
-                    glob.glob(
+                    fsc.glob(
                         os.path.join(
                             d["source"],
                             "T2w",
@@ -229,7 +324,7 @@ def getHCPPaths(sinfo, options):
                 )
             else:
                 d["T2w"] = "@".join(
-                    glob.glob(
+                    fsc.glob(
                         os.path.join(
                             d["source"], "T2w", sinfo["id"] + "_T2w_SPC*.nii.gz"
                         )
@@ -251,7 +346,7 @@ def getHCPPaths(sinfo, options):
             "siemensfieldmap",
             "philipsfieldmap",
         ])):
-            fmapmag = glob.glob(
+            fmapmag = fsc.glob(
                 os.path.join(
                     d["source"],
                     "FieldMap*" + options["fmtail"],
@@ -276,7 +371,7 @@ def getHCPPaths(sinfo, options):
                                 "Too many FM-Magnitude files found!",
                             )
 
-            fmapphase = glob.glob(
+            fmapphase = fsc.glob(
                 os.path.join(
                     d["source"],
                     "FieldMap*" + options["fmtail"],
@@ -293,7 +388,7 @@ def getHCPPaths(sinfo, options):
             (options["hcp_avgrdcmethod"] and (options["hcp_avgrdcmethod"].lower() == "gehealthcarelegacyfieldmap"))
             or (options["hcp_bold_dcmethod"].lower() and (options["hcp_bold_dcmethod"].lower() == "gehealthcarelegacyfieldmap"))
         ):
-            fmapge = glob.glob(
+            fmapge = fsc.glob(
                 os.path.join(
                     d["source"],
                     "FieldMap*" + options["fmtail"],
@@ -307,12 +402,12 @@ def getHCPPaths(sinfo, options):
                     d["fieldmap"].update({fmnum: {"GE": imagepath}})
 
     # B1tx/TB1TFL phase and mag
-    tb1tlf_magnitude = glob.glob(
+    tb1tlf_magnitude = fsc.glob(
         os.path.join(d["source"], "B1", sinfo["id"] + "*_TB1TFL-Magnitude.nii.gz")
     )
     if len(tb1tlf_magnitude) != 0:
         d["TB1TFL-Magnitude"] = tb1tlf_magnitude[0]
-    tb1tlf_phase = glob.glob(
+    tb1tlf_phase = fsc.glob(
         os.path.join(d["source"], "B1", sinfo["id"] + "*_TB1TFL-Phase.nii.gz")
     )
     if len(tb1tlf_phase) != 0:
@@ -2510,8 +2605,6 @@ def hcp_long_freesurfer(sinfo, subjectids, options, overwrite=False, thread=0):
                     report["not ready"].append(run_report["not ready"])
 
         else:  # parallel execution
-            # create a multiprocessing Pool
-            processPoolExecutor = ProcessPoolExecutor(parsubjects)
             # process
             f = partial(
                 _execute_hcp_long_freesurfer,
@@ -2520,7 +2613,7 @@ def hcp_long_freesurfer(sinfo, subjectids, options, overwrite=False, thread=0):
                 run,
                 hcp["hcp_base"],
             )
-            results = processPoolExecutor.map(f, subjects_list)
+            results = gw.map(f, subjects_list, parsubjects)
 
             # merge r and report
             for result in results:
@@ -2992,11 +3085,9 @@ def hcp_long_post_freesurfer(sinfo, subjectids, options, overwrite=False, thread
                 if run_report["not ready"]:
                     report["not ready"].append(run_report["not ready"])
         else:  # parallel execution
-            # create a multiprocessing Pool
-            processPoolExecutor = ProcessPoolExecutor(parsubjects)
             # process
             f = partial(_execute_hcp_long_post_freesurfer, options, overwrite, run, hcp)
-            results = processPoolExecutor.map(f, subjects_list)
+            results = gw.map(f, subjects_list, parsubjects)
 
             # merge
             for result in results:
@@ -5450,12 +5541,12 @@ def executeMultipleHCPfMRIVolume(sinfo, options, overwrite, hcp, boldsData, r, r
     # parelements
     parelements = max(1, min(options["parelements"], len(boldsData)))
 
-    # create a multiprocessing Pool
-    processPoolExecutor = ProcessPoolExecutor(parelements)
-
     # partial function
     f = partial(executeHCPfMRIVolume, sinfo, options, overwrite, hcp)
-    results = processPoolExecutor.map(f, boldsData)
+
+    # run in a memory-aware process pool
+    results, schedule = _map_elements(f, boldsData, parelements, options, hcp)
+    r += schedule
 
     # merge r and report
     for result in results:
@@ -6018,11 +6109,11 @@ def hcp_fmri_surface(sinfo, options, overwrite=False, thread=0):
                 report["skipped"] += tempReport["skipped"]
 
         else:  # parallel execution
-            # create a multiprocessing Pool
-            processPoolExecutor = ProcessPoolExecutor(parelements)
+            # run in a memory-aware process pool
             # process
             f = partial(executeHCPfMRISurface, sinfo, options, overwrite, hcp, run)
-            results = processPoolExecutor.map(f, bolds)
+            results, schedule = _map_elements(f, bolds, parelements, options, hcp)
+            r += schedule
 
             # merge r and report
             for result in results:
@@ -6744,11 +6835,13 @@ def hcp_icafix(sinfo, options, overwrite=False, thread=0):
                     report["skipped"] += tempReport["skipped"]
 
             else:  # parallel execution
-                # create a multiprocessing Pool
-                processPoolExecutor = ProcessPoolExecutor(parelements)
+                # run in a memory-aware process pool
                 # process
                 f = partial(executeHCPSingleICAFix, sinfo, options, overwrite, hcp, run)
-                results = processPoolExecutor.map(f, icafixBolds)
+                results, schedule = _map_elements(
+                    f, icafixBolds, parelements, options, hcp
+                )
+                r += schedule
 
                 # merge r and report
                 for result in results:
@@ -6783,11 +6876,13 @@ def hcp_icafix(sinfo, options, overwrite=False, thread=0):
                     report["skipped"] += tempReport["skipped"]
 
             else:  # parallel execution
-                # create a multiprocessing Pool
-                processPoolExecutor = ProcessPoolExecutor(parelements)
+                # run in a memory-aware process pool
                 # process
                 f = partial(executeHCPMultiICAFix, sinfo, options, overwrite, hcp, run)
-                results = processPoolExecutor.map(f, icafixGroups)
+                results, schedule = _map_elements(
+                    f, icafixGroups, parelements, options, hcp
+                )
+                r += schedule
 
                 # merge r and report
                 for result in results:
@@ -7514,13 +7609,11 @@ def hcp_post_fix(sinfo, options, overwrite=False, thread=0):
                 report["skipped"] += tempReport["skipped"]
 
         else:  # parallel execution
-            # create a multiprocessing Pool
-            processPoolExecutor = ProcessPoolExecutor(parelements)
             # process
             f = partial(
                 executeHCPPostFix, sinfo, options, overwrite, hcp, run, singleFix
             )
-            results = processPoolExecutor.map(f, icafixBolds)
+            results = gw.map(f, icafixBolds, parelements)
 
             # merge r and report
             for result in results:
@@ -7992,11 +8085,13 @@ def hcp_reapply_fix(sinfo, options, overwrite=False, thread=0):
                     report["skipped"] += tempReport["skipped"]
 
             else:  # parallel execution
-                # create a multiprocessing Pool
-                processPoolExecutor = ProcessPoolExecutor(parelements)
+                # run in a memory-aware process pool
                 # process
                 f = partial(executeHCPSingleReApplyFix, sinfo, options, hcp, run)
-                results = processPoolExecutor.map(f, icafixBolds)
+                results, schedule = _map_elements(
+                    f, icafixBolds, parelements, options, hcp
+                )
+                r += schedule
 
                 # merge r and report
                 for result in results:
@@ -8029,11 +8124,13 @@ def hcp_reapply_fix(sinfo, options, overwrite=False, thread=0):
                     report["skipped"] += tempReport["skipped"]
 
             else:  # parallel execution
-                # create a multiprocessing Pool
-                processPoolExecutor = ProcessPoolExecutor(parelements)
+                # run in a memory-aware process pool
                 # process
                 f = partial(executeHCPMultiReApplyFix, sinfo, options, hcp, run)
-                results = processPoolExecutor.map(f, icafixGroups)
+                results, schedule = _map_elements(
+                    f, icafixGroups, parelements, options, hcp
+                )
+                r += schedule
 
                 # merge r and report
                 for result in results:
@@ -12598,13 +12695,11 @@ def hcp_apply_auto_reclean(sinfo, options, overwrite=False, thread=0):
                 report["skipped"] += temp_report["skipped"]
 
         else:  # parallel execution
-            # create a multiprocessing Pool
-            ppe = ProcessPoolExecutor(parelements)
             # process
             f = partial(
                 execute_hcp_apply_auto_reclean, sinfo, options, overwrite, hcp, run
             )
-            results = ppe.map(f, icafix_groups)
+            results = gw.map(f, icafix_groups, parelements)
 
             # merge r and report
             for result in results:
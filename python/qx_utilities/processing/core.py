@@ -24,14 +24,19 @@ import os
 import os.path
 import shutil
 import re
-import subprocess
-import glob
 import sys
 import traceback
 import multiprocessing
+import time
 from datetime import datetime
 import general.exceptions as ge
 import general.core as gc
+import general.fscache as fsc
+import general.provenance as gpv
+import general.logscan as gls
+import general.watchdog as gwd
+import general.engine as gen
+import general.retry as grt
 from general.img import *
 from general.meltmovfidl import *
 
@@ -87,6 +92,14 @@ class ExternalFailed(Exception):
         return self.parameter  # repr(self.parameter)
 
 
+class ExternalStalled(ExternalFailed):
+    """Raised when an external command was terminated by its watchdog."""
+
+    def __init__(self, value="Got lost :-(", status="stalled"):
+        self.parameter = value
+        self.status = status
+
+
 class NoSourceFolder(Exception):
     def __init__(self, value="Got lost :-("):
         self.parameter = value
@@ -220,7 +233,7 @@ def doOptionsCheck(options, sinfo, command):
 
 
 def getExactFile(candidate):
-    g = glob.glob(candidate)
+    g = fsc.glob(candidate)
     if len(g) == 1:
         return g[0]
     elif len(g) > 1:
@@ -332,53 +345,49 @@ def getFileNames(sinfo, options):
     if options["image_target"] == "4dfp":
         # ---> BET & FAST
 
-        if os.path.exists(f["m111_brain"]) and not os.path.exists(f["t1_brain"]):
+        if fsc.exists(f["m111_brain"]) and not fsc.exists(f["t1_brain"]):
             gc.link_or_copy(f["m111_brain"], f["t1_brain"])
 
-        if os.path.exists(f["m111_seg"]) and not os.path.exists(f["t1_seg"]):
+        if fsc.exists(f["m111_seg"]) and not fsc.exists(f["t1_seg"]):
             gc.link_or_copy(f["m111_seg"], f["t1_seg"])
 
         # ---> FreeSurfer
 
-        if os.path.exists(f["fs_aseg_111"]) and not os.path.exists(f["fs_aseg_t1"]):
+        if fsc.exists(f["fs_aseg_111"]) and not fsc.exists(f["fs_aseg_t1"]):
             gc.link_or_copy(f["fs_aseg_111"], f["fs_aseg_t1"])
-        if os.path.exists(
-            f["fs_aseg_111"].replace(".img", ".ifh")
-        ) and not os.path.exists(f["fs_aseg_t1"].replace(".img", ".ifh")):
+        if fsc.exists(f["fs_aseg_111"].replace(".img", ".ifh")) and not fsc.exists(
+            f["fs_aseg_t1"].replace(".img", ".ifh")
+        ):
             gc.link_or_copy(
                 f["fs_aseg_111"].replace(".img", ".ifh"),
                 f["fs_aseg_t1"].replace(".img", ".ifh"),
             )
 
-        if os.path.exists(f["fs_aseg_333"]) and not os.path.exists(f["fs_aseg_bold"]):
+        if fsc.exists(f["fs_aseg_333"]) and not fsc.exists(f["fs_aseg_bold"]):
             gc.link_or_copy(f["fs_aseg_333"], f["fs_aseg_bold"])
-        if os.path.exists(
-            f["fs_aseg_333"].replace(".img", ".ifh")
-        ) and not os.path.exists(f["fs_aseg_bold"].replace(".img", ".ifh")):
+        if fsc.exists(f["fs_aseg_333"].replace(".img", ".ifh")) and not fsc.exists(
+            f["fs_aseg_bold"].replace(".img", ".ifh")
+        ):
             gc.link_or_copy(
                 f["fs_aseg_333"].replace(".img", ".ifh"),
                 f["fs_aseg_bold"].replace(".img", ".ifh"),
             )
 
-        if os.path.exists(f["fs_aparc+aseg_111"]) and not os.path.exists(
-            f["fs_aparc_t1"]
-        ):
+        if fsc.exists(f["fs_aparc+aseg_111"]) and not fsc.exists(f["fs_aparc_t1"]):
             gc.link_or_copy(f["fs_aparc+aseg_111"], f["fs_aparc_t1"])
-        if os.path.exists(
+        if fsc.exists(
             f["fs_aparc+aseg_111"].replace(".img", ".ifh")
-        ) and not os.path.exists(f["fs_aparc_t1"].replace(".img", ".ifh")):
+        ) and not fsc.exists(f["fs_aparc_t1"].replace(".img", ".ifh")):
             gc.link_or_copy(
                 f["fs_aparc+aseg_111"].replace(".img", ".ifh"),
                 f["fs_aparc_t1"].replace(".img", ".ifh"),
             )
 
-        if os.path.exists(f["fs_aparc+aseg_333"]) and not os.path.exists(
-            f["fs_aparc_bold"]
-        ):
+        if fsc.exists(f["fs_aparc+aseg_333"]) and not fsc.exists(f["fs_aparc_bold"]):
             gc.link_or_copy(f["fs_aparc+aseg_333"], f["fs_aparc_bold"])
-        if os.path.exists(
+        if fsc.exists(
             f["fs_aparc+aseg_333"].replace(".img", ".ifh")
-        ) and not os.path.exists(f["fs_aparc_bold"].replace(".img", ".ifh")):
+        ) and not fsc.exists(f["fs_aparc_bold"].replace(".img", ".ifh")):
             gc.link_or_copy(
                 f["fs_aparc+aseg_333"].replace(".img", ".ifh"),
                 f["fs_aparc_bold"].replace(".img", ".ifh"),
@@ -387,6 +396,55 @@ def getFileNames(sinfo, options):
     return f
 
 
+# options that getSessionFolders and getBOLDFileNames resolve paths from
+SESSION_FOLDER_OPTIONS = (
+    "image_source",
+    "hcp_suffix",
+    "sessionsfolder",
+    "img_suffix",
+    "bold_variant",
+)
+
+BOLD_FILE_OPTIONS = SESSION_FOLDER_OPTIONS + (
+    "image_target",
+    "cifti_tail",
+    "nifti_tail",
+    "bold_tail",
+    "bold_nuisance",
+    "boldname",
+    "path_bold",
+    "path_mov",
+    "event_file",
+    "bold_prefix",
+    "qx_nifti_tail",
+    "qx_cifti_tail",
+    "bold_actions",
+    "glm_name",
+)
+
+
+def _session_key(sinfo):
+    return (sinfo["id"], sinfo.get("hcp"), sinfo.get("data"))
+
+
+def _options_key(options, names):
+    # missing options are keyed apart from options set to None
+    return tuple((e in options, options.get(e)) for e in names)
+
+
+def _bold_key(sinfo, boldname, options):
+    movname = boldname.replace(options["boldname"], "mov")
+    return (
+        _session_key(sinfo),
+        boldname,
+        _options_key(
+            options,
+            BOLD_FILE_OPTIONS + ("path_" + boldname, "path_" + movname),
+        ),
+    )
+
+
+@fsc.memoize(_bold_key)
 def getBOLDFileNames(sinfo, boldname, options):
     """
     getBOLDFileNames - documentation not yet available.
@@ -610,34 +668,40 @@ def findFile(sinfo, options, fname):
     d = getSessionFolders(sinfo, options)
 
     tfile = os.path.join(d["inbox"], "%s_%s" % (sinfo["id"], fname))
-    if os.path.exists(tfile):
+    if fsc.exists(tfile):
         return tfile
 
     if any([e in fname for e in ["conc", "fidl"]]):
         tfile = os.path.join(d["inbox"], "events", "%s_%s" % (sinfo["id"], fname))
-        if os.path.exists(tfile):
+        if fsc.exists(tfile):
             return tfile
 
     if any([e in fname for e in ["conc"]]):
         tfile = os.path.join(d["inbox"], "concs", "%s_%s" % (sinfo["id"], fname))
-        if os.path.exists(tfile):
+        if fsc.exists(tfile):
             return tfile
 
     if d["s_source"] is not None:
         tfile = os.path.join(d["s_source"], fname)
-        if os.path.exists(tfile):
+        if fsc.exists(tfile):
             return tfile
 
         tfile = os.path.join(d["s_source"], "%s_%s" % (sinfo["id"], fname))
-        if os.path.exists(tfile):
+        if fsc.exists(tfile):
             return tfile
 
     return False
 
 
-def getSessionFolders(sinfo, options):
+@fsc.memoize(
+    lambda sinfo, options: (
+        _session_key(sinfo),
+        _options_key(options, SESSION_FOLDER_OPTIONS),
+    )
+)
+def _sessionFolders(sinfo, options):
     """
-    getSessionFolders - documentation not yet available.
+    Resolves the session folder paths without touching the file system.
     """
     d = {"s_source": None}
 
@@ -673,16 +737,25 @@ def getSessionFolders(sinfo, options):
         d["qc"], "movement" + options["img_suffix"] + options["bold_variant"]
     )
 
+    return d
+
+
+def getSessionFolders(sinfo, options):
+    """
+    getSessionFolders - documentation not yet available.
+    """
+    d = _sessionFolders(sinfo, options)
+
     folder_creation_lock = multiprocessing.Lock()
 
     for key, fpath in d.items():
         if key != "s_source":
-            if not os.path.exists(fpath):
+            if not fsc.exists(fpath):
                 try:
                     with folder_creation_lock:
                         # Check again inside the lock to ensure no other process created the folder
                         if not os.path.exists(fpath):
-                            os.makedirs(fpath)
+                            fsc.makedirs(fpath)
                 except:
                     print(
                         f"ERROR: Could not create folder {fpath}! Please check paths and permissions!"
@@ -711,12 +784,15 @@ def checkRun(
     logFile=None,
     verbose=True,
     overwrite=False,
+    scanner=None,
 ):
     """
-    ``checkRun(tfile, fullTest=None, command=None, r="", logFile=None, verbose=True, overwrite=False)``
+    ``checkRun(tfile, fullTest=None, command=None, r="", logFile=None, verbose=True, overwrite=False, scanner=None)``
 
     The function checks the presence of a test file.
-    If specified it runs also full test.
+    If specified it runs also full test. Without a test file the log is
+    checked for errors, using the results of a LogScanner that already
+    scanned it if one is given.
 
     OUTPUTS
     =======
@@ -740,24 +816,27 @@ def checkRun(
 
         if fullTest:
             try:
+                checkstart = time.time()
                 filestatus, filespresent, filesmissing = gc.checkFiles(
                     fullTest["tfolder"],
                     fullTest["tfile"],
                     fields=fullTest["fields"],
                     report=logFile,
                 )
+                checktime = time.time() - checkstart
                 if filesmissing:
                     if verbose:
                         r += missingReport(
                             filesmissing,
-                            "\n---> Full file check revealed that the following files were not created:",
+                            "\n---> Full file check [%.2f s] revealed that the following files were not created:"
+                            % (checktime),
                             "            ",
                         )
                     report += ", full file check incomplete"
                     passed = "incomplete"
                     failed = 1
                 else:
-                    r += "\n---> Full file check passed"
+                    r += "\n---> Full file check passed [%.2f s]" % (checktime)
                     report += ", full file check complete"
 
             except ge.CommandFailed as e:
@@ -776,16 +855,13 @@ def checkRun(
         failed = 0
 
         # check log contents for errors
-        if logFile is not None:
-            log = open(logFile, "r")
-            lines = log.readlines()
-
-            for line in lines:
-                if any(err in line for err in ["Error ", "Error:", "ERROR ", "ERROR:"]):
-                    report = "%s not finished" % (command)
-                    passed = None
-                    failed = 1
-                    break
+        if scanner is None and logFile is not None:
+            scanner = gls.scan_file(logFile)
+
+        if scanner is not None and scanner.matched:
+            report = "%s not finished" % (command)
+            passed = None
+            failed = 1
 
     else:
         if verbose and tfile is not None:
@@ -842,13 +918,27 @@ def runExternalForFile(
     shell=False,
     r="",
     verbose=True,
+    inputs=None,
 ):
     """
-    ``runExternalForFile(checkfile, run, description, overwrite=False, thread="0", remove=True, task=None, logfolder="", logtags="", fullTest=None, shell=False, r="", verbose=True)``
+    ``runExternalForFile(checkfile, run, description, overwrite=False, thread="0", remove=True, task=None, logfolder="", logtags="", fullTest=None, shell=False, r="", verbose=True, inputs=None)``
 
     Runs the specified command and checks whether it was executed against a
     checkfile, and if provided a full list of files as specified in fullTest.
 
+    When the command completes, a provenance record of the command and the
+    state of its input files is saved for the checkfile (see
+    general/provenance.py). An existing checkfile is only accepted as done if
+    its record matches, otherwise the command is run again. Checkfiles
+    without a record are accepted as before.
+
+    The command runs under a watchdog (see general/watchdog.py) that
+    terminates it when it stalls or exceeds its hard timeout, in which case
+    the log is saved as stalled_* or timeout_* and ExternalStalled is raised.
+    Attempts that fail for transient reasons are retried after a delay as
+    set by the retry policy of the command (see general/retry.py), and
+    every attempt is listed in the report.
+
     INPUTS
     ======
 
@@ -875,6 +965,9 @@ def runExternalForFile(
 
     --shell            Whether to run the command in a shell (boolean).
     --r                A string to which to append the report.
+    --inputs           A list of additional input files to record in the
+                       provenance of the checkfile, besides those named in
+                       the command.
 
     OUTPUTS
     =======
@@ -912,8 +1005,17 @@ def runExternalForFile(
     # add an empty line for log purposes
     printComm += "\n"
 
-    if overwrite or checkfile is None or not os.path.exists(checkfile):
+    # --- check whether existing results are up to date
+    outdated = None
+    if not overwrite and checkfile is not None and os.path.exists(checkfile):
+        outdated = gpv.check(checkfile, run, inputs)
+
+    if overwrite or outdated or checkfile is None or not os.path.exists(checkfile):
         r += "\n\n%s" % (description)
+        if outdated:
+            r += "\n---> previous results are out of date (%s), rerunning" % (
+                "; ".join(outdated)
+            )
 
         # --- set up parameters
         basestring = (str, bytes)
@@ -961,10 +1063,72 @@ def runExternalForFile(
             print(printComm, file=nf)
             nf.flush()
 
-            if shell:
-                ret = subprocess.call(run, shell=True, stdout=nf, stderr=nf)
-            else:
-                ret = subprocess.call(run.split(), stdout=nf, stderr=nf)
+            # record the inputs before they can be changed
+            gpv.remove(checkfile)
+            provenance = gpv.snapshot(run, checkfile, inputs)
+
+            policy = grt.RetryPolicy.from_environment(run, task=task)
+            while True:
+                # supervise the command and scan its output as it is logged
+                watchdog = gwd.Watchdog.from_environment(
+                    run, task=task, logfile=tmplogfile, report=nf
+                )
+                scanner = gls.LogScanner()
+                transient = policy.scanner()
+                started = time.time()
+                result = gen.call(
+                    run if shell else run.split(),
+                    shell=shell,
+                    log=tmplogfile,
+                    name=task or description,
+                    output=gls.feeder(scanner, transient),
+                    watchdog=watchdog,
+                )
+                scanner.finish()
+                transient.finish()
+                ret, usage, stalled = (
+                    result["exit"],
+                    result["usage"],
+                    result["stalled"],
+                )
+
+                # the external command might have changed any file
+                fsc.invalidate()
+
+                print("\n" + gc.format_usage(usage), file=nf)
+                retry = policy.retry(ret, stalled, transient)
+                gc.record_metrics(
+                    task or description,
+                    run,
+                    ret,
+                    usage,
+                    log=logname,
+                    tags=logtags,
+                    stalled=stalled,
+                    attempt=len(policy.attempts) + (0 if retry else 1),
+                    retry=retry[0] if retry else None,
+                )
+                if not retry:
+                    break
+
+                # --- retry transient failures after a delay
+                reason, delay = retry
+                removed = grt.cleanup(checkfile, fullTest, started)
+                message = "\n---> Attempt %d failed transiently (%s), " % (
+                    len(policy.attempts),
+                    reason,
+                )
+                if removed:
+                    message += "removed %d partial outputs, " % (len(removed))
+                message += "retrying in %.0f s\n" % (delay)
+                print(message, file=nf)
+                nf.flush()
+                print(message)
+                time.sleep(delay)
+                fsc.invalidate()
+
+            if policy.attempts:
+                r += "\n" + policy.summary()
 
         except:
             r += "\n\nERROR: Running external command failed! \nTry running the command directly for more detailed error information:\n"
@@ -973,6 +1137,15 @@ def runExternalForFile(
             raise ExternalFailed(r)
 
         # --- check results
+        if stalled:
+            r += "\n\nERROR: %s was terminated, %s\n... \ncommand executed:\n" % (
+                description,
+                watchdog.reason,
+            )
+            r += comm
+            endlog, r = closeLog(nf, tmplogfile, logfolders, stalled, remove, r)
+            raise ExternalStalled(r, stalled)
+
         if ret:
             r += "\n\nERROR: %s failed with error %s\n... \ncommand executed:\n" % (
                 description,
@@ -989,14 +1162,18 @@ def runExternalForFile(
             r=r,
             logFile=tmplogfile,
             verbose=verbose,
+            scanner=scanner,
         )
 
         if status is None:
+            if scanner.matched:
+                r += "\n\nErrors reported in the log:\n" + scanner.summary()
             r += "\n\nTry running the command directly for more detailed error information:\n"
             r += comm
 
         # --- End
         if status and status == "done":
+            gpv.save(checkfile, run, provenance)
             print("\n\n---> Successful completion of task\n", file=nf)
             endlog, r = closeLog(nf, tmplogfile, logfolders, "done", remove, r)
         else:
@@ -1021,6 +1198,7 @@ def runExternalForFile(
                 fullTest=fullTest,
                 shell=shell,
                 r=r,
+                inputs=inputs,
             )
         else:
             status, _, _, failed = checkRun(checkfile, fullTest)
@@ -1071,8 +1249,32 @@ def runScriptThroughShell(
         file=nf,
     )
 
-    ret = subprocess.call(run, shell=True, stdout=nf, stderr=nf)
-    if ret:
+    nf.flush()
+    watchdog = gwd.Watchdog.from_environment(
+        run, task=task, logfile=tmplogfile, report=nf
+    )
+    result = gen.call(
+        run, shell=True, log=tmplogfile, name=task or description, watchdog=watchdog
+    )
+    ret, usage, stalled = result["exit"], result["usage"], result["stalled"]
+    fsc.invalidate()
+    print("\n" + gc.format_usage(usage), file=nf)
+    gc.record_metrics(
+        task or description,
+        run,
+        ret,
+        usage,
+        log=logname,
+        tags=logtags,
+        stalled=stalled,
+    )
+    if stalled:
+        r += "\n\nERROR: Terminated, %s\n" % (watchdog.reason)
+        nf.close()
+        endlog = os.path.join(logfolder, "%s_%s.log" % (stalled, logname))
+        shutil.move(tmplogfile, endlog)
+        raise ExternalStalled(r, stalled)
+    elif ret:
         r += "\n\nERROR: Failed with error %s\n" % (ret)
         nf.close()
         shutil.move(tmplogfile, errlogfile)
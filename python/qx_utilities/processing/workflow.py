@@ -37,7 +37,6 @@ import re
 import traceback
 import time
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import processing.core as pc
@@ -46,6 +45,7 @@ import general.filelock as fl
 import general.meltmovfidl as gm
 import general.img as gi
 import general.core as gc
+import general.workers as gw
 
 if "QUNEXMCOMMAND" not in os.environ:
     print(
@@ -327,11 +327,9 @@ def create_bold_brain_masks(sinfo, options, overwrite=False, thread=0):
             report["boldfail"] += tempReport["boldfail"]
             report["boldmissing"] += tempReport["boldmissing"]
     else:  # parallel execution
-        # create a multiprocessing Pool
-        processPoolExecutor = ProcessPoolExecutor(parelements)
         # process
         f = partial(executeCreateBOLDBrainMasks, sinfo, options, overwrite)
-        results = processPoolExecutor.map(f, bolds)
+        results = gw.map(f, bolds, parelements)
 
         # merge r and report
         for result in results:
@@ -909,11 +907,9 @@ def compute_bold_stats(sinfo, options, overwrite=False, thread=0):
             report["boldfail"] += tempReport["boldfail"]
             report["boldmissing"] += tempReport["boldmissing"]
     else:  # parallel execution
-        # create a multiprocessing Pool
-        processPoolExecutor = ProcessPoolExecutor(parelements)
         # process
         f = partial(executeComputeBOLDStats, sinfo, options, overwrite)
-        results = processPoolExecutor.map(f, bolds)
+        results = gw.map(f, bolds, parelements)
 
         # merge r and report
         for result in results:
@@ -1802,11 +1798,9 @@ def extract_nuisance_signal(sinfo, options, overwrite=False, thread=0):
             report["boldfail"] += tempReport["boldfail"]
             report["boldmissing"] += tempReport["boldmissing"]
     else:  # parallel execution
-        # create a multiprocessing Pool
-        processPoolExecutor = ProcessPoolExecutor(parelements)
         # process
         f = partial(executeExtractNuisanceSignal, sinfo, options, overwrite)
-        results = processPoolExecutor.map(f, bolds)
+        results = gw.map(f, bolds, parelements)
 
         # merge r and report
         for result in results:
@@ -2462,11 +2456,9 @@ def preprocess_bold(sinfo, options, overwrite=False, thread=0):
             report["ready"] += tempReport["ready"]
             report["not ready"] += tempReport["not ready"]
     else:  # parallel execution
-        # create a multiprocessing Pool
-        processPoolExecutor = ProcessPoolExecutor(parelements)
         # process
         f = partial(executePreprocessBold, sinfo, options, overwrite)
-        results = processPoolExecutor.map(f, bolds)
+        results = gw.map(f, bolds, parelements)
 
         # merge r and report
         for result in results:
@@ -0,0 +1,123 @@
+import json
+import os
+import time
+
+import general.admission as ga
+
+
+def _interval(n):
+    start = time.time()
+    time.sleep(0.2)
+    return n, start, time.time()
+
+
+def test_parse_memory():
+    """Memory sizes are parsed with binary units"""
+    assert ga.parse_memory("64G") == 64 * 1024**3
+    assert ga.parse_memory("1500m") == 1500 * 1024**2
+    assert ga.parse_memory("2.5GB") == int(2.5 * 1024**3)
+    assert ga.parse_memory(1000) == 1000
+    assert ga.memory_budget({"memory_budget": "none"}) is None
+    assert ga.memory_budget({"memory_budget": "8G"}) == 8 * 1024**3
+
+
+def test_map_admitted_respects_budget():
+    """Items run concurrently only while their estimates fit in the budget"""
+    completed = []
+    results = ga.map_admitted(
+        _interval,
+        list(range(4)),
+        4,
+        10,
+        [6, 4, 7, 20],
+        callback=lambda n, result: completed.append(n),
+    )
+    assert [e[0] for e in results] == [0, 1, 2, 3]
+    assert sorted(completed) == [0, 1, 2, 3]
+
+    def overlap(a, b):
+        return results[a][1] < results[b][2] and results[b][1] < results[a][2]
+
+    assert overlap(0, 1)
+    assert not overlap(0, 2) and not overlap(1, 2)
+    assert not any(overlap(3, n) for n in range(3))
+
+
+def test_estimate_from_history(tmp_path):
+    """Estimates use the largest max RSS recorded for the task"""
+    with open(tmp_path / "Metrics-hcp_icafix-1.jsonl", "w") as f:
+        for name, maxrss in [
+            ("hcp_icafix", 1000),
+            ("hcp_icafix", 3000),
+            ("other", 9000),
+        ]:
+            print(json.dumps({"name": name, "maxrss": maxrss}), file=f)
+    options = {"runlogs": str(tmp_path)}
+    assert ga.estimate_memory(options, "hcp_icafix") == 3000 * 1024
+    assert ga.estimate_memory(options, "hcp_msmall") == 0
+    assert ga.estimate_memory({}, "hcp_icafix", [os.devnull]) == 0
+
+
+def test_estimate_from_images(tmp_path):
+    """Estimates scale with the in-memory size of the input images"""
+    import nibabel as nib
+    import numpy as np
+
+    image = str(tmp_path / "bold.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((10, 10, 10, 5), dtype="f4"), np.eye(4)), image)
+    assert ga.estimate_memory({}, "hcp_fmri_volume", [image]) == (
+        5000 * 4 * ga.IMAGE_MEMORY_FACTOR
+    )
+
+
+def test_lpt_makespan():
+    """Longest-first ordering shortens the makespan of a skewed queue"""
+    times = [1, 1, 1, 1, 4]
+    order = ga.lpt_order(times)
+    assert order[0] == 4
+    assert ga.makespan(times, 2) == 6
+    assert ga.makespan(times, 2, order) == 4
+
+
+def test_run_scheduled(tmp_path, monkeypatch):
+    """Items are submitted longest first and their run times calibrate later runs"""
+    metrics = tmp_path / "Metrics-test-1.jsonl"
+    monkeypatch.setenv("QUNEXMETRICS", str(metrics))
+    options = {"runlogs": str(tmp_path)}
+
+    results, summary = ga.run_scheduled(
+        _interval, [0, 1, 2], 1, options, "test element", [1, 3, 2]
+    )
+    assert [e[0] for e in results] == [0, 1, 2]
+    assert results[1][1] < results[2][1] < results[0][1]
+    assert "expected makespan" not in summary and "achieved makespan" in summary
+
+    assert ga.runtime_rate(str(tmp_path), "test element") > 0
+    _, summary = ga.run_scheduled(_interval, [0, 1], 2, options, "test element", [1, 1])
+    assert "expected makespan" in summary
+
+
+def test_pack_balances_loads():
+    """Packing longest first balances the loads of the bins"""
+    groups, loads = ga.pack([5, 4, 3, 3, 3], 2)
+    assert sorted(loads) == [8, 10]
+    assert sorted(n for group in groups for n in group) == [0, 1, 2, 3, 4]
+    groups, loads = ga.pack([1], 3)
+    assert loads == [1, 0, 0] and groups == [[0], [], []]
+
+
+def test_expected_times(tmp_path):
+    """Image sizes weight the costs and recorded durations set the rate"""
+    import nibabel as nib
+    import numpy as np
+
+    small, large = str(tmp_path / "small.nii.gz"), str(tmp_path / "large.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4, 2), dtype="f4"), np.eye(4)), small)
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4, 6), dtype="f4"), np.eye(4)), large)
+    costs = ga.relative_costs([1, 1, 3], [[small], [large], []])
+    assert costs == [0.5, 1.5, 3]
+
+    assert ga.expected_times(costs, [None] * 3) == (costs, False)
+    times, seconds = ga.expected_times(costs, [None, 30, None])
+    assert seconds and times == [10, 30, 60]
+    assert ga.expected_times(costs, [None] * 3, rate=2)[0] == [1, 3, 6]
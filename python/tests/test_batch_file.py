@@ -0,0 +1,96 @@
+import json
+import os
+
+from general.core import read_session_data, read_session_index, read_session_subset
+
+BATCH = """# Generated by QuNex
+_hcp_processing_mode : HCPStyleData
+--parsessions: 2
+
+---
+session: S001
+subject: S001
+01: T1w
+02: bold1:rest
+
+---
+session: S002
+subject: S002
+01: T1w
+"""
+
+
+def test_read_session_data(tmp_path):
+    """Batch files are parsed into sessions and global parameters"""
+    batch = tmp_path / "batch.txt"
+    batch.write_text(BATCH)
+
+    sessions, gpref = read_session_data(str(batch), cache=False)
+    assert gpref == {"hcp_processing_mode": "HCPStyleData", "parsessions": "2"}
+    assert [s["id"] for s in sessions] == ["S001", "S002"]
+    assert sessions[0]["02"]["name"] == "bold1"
+    assert sessions[0]["02"]["task"] == "rest"
+    assert not (tmp_path / ".batch.txt.qxcache").exists()
+
+
+def test_batch_cache_is_invalidated(tmp_path):
+    """The compiled batch cache is reused and rebuilt when the file changes"""
+    batch = tmp_path / "batch.txt"
+    batch.write_text(BATCH)
+
+    first = read_session_data(str(batch), cache=True)
+    assert (tmp_path / ".batch.txt.qxcache").exists()
+    json.loads((tmp_path / ".batch.txt.qxcache").read_text())
+    assert read_session_data(str(batch), cache=True) == first
+
+    batch.write_text(BATCH.replace("S002", "S003"))
+    os.utime(batch, ns=(0, 0))
+    sessions, _ = read_session_data(str(batch), cache=True)
+    assert [s["id"] for s in sessions] == ["S001", "S003"]
+
+
+def test_read_session_subset(tmp_path):
+    """Only the indexed blocks of the requested sessions are parsed"""
+    batch = tmp_path / "batch.txt"
+    batch.write_text(BATCH)
+
+    index = read_session_index(str(batch))
+    assert [e[2] for e in index] == [[], ["S001"], ["S002"]]
+
+    sessions, gpref = read_session_subset(str(batch), ["S002"])
+    full, full_gpref = read_session_data(str(batch), cache=False)
+    assert sessions == [full[1]]
+    assert gpref == full_gpref
+
+
+def test_session_index_cache(tmp_path):
+    """The index of large batch files is cached as JSON and reused"""
+    batch = tmp_path / "batch.txt"
+    block = "\n---\nsession: S%04d\nsubject: S%04d\n01: T1w\n" + "# padding\n" * 10
+    batch.write_text(BATCH + "".join(block % (n, n) for n in range(3, 700)))
+
+    index = read_session_index(str(batch))
+    cached = json.loads((tmp_path / ".batch.txt.qxindex").read_text())
+    assert cached[1] == index and read_session_index(str(batch)) == index
+
+    sessions, _ = read_session_subset(str(batch), ["S0500"])
+    assert [s["id"] for s in sessions] == ["S0500"]
+
+
+def test_session_index_mismatch(tmp_path):
+    """A saved index that no longer matches the batch file is rebuilt"""
+    batch = tmp_path / "batch.txt"
+    block = "\n---\nsession: S%04d\nsubject: S%04d\n01: T1w\n" + "# padding\n" * 10
+    batch.write_text(BATCH + "".join(block % (n, n) for n in range(3, 700)))
+    read_session_index(str(batch))
+    stat = batch.stat()
+
+    # swap two sessions without changing the size or modification time
+    content = batch.read_text()
+    content = content.replace("S0500", "SXXXX").replace("S0501", "S0500")
+    batch.write_text(content.replace("SXXXX", "S0501"))
+    os.utime(batch, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    sessions, _ = read_session_subset(str(batch), ["S0500"])
+    assert [s["id"] for s in sessions] == ["S0500"]
+    assert sessions[0]["subject"] == "S0500"
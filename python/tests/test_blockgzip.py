@@ -0,0 +1,41 @@
+import gzip
+import os
+
+import general.blockgzip as bgz
+
+
+def test_block_gzip_is_standard_gzip(tmp_path):
+    """Multi-member block gzip output can be read by the gzip module"""
+    data = os.urandom(1000) * 300 + bytes(100000)
+    filename = str(tmp_path / "data.gz")
+    with bgz.BlockGzipWriter(filename, level=1, threads=3, blocksize=65536) as f:
+        f.write(data[:12345])
+        f.write(data[12345:])
+
+    with gzip.open(filename, "rb") as f:
+        assert f.read() == data
+
+
+def test_block_gzip_random_access(tmp_path):
+    """The reader indexes members and reads from arbitrary offsets"""
+    data = os.urandom(200000)
+    filename = str(tmp_path / "data.gz")
+    with bgz.BlockGzipWriter(filename, threads=2, blocksize=50000) as f:
+        f.write(data)
+
+    with bgz.open_gzip(filename) as f:
+        assert isinstance(f, bgz.BlockGzipReader)
+        assert len(f.index) == 4
+        assert f.pread(49990, 20) == data[49990:50010]
+        f.seek(150000)
+        assert f.read() == data[150000:]
+
+
+def test_open_gzip_falls_back_to_gzip(tmp_path):
+    """Regular gzip files are opened with the gzip module"""
+    filename = str(tmp_path / "data.gz")
+    with gzip.open(filename, "wb") as f:
+        f.write(b"qunex")
+
+    with bgz.open_gzip(filename) as f:
+        assert f.read() == b"qunex"
@@ -0,0 +1,47 @@
+import os
+
+import general.core as gc
+
+SPEC = """# full file check spec
+{sessionid} T1w T1w.nii.gz
+{sessionid} T1w T2w.nii.gz | {sessionid} T1w T2w_acpc.nii.gz
+{sessionid} MNINonLinear Results {sessionid}_bold.nii.gz
+{sessionid} MNINonLinear link.nii.gz
+"""
+
+
+def test_check_files(tmp_path):
+    """Full file check reports present and missing files and alternatives"""
+    spec = tmp_path / "spec.txt"
+    spec.write_text(SPEC)
+
+    session = tmp_path / "hcp" / "s01"
+    (session / "T1w").mkdir(parents=True)
+    (session / "T1w" / "T1w.nii.gz").write_text("")
+    (session / "T1w" / "T2w_acpc.nii.gz").write_text("")
+    (session / "MNINonLinear").mkdir()
+    os.symlink(str(session / "missing"), str(session / "MNINonLinear" / "link.nii.gz"))
+
+    report = tmp_path / "report.txt"
+    status, present, missing = gc.checkFiles(
+        str(tmp_path / "hcp"),
+        str(spec),
+        fields=[("sessionid", "s01")],
+        report=str(report),
+    )
+    assert not status
+    assert present == [
+        str(session / "T1w" / "T1w.nii.gz"),
+        str(session / "T1w" / "T2w_acpc.nii.gz"),
+    ]
+    assert missing == [
+        str(session / "MNINonLinear" / "Results" / "s01_bold.nii.gz"),
+        str(session / "MNINonLinear" / "link.nii.gz"),
+    ]
+    assert "# Checked 4 files" in report.read_text()
+
+    # the compiled spec is reused for other sessions
+    status, present, missing = gc.checkFiles(
+        str(tmp_path / "hcp"), str(spec), fields=[("sessionid", "s02")]
+    )
+    assert len(missing) == 4
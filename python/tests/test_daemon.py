@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+import pytest
+
+import general.daemon as gd
+import general.exceptions as ge
+
+GMRI = os.path.join(os.path.dirname(gd.__file__), "..", "gmri")
+
+
+def test_daemon_runs_commands(tmp_path, monkeypatch, capfd):
+    """Commands forwarded to the daemon give the same output as direct calls"""
+    socketpath = str(tmp_path / "gmri.sock")
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(sys.path),
+        QUNEXMCOMMAND="matlab",
+        QUNEXDAEMONSOCKET=socketpath,
+    )
+    env.pop("QUNEXDAEMON", None)
+
+    direct = subprocess.run(
+        [sys.executable, GMRI, "-available"], env=env, capture_output=True, text=True
+    ).stdout
+
+    daemon = subprocess.Popen(
+        [sys.executable, GMRI, "gmri_daemon", "--action=run", "--idle=60"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(300):
+            if os.path.exists(socketpath):
+                break
+            time.sleep(0.1)
+
+        for key in ["PYTHONPATH", "QUNEXMCOMMAND", "QUNEXDAEMONSOCKET"]:
+            monkeypatch.setenv(key, env[key])
+        capfd.readouterr()
+        assert gd.client(["-available"]) == 0
+        assert capfd.readouterr().out == direct
+
+        env["QUNEXDAEMON"] = "yes"
+        failed = subprocess.run(
+            [sys.executable, GMRI, "no_such_command"],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert failed.returncode == 1
+        assert "not recognized" in failed.stdout
+    finally:
+        daemon.terminate()
+        daemon.wait(30)
+    assert not os.path.exists(socketpath)
+
+
+def test_daemon_socket_is_private(tmp_path):
+    """The daemon is only used through a private folder and by the same user"""
+    folder = tmp_path / "shared"
+    folder.mkdir(mode=0o755)
+    folder.chmod(0o755)
+    socketpath = str(folder / "gmri.sock")
+    assert "accessible to other users" in gd._private_folder(socketpath)
+    with pytest.raises(ge.CommandFailed):
+        gd._make_folder(socketpath)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketpath)
+    server.listen(1)
+    with server:
+        assert gd.client(["-available"], socketpath) is None
+
+    link = tmp_path / "link"
+    link.symlink_to(folder)
+    assert "not a directory" in gd._private_folder(str(link / "gmri.sock"))
+
+    private = tmp_path / "private"
+    gd._make_folder(str(private / "gmri.sock"))
+    assert oct(private.stat().st_mode & 0o777) == "0o700"
+
+    a, b = socket.socketpair()
+    with a, b:
+        assert gd._peer_uid(a) == os.getuid()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+
+import pytest
+import concurrent.futures
+
+import general.engine as gen
+import general.watchdog as gwd
+
+
+def test_output_and_usage(tmp_path):
+    """Output is streamed to the log and the output function"""
+    log = tmp_path / "command.log"
+    blocks = []
+    result = gen.call(
+        [
+            sys.executable,
+            "-c",
+            "import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)",
+        ],
+        log=str(log),
+        header=lambda: "header\n",
+        output=blocks.append,
+    )
+    assert result["exit"] == 3
+    assert result["usage"]["maxrss"] > 0
+    assert log.read_text().split() == ["header", "out", "err"]
+    assert b"".join(blocks).split() == [b"out", b"err"]
+
+
+def test_bounded_concurrency():
+    """No more than the given number of commands run at once"""
+    with gen.ProcessEngine(2) as engine:
+        started = time.time()
+        futures = [engine.submit(["sleep", "0.4"], name=n) for n in range(4)]
+        results = [f.result() for f in futures]
+    assert [r["name"] for r in results] == [0, 1, 2, 3]
+    assert 0.8 <= time.time() - started < 5
+
+
+def _dead(pid):
+    """Returns whether the process is gone or a zombie."""
+    try:
+        with open("/proc/%d/stat" % (pid)) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except OSError:
+        return True
+
+
+def test_cancel_kills_group(tmp_path):
+    """Cancelling a supervised command kills its children and waiting ones never start"""
+    marker = tmp_path / "child.pid"
+    script = (
+        "import subprocess, time; "
+        "p = subprocess.Popen(['sleep', '60']); "
+        "open(%r, 'w').write(str(p.pid)); time.sleep(60)" % (str(marker))
+    )
+    with gen.ProcessEngine(1) as engine:
+        running = engine.submit(
+            [sys.executable, "-c", script], watchdog=gwd.Watchdog(hard=600)
+        )
+        waiting = engine.submit(["sleep", "60"])
+        while not marker.exists() or not marker.read_text():
+            time.sleep(0.05)
+        engine.cancel(waiting)
+        engine.cancel(running)
+        for future in [running, waiting]:
+            with pytest.raises(concurrent.futures.CancelledError):
+                future.result()
+
+    time.sleep(0.2)
+    assert _dead(int(marker.read_text()))
+
+
+def test_cancel_nested_engine(tmp_path):
+    """A cancelled QuNex command stops the commands of its own engine"""
+    marker = tmp_path / "child.pid"
+    script = (
+        "import general.engine as gen; "
+        "gen.call(['sleep', '60'], started=lambda p: open(%r, 'w').write(str(p.pid)))"
+        % (str(marker))
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    with gen.ProcessEngine() as engine:
+        running = engine.submit([sys.executable, "-c", script], env=env)
+        while not marker.exists() or not marker.read_text():
+            time.sleep(0.05)
+        assert os.getpgid(int(marker.read_text())) == os.getpgid(0)
+        started = time.time()
+        engine.cancel(running)
+        assert time.time() - started < gwd.GRACE
+
+    time.sleep(0.2)
+    assert _dead(int(marker.read_text()))
+
+
+def test_start_failure():
+    """A command that can not be started fails its future"""
+    with gen.ProcessEngine() as engine:
+        future = engine.submit([os.path.join(os.sep, "nonexistent", "command")])
+        with pytest.raises(FileNotFoundError):
+            future.result()
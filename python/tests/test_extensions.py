@@ -0,0 +1,50 @@
+import os
+import sys
+import subprocess
+
+EXTENSION = '''
+from general.extensions import qx
+
+@qx()
+def ext_hello(name="x"):
+    """Says hello."""
+    return "hello " + name
+
+commands = {"ext_plain": {"com": ext_hello, "args": ("name",)}}
+'''
+
+CHECK = """
+import sys
+import general.extensions as ge
+print("myext" in sys.modules)
+print(ge.commands["ext_hello"]["com"](name="bob"), ge.compile_dict("commands")["ext_plain"]["args"])
+print("myext" in sys.modules)
+"""
+
+
+def _run(path):
+    env = dict(
+        os.environ, QXEXTENSIONSPY=str(path), PYTHONPATH=os.pathsep.join(sys.path)
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.splitlines()
+
+
+def test_extension_discovery_is_cached(tmp_path):
+    """Cached extension modules are imported only when their commands run"""
+    (tmp_path / "qx_modules").write_text("myext\n")
+    (tmp_path / "myext.py").write_text(EXTENSION)
+
+    assert _run(tmp_path) == ["True", "hello bob ('name',)", "True"]
+    assert (tmp_path / ".qx_modules.cache.json").exists()
+    assert _run(tmp_path) == ["False", "hello bob ('name',)", "True"]
+
+    # changing the module invalidates the cache
+    (tmp_path / "myext.py").write_text(EXTENSION + "\nfunctions = {}\n")
+    assert _run(tmp_path)[0] == "True"
@@ -0,0 +1,135 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import general.filelock as fl
+import general.inotify as inotify
+
+
+def _append(filename, n):
+    for i in range(n):
+        fl.safe_write("%d %d\n" % (os.getpid(), i), filename)
+
+
+def test_safe_write_concurrent(tmp_path):
+    """Concurrent appends through safe_write are neither lost nor interleaved"""
+    filename = str(tmp_path / "log.txt")
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=_append, args=(filename, 50)) for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 200
+    assert all(len(line.split()) == 2 for line in lines)
+    assert not os.path.exists(filename + ".lock")
+
+
+def _hold(filename, locked, release):
+    fl.lock(filename, identifier="holder")
+    locked.set()
+    release.wait(10)
+    fl.unlock(filename)
+
+
+@pytest.mark.parametrize("fallback", [False, True])
+def test_lock_timeout(tmp_path, fallback):
+    """Waiting for a held lock times out and reports its owner"""
+    filename = str(tmp_path / "batch.txt")
+    if fallback:
+        fl.nolock_folders.add(str(tmp_path))
+
+    ctx = multiprocessing.get_context("fork")
+    locked, release = ctx.Event(), ctx.Event()
+    holder = ctx.Process(target=_hold, args=(filename, locked, release))
+    holder.start()
+    try:
+        assert locked.wait(10)
+        assert fl.owner(filename)["pid"] == holder.pid
+
+        timeouts = fl.lock_stats()["timeouts"]
+        with pytest.raises(fl.LockTimeout, match="holder"):
+            fl.lock(filename, delay=0.05, timeout=0.2)
+        assert fl.lock_stats()["timeouts"] == timeouts + 1
+    finally:
+        release.set()
+        holder.join()
+        fl.nolock_folders.discard(str(tmp_path))
+
+    assert fl.lock(filename, timeout=5) < 5
+    assert fl.lock(filename) == 0.0
+    fl.unlock(filename)
+    assert os.path.exists(filename + ".lock")
+    fl.unlock(filename)
+    assert not os.path.exists(filename + ".lock")
+
+
+def _wait(filename, start, results):
+    start.wait(10)
+    results.put((fl.wait_status(filename, "done", delay=5), time.time()))
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_wait_status_many_waiters(tmp_path, monkeypatch, use_inotify):
+    """Concurrent waiters wake up shortly after the status is written"""
+    if not use_inotify:
+        monkeypatch.setattr(inotify, "available", False)
+    elif not inotify.available:
+        pytest.skip("inotify is not available")
+
+    filename = str(tmp_path / "status")
+    assert fl.open_status(filename, "Processing started\n") is None
+    fl.statuses.remove(filename)
+
+    ctx = multiprocessing.get_context("fork")
+    start, results = ctx.Event(), ctx.Queue()
+    waiters = [
+        ctx.Process(target=_wait, args=(filename, start, results)) for _ in range(16)
+    ]
+    for p in waiters:
+        p.start()
+    start.set()
+    time.sleep(1)
+
+    written = time.time()
+    fl.write_status(filename, "done\n", mode="a")
+    woken = [results.get(timeout=10) for _ in waiters]
+    for p in waiters:
+        p.join()
+
+    assert all(status == "done" for status, _ in woken)
+    latency = max(t for _, t in woken) - written
+    assert latency < (0.25 if use_inotify else 6)
+
+
+def test_lock_report(tmp_path):
+    """Lock waits of the workers and of the run are summarized"""
+    import json
+
+    import general.process as gp
+    import general.workers as gw
+
+    metrics = tmp_path / "Metrics.jsonl"
+    entry = {
+        "name": gw.LOCK_METRICS,
+        "locks": 3,
+        "wait": 1.5,
+        "max_wait": 1.0,
+        "timeouts": 1,
+    }
+    metrics.write_text(json.dumps(entry) + "\n" + json.dumps({"name": "bet"}) + "\n")
+
+    before = fl.lock_stats()
+    fl.lock(str(tmp_path / "a"))
+    fl.unlock(str(tmp_path / "a"))
+    waits = fl.lock_stats_since(before)
+    assert waits["locks"] == 1 and waits["timeouts"] == 0
+
+    line = gp.lock_report(str(metrics), waits)
+    assert "4 taken" in line and "1 timeouts" in line
+    assert gp.lock_report(str(tmp_path / "missing.jsonl")) is None
@@ -0,0 +1,61 @@
+import glob
+import os
+
+import general.fscache as fsc
+
+
+def _tree(tmp_path):
+    for name in ["a.nii.gz", "b.nii.gz", ".hidden.nii.gz", "c.txt"]:
+        (tmp_path / name).write_text("")
+    for folder in ["BOLD_1", "BOLD_2"]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "bold.nii.gz").write_text("")
+    (tmp_path / "BOLD_3").write_text("")
+    os.symlink(str(tmp_path / "missing"), str(tmp_path / "broken.nii.gz"))
+
+
+def test_glob_matches_glob(tmp_path):
+    """Cached glob returns the same paths as glob.glob"""
+    _tree(tmp_path)
+    listing = fsc.DirectoryListing()
+    for pattern in [
+        "*.nii.gz",
+        ".*",
+        "BOLD_*/bold.nii.gz",
+        "BOLD_*/",
+        "BOLD_[12]/*",
+        "c.txt",
+        "missing/*",
+    ]:
+        pattern = os.path.join(str(tmp_path), pattern)
+        assert sorted(listing.glob(pattern)) == sorted(glob.glob(pattern))
+    assert listing.exists(str(tmp_path / "a.nii.gz"))
+    assert not listing.exists(str(tmp_path / "broken.nii.gz"))
+    assert listing.lexists(str(tmp_path / "broken.nii.gz"))
+    assert not listing.isdir(str(tmp_path / "BOLD_3"))
+
+
+def test_invalidate(tmp_path):
+    """Invalidation drops cached listings and memoized results"""
+    calls = []
+
+    @fsc.memoize(lambda folder: folder)
+    def resolve(folder):
+        calls.append(folder)
+        return {"files": fsc.glob(os.path.join(folder, "*"))}
+
+    folder = str(tmp_path)
+    assert resolve(folder) == {"files": []}
+    resolve(folder)["files"].append("changed")
+    assert resolve(folder) == {"files": []}
+    assert len(calls) == 1
+
+    (tmp_path / "a").write_text("")
+    assert not fsc.exists(str(tmp_path / "a"))
+
+    fsc.makedirs(str(tmp_path / "b" / "c"))
+    assert fsc.isdir(str(tmp_path / "b" / "c"))
+    files = sorted(resolve(folder)["files"])
+    assert files == [str(tmp_path / "a"), str(tmp_path / "b")]
+    assert len(calls) == 2
+    fsc.invalidate()
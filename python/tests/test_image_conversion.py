@@ -0,0 +1,76 @@
+import gzip
+
+import numpy as np
+
+import general.img as gi
+
+
+def _write_nifti(filename, data, e="<"):
+    """Writes a float32 NIfTI image with data in (frames, z, y, x) order"""
+    hdr = gi.niftihdr()
+    hdr.e = e
+    hdr.frames, hdr.sizez, hdr.sizey, hdr.sizex = data.shape
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "wb") as f:
+        f.write(hdr.packHdr())
+        f.write(data.astype(np.dtype(e + "f4")).tobytes())
+
+
+def _read_nifti(filename):
+    _, hdr, _, _, offset = gi.readImageHeader(filename)
+    with gi.openImage(filename) as f:
+        f.seek(offset)
+        data = np.frombuffer(f.read(), dtype=np.dtype(hdr.e + hdr.dType))
+    return data.reshape(hdr.frames, hdr.sizez, hdr.sizey, hdr.sizex)
+
+
+def test_convert_nifti_4dfp_roundtrip(tmp_path):
+    """Converting NIfTI to 4dfp flips y and converting back restores the data"""
+    data = np.random.rand(3, 4, 5, 6).astype("f4")
+    source = str(tmp_path / "bold.nii.gz")
+    _write_nifti(source, data)
+
+    target = gi.convert_image(source, str(tmp_path / "bold.nii.gz"), tform=".4dfp.img")
+    assert target == str(tmp_path / "bold.4dfp.img")
+    assert (tmp_path / "bold.4dfp.ifh").exists()
+
+    raw = np.fromfile(target, dtype="<f4").reshape(data.shape)
+    assert np.array_equal(raw, data[:, :, ::-1, :])
+
+    back = gi.convert_image(target, str(tmp_path / "back.nii"))
+    assert np.array_equal(_read_nifti(back), data)
+
+
+def test_convert_nifti_copies_payload(tmp_path):
+    """Uncompressed NIfTI to NIfTI conversion keeps the payload unchanged"""
+    data = np.random.rand(2, 3, 4, 5).astype("f4")
+    source = str(tmp_path / "a.nii")
+    _write_nifti(source, data, e=">")
+
+    target = gi.convert_image(source, str(tmp_path / "b.nii"))
+    with open(source, "rb") as s, open(target, "rb") as t:
+        assert s.read() == t.read()
+
+
+def test_parse_frames():
+    """Frame specifications resolve to 0-based frame indices"""
+    assert gi.parseFrames(3, 10) == [0, 1, 2]
+    assert gi.parseFrames("2-4,8-", 10) == [1, 2, 3, 7, 8, 9]
+    assert gi.parseFrames("1,", 10) == [0]
+
+
+def test_extract_frames_with_scrub(tmp_path):
+    """Frames marked for exclusion in the .scrub file are removed"""
+    data = np.random.rand(6, 2, 3, 4).astype("f4")
+    source = str(tmp_path / "bold1.nii.gz")
+    _write_nifti(source, data)
+
+    (tmp_path / "movement").mkdir()
+    with open(tmp_path / "movement" / "bold1.scrub", "w") as f:
+        print("frame mov dvars dvarsme idvars idvarsme udvars udvarsme", file=f)
+        for n, bad in enumerate([0, 1, 0, 0, 1, 0]):
+            print("%d 0 0 0 0 0 0 %d" % (n + 1, bad), file=f)
+
+    target = str(tmp_path / "bold1_scrubbed.nii")
+    assert gi.extractFrames(source, target, "scrub") == 4
+    assert np.array_equal(_read_nifti(target), data[[0, 2, 3, 5]])
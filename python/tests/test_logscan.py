@@ -0,0 +1,38 @@
+import general.logscan as gls
+
+
+def test_scanner_blocks():
+    """Matches are found across block boundaries, once per line"""
+    text = b"start\nfirst Error: one\nok\nERROR: two ERROR: again\n" + b"x" * 10
+    text += b"\nlast Error without newline"
+    scanner = gls.LogScanner(keep=1)
+    found = []
+    for n in range(0, len(text), 3):
+        found += [m[1] for m in scanner.feed(text[n : n + 3])]
+    found += [m[1] for m in scanner.finish()]
+    assert found == [
+        "first Error: one",
+        "ERROR: two ERROR: again",
+        "last Error without newline",
+    ]
+    assert scanner.count == 3
+    assert scanner.first == [("Error:", "first Error: one")]
+    assert list(scanner.last) == [("Error ", "last Error without newline")]
+    assert scanner.summary().split("\n") == [
+        "first Error: one",
+        "...",
+        "last Error without newline",
+    ]
+
+
+def test_scan_file_incremental(tmp_path):
+    """Only bytes appended since the last scan are read"""
+    log = tmp_path / "log.txt"
+    log.write_bytes(b"line\nan Err")
+    scanner = gls.LogScanner()
+    assert scanner.scan_file(str(log)) == []
+    with open(str(log), "ab") as f:
+        f.write(b"or here\nclean\n")
+    assert [m[1] for m in scanner.scan_file(str(log))] == ["an Error here"]
+    assert scanner.offset == log.stat().st_size
+    assert not gls.scan_file(str(tmp_path / "log.txt"), ["FATAL"]).matched
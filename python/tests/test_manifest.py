@@ -0,0 +1,65 @@
+import os
+import sys
+import subprocess
+
+import general.manifest as gmf
+
+GMRI = os.path.join(os.path.dirname(gmf.__file__), "..", "gmri")
+
+
+def test_manifest_lists_all_commands():
+    """The manifest holds every gmri command, processing action and matlab function"""
+    from general import commands as gcom
+    from general import process as gp
+    from general import matlab as gm
+
+    manifest = gmf.load_manifest()
+    assert set(manifest) == set(gcom.commands) | set(gp.allactions) | set(gm.functions)
+    assert manifest["create_study"]["class"] == "gmri"
+    assert manifest["hcp_pre_freesurfer"]["class"] == "process"
+    assert (
+        gmf.resolve_command("create_study")["com"]
+        is gcom.commands["create_study"]["com"]
+    )
+
+
+def test_gmri_available_is_lazy():
+    """Listing commands through gmri does not import the command modules"""
+    gmf.load_manifest()
+    script = (
+        "import sys, runpy\n"
+        "sys.argv = ['gmri', '-available']\n"
+        "runpy.run_path(%r, run_name='__main__')\n"
+        "print(sorted(m for m in ['general.process', 'general.commands', 'general.dicom'] if m in sys.modules))\n"
+    ) % GMRI
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    lines = output.strip().splitlines()
+    assert "create_study" in lines[-2].split()
+    assert lines[-1] == "[]"
+
+
+def test_manifest_tracks_command_modules(tmp_path):
+    """The stored manifest is stale once a module behind a command changes"""
+    import json
+
+    gmf.load_manifest(rebuild=True)
+    for filename in gmf._manifest_files():
+        if os.path.exists(filename):
+            with open(filename) as f:
+                sources = [e[0] for e in json.load(f)["sources"]]
+            break
+    assert any(e.endswith(os.path.join("general", "img.py")) for e in sources)
+
+    module = tmp_path / "module.py"
+    module.write_text("x = 1\n")
+    sources = [gmf._stat_key(str(module))]
+    assert gmf._current(sources)
+    module.write_text("x = 22\n")
+    assert not gmf._current(sources)
@@ -0,0 +1,54 @@
+import os
+
+import processing.core as pc
+
+
+def _environment(tmp_path, monkeypatch):
+    (tmp_path / "tools" / "qunex").mkdir(parents=True)
+    (tmp_path / "tools" / "qunex" / "VERSION.md").write_text("1.0")
+    monkeypatch.setenv("TOOLS", str(tmp_path / "tools"))
+    monkeypatch.setenv("QUNEXREPO", "qunex")
+
+
+def _run(tmp_path, command):
+    source = tmp_path / "source.txt"
+    target = tmp_path / "target.txt"
+    r, _, status, failed = pc.runExternalForFile(
+        str(target),
+        command % (source, target),
+        "Copying",
+        task="copy",
+        logfolder=str(tmp_path / "logs"),
+    )
+    return r
+
+
+def test_rerun_on_changed_inputs(tmp_path, monkeypatch, capsys):
+    """Existing results are recomputed only when the command or inputs change"""
+    _environment(tmp_path, monkeypatch)
+    source = tmp_path / "source.txt"
+    source.write_text("x" * 200)
+    command = "cp %s %s"
+
+    assert "already completed" not in _run(tmp_path, command)
+    assert "already completed" in _run(tmp_path, command)
+
+    source.write_text("y" * 300)
+    r = _run(tmp_path, command)
+    assert "input changed: %s" % (source) in r
+    assert (tmp_path / "target.txt").read_text() == "y" * 300
+    assert "already completed" in _run(tmp_path, command)
+
+    r = _run(tmp_path, "cp -p %s %s")
+    assert "command or parameters changed" in r
+    assert "already completed" in _run(tmp_path, "cp -p %s %s")
+
+
+def test_results_without_record_are_kept(tmp_path, monkeypatch, capsys):
+    """Checkfiles produced without a provenance record are accepted as before"""
+    _environment(tmp_path, monkeypatch)
+    (tmp_path / "source.txt").write_text("x" * 200)
+    (tmp_path / "target.txt").write_text("z" * 200)
+    assert "already completed" in _run(tmp_path, "cp %s %s")
+    assert (tmp_path / "target.txt").read_text() == "z" * 200
+    assert not os.path.exists(tmp_path / ".qunex_provenance")
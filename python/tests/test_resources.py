@@ -0,0 +1,39 @@
+import json
+import sys
+
+import general.core as gc
+
+
+def test_call_process_reports_usage(tmp_path):
+    """Resource usage of an external command includes its memory and CPU time"""
+    script = "x = bytearray(64 * 1024 * 1024); sum(range(2000000))"
+    ret, usage = gc.call_process([sys.executable, "-c", script])
+    assert ret == 0
+    assert usage["maxrss"] > 64 * 1024
+    assert usage["user"] + usage["system"] > 0
+    assert usage["wall"] > 0
+    assert "max RSS" in gc.format_usage(usage)
+
+    ret, _ = gc.call_process("exit 3", shell=True)
+    assert ret == 3
+
+
+def test_parallel_metrics(tmp_path, monkeypatch, capsys):
+    """runExternalParallel appends a usage footer and records run metrics"""
+    metrics = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("QUNEXMETRICS", str(metrics))
+    calls = [
+        {
+            "name": "call %d" % n,
+            "args": ["true"],
+            "sout": str(tmp_path / ("%d.log" % n)),
+        }
+        for n in range(3)
+    ]
+    completed = gc.runExternalParallel(calls, cores=2)
+
+    assert [e["exit"] for e in completed] == [0, 0, 0]
+    assert "Resources used" in (tmp_path / "0.log").read_text()
+    entries = [json.loads(e) for e in metrics.read_text().splitlines()]
+    assert sorted(e["name"] for e in entries) == ["call 0", "call 1", "call 2"]
+    assert all("maxrss" in e and "wall" in e for e in entries)
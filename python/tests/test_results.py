@@ -0,0 +1,71 @@
+import os
+import subprocess
+
+import general.results as grs
+
+
+def test_parse_status():
+    """Counts and log paths are read from session reports"""
+    counts = grs.parse_counts("BOLDS done:  2, missing data:  0, failed:  1")
+    assert counts == {"bolds_done": 2, "missing_data": 0, "failed": 1}
+    r = "...\n---> logfile: /logs/done_bet.log\n---> logfile: /logs/error_x.log\n"
+    assert grs.parse_logs(r) == ["/logs/done_bet.log", "/logs/error_x.log"]
+
+
+def test_stream_and_summary(tmp_path, capsys):
+    """Session results are streamed as they complete and summarized per run"""
+    filename = str(tmp_path / "Results-test-1.jsonl")
+    stream = grs.ResultStream(filename, "test-1", "test")
+    stream.start(["s1", "s2", "s3"])
+    stream.record("", ("s1", "BOLDS done: 1, failed: 0", 0), 10.0, 25.0)
+    stream.record("", ("s2", "BOLDS done: 0, failed: 1", 1))
+
+    entries = grs.read_results([filename])
+    assert entries[1]["duration"] == 15.0 and entries[1]["counts"]["bolds_done"] == 1
+    (run,) = grs.summarize(entries)
+    assert run["state"] == "running" and run["total"] == 3
+    assert run["sessions"]["done"] == ["s1"] and run["sessions"]["failed"] == ["s2"]
+
+    stream.finish()
+    (run,) = grs.query_results(logfolder=str(tmp_path), details="yes")
+    assert run["state"] == "finished" and run["status"] == "failed"
+    assert "failed: s2" in capsys.readouterr().out
+
+
+def test_interrupted_run(tmp_path):
+    """Unfinished runs whose process is gone are reported as interrupted"""
+    filename = str(tmp_path / "Results-test-2.jsonl")
+    stream = grs.ResultStream(filename, "test-2", "test")
+    stream.start(["s1"])
+    p = subprocess.Popen(["true"])
+    p.wait()
+    entries = grs.read_results([filename])
+    entries[0]["pid"] = p.pid
+    (run,) = grs.summarize(entries)
+    assert run["state"] == "interrupted"
+
+
+def test_runs_on_other_hosts(tmp_path, monkeypatch):
+    """Unfinished runs on other hosts are checked by their job or their age"""
+    squeue = tmp_path / "squeue"
+    squeue.write_text('#!/bin/sh\n[ "$3" = 11 ] && echo RUNNING\n')
+    squeue.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("SLURM_JOB_ID", "12")
+
+    filename = str(tmp_path / "Results-test-3.jsonl")
+    grs.ResultStream(filename, "test-3", "test").start(["s1"])
+    (entry,) = grs.read_results([filename])
+    assert entry["scheduler"] == "SLURM" and entry["job"] == "12"
+
+    entry["host"] = "elsewhere"
+    (run,) = grs.summarize([entry])
+    assert run["state"] == "interrupted"
+    (run,) = grs.summarize([dict(entry, job="11")])
+    assert run["state"] == "running"
+
+    old = dict(entry, scheduler=None, job=None, time="2000-01-01 00:00:00")
+    (run,) = grs.summarize([old], stale=3600)
+    assert run["state"] == "stale"
+    (run,) = grs.summarize([old])
+    assert run["state"] == "running"
@@ -0,0 +1,127 @@
+import os
+import time
+
+import general.logscan as gls
+import general.retry as grt
+import processing.core as pc
+
+
+def _scanner(text):
+    scanner = grt.RetryPolicy().scanner()
+    scanner.feed(text.encode())
+    scanner.finish()
+    return scanner
+
+
+def test_classify():
+    """Only failures with transient causes are classified as transient"""
+    policy = grt.RetryPolicy(retries=2)
+    quiet = _scanner("done\n")
+    assert policy.classify(0, None, _scanner("Stale file handle\n")) is None
+    assert policy.classify(1, None, quiet) is None
+    assert policy.classify(75, None, quiet) == "exit code 75"
+    assert policy.classify(-15, "stalled", quiet) is None
+    assert grt.RetryPolicy(1, stalled=True).classify(-15, "stalled", quiet) == "stalled"
+    assert policy.classify(-15, "timeout", _scanner("Stale file handle\n")) is None
+    reason = policy.classify(1, None, _scanner("open: Stale file handle\n"))
+    assert "Stale file handle" in reason
+
+
+def test_error_lines_are_scanned_for_transient_markers():
+    """Lines with error markers are also checked for transient failures"""
+    policy = grt.RetryPolicy(retries=1)
+    scanner = gls.LogScanner()
+    transient = policy.scanner()
+    feed = gls.feeder(scanner, transient)
+    feed(b"ERROR: could not write out.nii: Stale ")
+    feed(b"file handle\n")
+    scanner.finish()
+    transient.finish()
+    assert scanner.matched and transient.matched
+    assert "Stale file handle" in policy.retry(1, None, transient)[0]
+
+
+def test_extra_patterns(monkeypatch):
+    """Additional markers are read from the environment"""
+    monkeypatch.setenv(grt.ENVIRONMENT["patterns"], "Out of licenses|Busy")
+    policy = grt.RetryPolicy(retries=1)
+    assert policy.classify(1, None, _scanner("Error: Out of licenses\n"))
+
+
+def test_policy_from_environment(monkeypatch):
+    """Budgets and delays are looked up by task and executable"""
+    monkeypatch.setenv(grt.ENVIRONMENT["retries"], "matlab:3|bet:none|1")
+    monkeypatch.setenv(grt.ENVIRONMENT["delay"], "5m")
+    assert grt.RetryPolicy.from_environment("matlab -r x").retries == 3
+    assert grt.RetryPolicy.from_environment("/usr/bin/bet a b").retries == 0
+    policy = grt.RetryPolicy.from_environment("fslmaths a", task="other")
+    assert policy.retries == 1 and policy.delay == 300
+
+
+def test_budget_and_backoff():
+    """Retries stop with the budget and their delays grow up to the cap"""
+    policy = grt.RetryPolicy(retries=2, delay=600)
+    first = policy.retry(75, None, None)
+    second = policy.retry(75, None, None)
+    assert first and second and policy.retry(75, None, None) is None
+    assert 480 <= first[1] <= 720
+    assert second[1] <= grt.MAX_DELAY * 1.2
+    assert len(policy.attempts) == 2 and "attempt 2" in policy.summary()
+
+
+def test_cleanup_removes_new_outputs(tmp_path):
+    """Only outputs written by the failed attempt are removed"""
+    (tmp_path / "old.txt").write_text("old")
+    past = time.time() - 100
+    os.utime(tmp_path / "old.txt", (past, past))
+    spec = tmp_path / "check.txt"
+    spec.write_text("old.txt\nnew.txt\n")
+    started = time.time() - 1
+    (tmp_path / "new.txt").write_text("partial")
+    (tmp_path / "done.txt").write_text("done")
+
+    test = {"tfile": str(spec), "tfolder": str(tmp_path), "fields": []}
+    removed = grt.cleanup(str(tmp_path / "done.txt"), test, started)
+    assert sorted(os.path.basename(e) for e in removed) == ["done.txt", "new.txt"]
+    assert (tmp_path / "old.txt").exists()
+
+
+def test_transient_failure_is_retried(tmp_path, monkeypatch, capsys):
+    """A command failing transiently once succeeds on its retry"""
+    (tmp_path / "tools" / "qunex").mkdir(parents=True)
+    (tmp_path / "tools" / "qunex" / "VERSION.md").write_text("1.0")
+    monkeypatch.setenv("TOOLS", str(tmp_path / "tools"))
+    monkeypatch.setenv("QUNEXREPO", "qunex")
+    monkeypatch.setenv(grt.ENVIRONMENT["retries"], "1")
+    monkeypatch.setenv(grt.ENVIRONMENT["delay"], "0.01")
+
+    marker = tmp_path / "marker"
+    target = tmp_path / "target.txt"
+    script = tmp_path / "flaky.sh"
+    script.write_text(
+        "#!/bin/bash\n"
+        "if [ ! -e %s ]; then touch %s; "
+        "echo 'Resource temporarily unavailable'; exit 1; fi\n"
+        "echo done > %s\n" % (marker, marker, target)
+    )
+    script.chmod(0o755)
+
+    r, _, status, failed = pc.runExternalForFile(
+        str(target),
+        str(script),
+        "Flaky",
+        task="flaky",
+        logfolder=str(tmp_path / "logs"),
+    )
+    assert not failed
+    assert target.read_text() == "done\n"
+    assert "attempt 1 failed transiently" in r
+
+
+def test_retries_are_opt_in(monkeypatch):
+    """Without a budget or the stalled setting nothing is retried"""
+    monkeypatch.delenv(grt.ENVIRONMENT["retries"], raising=False)
+    monkeypatch.delenv(grt.ENVIRONMENT["stalled"], raising=False)
+    policy = grt.RetryPolicy.from_environment("bet a b")
+    assert policy.retries == 0 and not policy.stalled
+    assert policy.retry(75, None, None) is None
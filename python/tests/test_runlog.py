@@ -0,0 +1,38 @@
+import general.process as gp
+
+
+def test_runlog_streams_records(tmp_path):
+    """Run log records are appended in order and summarized as they arrive"""
+    filename = str(tmp_path / "Log-test.log")
+    runlog = gp.RunLog(filename, fsync_interval=0.01, batch=7)
+    for n in range(100):
+        runlog.write("line %d" % n)
+    runlog.record(("s1", "done", 0))
+    runlog.record(("Unknown", "Unknown", None))
+    runlog.record(("s2", "failed", 1))
+    runlog.close()
+
+    with open(filename) as f:
+        assert f.read().splitlines() == ["line %d" % n for n in range(100)]
+    assert runlog.stati == [("s1", "done"), ("s2", "failed")]
+    assert runlog.failed == 1
+
+    runlog.record(("s3", "unknown", None))
+    assert runlog.failed is None
+
+
+def test_writelog(tmp_path, monkeypatch):
+    """writelog splits results into the log text and the status summary"""
+    monkeypatch.setattr(gp, "logname", str(tmp_path / "Log-test.log"))
+    gp.writelog("header")
+
+    monkeypatch.setattr(gp, "runlog", gp.RunLog(gp.logname))
+    gp.writelog(("session report", ("s1", "done", 0)))
+    gp.writelog(("another report", ("s2", "done")))
+    runlog = gp.runlog
+    gp.closelog()
+
+    with open(str(tmp_path / "Log-test.log")) as f:
+        assert f.read().splitlines() == ["header", "session report", "another report"]
+    assert runlog.stati == [("s1", "done"), ("s2", "done")]
+    assert runlog.failed is None
@@ -0,0 +1,45 @@
+import json
+
+import general.scheduler as gs
+
+
+def _session(sid, bolds):
+    session = {"id": sid}
+    for n in range(bolds):
+        session[str(n + 1)] = {"name": "bold%d" % (n + 1)}
+    return session
+
+
+def test_session_times_from_records(tmp_path):
+    """Recorded session durations calibrate the estimates of the others"""
+    runlogs = tmp_path / "runlogs"
+    runlogs.mkdir()
+    record = {"event": "result", "command": "test", "session": "a", "duration": 40}
+    (runlogs / "Results-test-1.jsonl").write_text(json.dumps(record) + "\n")
+
+    sessions = [_session("a", 2), _session("b", 4), _session("c", 1)]
+    options = {"sessionsfolder": str(tmp_path), "runlogs": str(runlogs)}
+    times, seconds = gs.session_times("test", sessions, options)
+    assert seconds and times == [40, 80, 20]
+
+    times, seconds = gs.session_times("other", sessions, options)
+    assert not seconds and times == [2, 4, 1]
+
+
+def test_session_map(tmp_path, monkeypatch):
+    """Job array tasks read only their own sessions from the session map"""
+    import general.core as gc
+
+    batch = tmp_path / "batch.txt"
+    batch.write_text("".join("id: s%d\nsession: s%d\n---\n" % (n, n) for n in range(5)))
+    mapfile = str(tmp_path / "array.sessions")
+    gc.write_session_map(mapfile, [["s0", "s1"], ["s2", "s3"], ["s4"]])
+
+    monkeypatch.setenv("SLURM_ARRAY_TASK_ID", "1")
+    monkeypatch.setenv("SLURM_ARRAY_TASK_MAX", "2")
+    sessions, _ = gc.get_sessions_list(str(batch), sessionids="map:" + mapfile)
+    assert [e["id"] for e in sessions] == ["s2", "s3"]
+
+    assert gc.read_session_map(mapfile, task=2) == ["s4"]
+    monkeypatch.delenv("SLURM_ARRAY_TASK_ID")
+    assert len(gc.read_session_map(mapfile)) == 5
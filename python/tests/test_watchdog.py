@@ -0,0 +1,74 @@
+import sys
+import time
+
+import pytest
+
+import general.core as gc
+import general.watchdog as gwd
+
+
+def _running(pid):
+    try:
+        with open("/proc/%d/stat" % (pid)) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+def test_parse_timeouts():
+    """Timeouts are matched by command name with a default"""
+    spec = "wb_command:30m|bet:90|2h"
+    assert gwd.parse_timeouts(spec, ["wb_command"]) == 1800
+    assert gwd.parse_timeouts(spec, ["fMRIVolume", "bet"]) == 90
+    assert gwd.parse_timeouts(spec, ["other"]) == 7200
+    assert gwd.parse_timeouts("none", ["bet"]) is None
+    assert gwd.command_name("/opt/fsl/bin/bet in out -f 0.3") == "bet"
+    with pytest.raises(ValueError):
+        gwd.parse_duration("2 weeks")
+
+
+def test_timeouts_are_opt_in(monkeypatch):
+    """Commands are only supervised when a timeout is set"""
+    for variable in gwd.ENVIRONMENT.values():
+        monkeypatch.delenv(variable, raising=False)
+    assert gwd.Watchdog.from_environment("ls -l") is None
+    monkeypatch.setenv("QUNEXSTALLTIMEOUT", "bet:2h")
+    assert gwd.Watchdog.from_environment("ls -l") is None
+    assert gwd.Watchdog.from_environment("bet in out").stall == 7200
+
+
+def test_stalled_group_is_killed(tmp_path):
+    """A silent, idle command is terminated with its whole process group"""
+    log = tmp_path / "log.txt"
+    child = tmp_path / "child.pid"
+    script = (
+        "import subprocess, sys, time; "
+        "p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']); "
+        "open(%r, 'w').write(str(p.pid)); time.sleep(60)" % (str(child))
+    )
+    with open(str(log), "w") as f:
+        watchdog = gwd.Watchdog(logfile=str(log), stall=1, report=f, interval=0.2)
+        ret, usage = gc.call_process(
+            [sys.executable, "-c", script], stdout=f, stderr=f, watchdog=watchdog
+        )
+
+    assert ret != 0
+    assert usage["wall"] < 30
+    assert watchdog.outcome == "stalled"
+    assert "WATCHDOG" in log.read_text()
+    time.sleep(0.5)
+    pid = int(child.read_text())
+    alive = [
+        e for e in gwd.group_processes(watchdog.pgid).values() if e["state"] != "Z"
+    ]
+    assert alive == []
+    assert not _running(pid)
+
+
+def test_busy_command_is_not_stalled(tmp_path):
+    """CPU time counts as progress, the hard timeout still applies"""
+    busy = "import time\nt = time.time()\nwhile time.time() - t < 60: pass"
+    watchdog = gwd.Watchdog(stall=1, hard=2, interval=0.2)
+    ret, usage = gc.call_process([sys.executable, "-c", busy], watchdog=watchdog)
+    assert watchdog.outcome == "timeout"
+    assert 2 <= usage["wall"] < 30
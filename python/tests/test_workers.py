@@ -0,0 +1,87 @@
+import os
+import sys
+import functools
+import subprocess
+
+import pytest
+
+import general.workers as gw
+
+
+def _describe(options, item):
+    return os.getpid(), os.environ.get("QX_WORKERS_TEST"), options["value"], item
+
+
+def test_delta_round_trip():
+    """Options are sent as changes to the base and restored in full"""
+    base = {"command_ran": "test", "value": 1, "other": [1, 2]}
+    gw.set_base(base)
+    options = dict(base, value=2, extra="x")
+    del options["other"]
+    task = gw._compact(functools.partial(_describe, options))
+    delta = task.args[0]
+    assert isinstance(delta, gw.Delta)
+    assert delta.changed == {"value": 2, "extra": "x"}
+    assert delta.removed == ["other"]
+    assert gw._expand(task).args[0] == options
+    gw.set_base(None)
+
+
+def test_workers_are_reused(monkeypatch):
+    """Tasks of later calls run in the same warm workers and see the environment"""
+    base = {"command_ran": "test", "value": 1}
+    gw.set_base(base)
+    monkeypatch.setenv("QX_WORKERS_TEST", "first")
+    first = gw.map(functools.partial(_describe, base), [1, 2, 3, 4], 2)
+    monkeypatch.setenv("QX_WORKERS_TEST", "second")
+    second = gw.map(functools.partial(_describe, dict(base, value=3)), [5, 6], 2)
+
+    assert [e[1:] for e in first] == [("first", 1, n) for n in [1, 2, 3, 4]]
+    assert [e[1:] for e in second] == [("second", 3, 5), ("second", 3, 6)]
+    assert {e[0] for e in second} <= {e[0] for e in first}
+    assert os.getpid() not in {e[0] for e in first}
+    gw.set_base(None)
+
+
+NESTED = """
+import sys
+import functools
+import general.workers as gw
+import general.admission as ga
+
+def inner(options, item):
+    return options["value"] * item
+
+def outer(options, item):
+    f = functools.partial(inner, dict(options, value=item))
+    if options.get("admitted"):
+        return ga.map_admitted(f, [1, 2], 2, None, [0, 0])
+    return gw.map(f, [1, 2], 2)
+
+if __name__ == "__main__":
+    options = {"command_ran": "test", "value": 1, "admitted": sys.argv[1] == "yes"}
+    gw.set_base(options)
+    print(gw.map(functools.partial(outer, options), [1, 2, 3], 2))
+"""
+
+
+@pytest.mark.parametrize("admitted", ["no", "yes"])
+def test_nested_map(tmp_path, admitted):
+    """Elements mapped inside a worker run on a pool that does not outlive them"""
+    script = tmp_path / "nested.py"
+    script.write_text(NESTED)
+    temp = tmp_path / "tmp"
+    temp.mkdir()
+    env = dict(os.environ, TMPDIR=str(temp), PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run(
+        [sys.executable, str(script), admitted],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1] == "[[1, 2], [2, 4], [3, 6]]"
+    assert "leaked" not in result.stderr
+    assert not list(temp.glob("qunex-workers-*"))